@@ -0,0 +1,138 @@
+"""
+Coroutine versions of the db_handler functions, so an asyncio front end can serve many desks or API clients from one
+process. Every call runs the db_handler function on a worker thread with its own pooled Session, which is committed
+when the call succeeds and rolled back if it raises, so the calls are independent of each other and of the
+module-level connection:
+
+    import async_db_handler as adb
+
+    async def desk():
+        outcome, place = await adb.try_checkout(isbn, account_id)
+        books = await adb.get_filtered_books(filter_attributes=Book(author="Jim Davis"))
+
+The iter_filtered_* functions and overdue_report are async generators that fetch chunk_size rows at a time on a thread
+of their own.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from itertools import islice
+from typing import AsyncIterator, Callable
+
+import db_handler as db
+
+# One worker per pooled connection. The async generators hold their Session across awaits, so they each run on a
+# thread of their own instead: if they used these workers, every worker could end up waiting for a Session that only a
+# stream's next chunk (which would need a worker) would give back
+_executor = ThreadPoolExecutor(max_workers=db.POOL_SIZE, thread_name_prefix="async_db_handler")
+
+
+def _run_in_session(func: Callable, args: tuple, kwargs: dict):
+    """
+    Runs func on a Session of its own, committing if it returns and rolling back if it raises.
+    """
+    with db.Session() as session:
+        return func(*args, session=session, **kwargs)
+
+
+def _coroutine(func: Callable) -> Callable:
+    """
+    returns a coroutine function with func's signature that runs func with _run_in_session on the executor.
+    """
+    @wraps(func)
+    async def run(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, partial(_run_in_session, func, args, kwargs))
+
+    return run
+
+
+def _close_stream(rows, session: db.Session):
+    """
+    Closes the generator (and so its cursor) before the session goes back to the pool.
+    """
+    try:
+        rows.close()
+    finally:
+        session.close()
+
+
+def _async_generator(func: Callable) -> Callable:
+    """
+    returns an async generator function with func's signature. func must be one of the db_handler generator functions
+        that take chunk_size; its rows are fetched chunk_size at a time on a thread of the generator's own and the
+        Session is held until the generator is exhausted or closed.
+    """
+    @wraps(func)
+    async def run(*args, chunk_size: int = db.DEFAULT_CHUNK_SIZE, **kwargs) -> AsyncIterator:
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="async_db_handler_stream")
+
+        try:
+            session = await loop.run_in_executor(executor, db.Session)
+            rows = func(*args, chunk_size=chunk_size, session=session, **kwargs)
+
+            try:
+                while True:
+                    chunk = await loop.run_in_executor(executor, list, islice(rows, chunk_size))
+                    if not chunk:
+                        break
+
+                    for row in chunk:
+                        yield row
+
+            finally:
+                await loop.run_in_executor(executor, _close_stream, rows, session)
+
+        finally:
+            executor.shutdown(wait=False)
+
+    return run
+
+
+add_book = _coroutine(db.add_book)
+add_user = _coroutine(db.add_user)
+edit_user = _coroutine(db.edit_user)
+checkout_book = _coroutine(db.checkout_book)
+waitlist_user = _coroutine(db.waitlist_user)
+update_waitlist = _coroutine(db.update_waitlist)
+return_book = _coroutine(db.return_book)
+grant_extension = _coroutine(db.grant_extension)
+try_checkout = _coroutine(db.try_checkout)
+return_books = _coroutine(db.return_books)
+checkout_books = _coroutine(db.checkout_books)
+
+get_book = _coroutine(db.get_book)
+get_user = _coroutine(db.get_user)
+book_exists = _coroutine(db.book_exists)
+user_exists = _coroutine(db.user_exists)
+book_and_user_exist = _coroutine(db.book_and_user_exist)
+loan_exists = _coroutine(db.loan_exists)
+search_books_fulltext = _coroutine(db.search_books_fulltext)
+get_filtered_books = _coroutine(db.get_filtered_books)
+get_filtered_users = _coroutine(db.get_filtered_users)
+get_filtered_loans = _coroutine(db.get_filtered_loans)
+get_filtered_loan_histories = _coroutine(db.get_filtered_loan_histories)
+get_loan_histories_columnar = _coroutine(db.get_loan_histories_columnar)
+get_filtered_waitlist = _coroutine(db.get_filtered_waitlist)
+number_in_stock = _coroutine(db.number_in_stock)
+place_in_line = _coroutine(db.place_in_line)
+line_length = _coroutine(db.line_length)
+check_availability = _coroutine(db.check_availability)
+rebuild_availability = _coroutine(db.rebuild_availability)
+
+iter_filtered_books = _async_generator(db.iter_filtered_books)
+iter_filtered_users = _async_generator(db.iter_filtered_users)
+iter_filtered_loans = _async_generator(db.iter_filtered_loans)
+iter_filtered_loan_histories = _async_generator(db.iter_filtered_loan_histories)
+iter_filtered_waitlist = _async_generator(db.iter_filtered_waitlist)
+overdue_report = _async_generator(db.overdue_report)
+
+page_cursor = db.page_cursor
+
+
+def shutdown():
+    """
+    Waits for running calls to finish and stops the worker threads. The module can't be used afterwards.
+    """
+    _executor.shutdown(wait=True)
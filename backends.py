@@ -0,0 +1,146 @@
+"""
+Storage backends for db_handler, load_db and migrations, picked with DB_CONFIG["backend"]:
+
+    "mariadb" (the default) - A MariaDB server, using the username, password, host, port and database in DB_CONFIG.
+    "sqlite" - An embedded SQLite database in the file DB_CONFIG["sqlite_path"] (library.sqlite3 by default). There is
+        no server round trip per call, so small branches and kiosks can run without a server and it is a zero-network
+        baseline for the benchmarks.
+
+The SQL in db_handler, migrations and the data/*.sql files is written for MariaDB. The SQLite backend hands out
+connections and cursors that work like the mariadb ones and translate every statement to SQLite's dialect on the way
+through (see sqlite_backend.translate), so the rest of the code doesn't need to know which backend it is running on.
+
+Nothing is imported for a backend until it is picked and connected with, so e.g. the CLI starts without loading the
+mariadb connector.
+"""
+from contextlib import contextmanager
+from itertools import count
+
+from MARIADB_CREDS import DB_CONFIG
+
+BACKEND_MARIADB = "mariadb"
+BACKEND_SQLITE = "sqlite"
+
+# Numbers the MariaDB connection pools so each one gets a unique name
+_pool_ids = count(1)
+
+
+class MariaDBBackend:
+    name = BACKEND_MARIADB
+
+    def __init__(self, config: dict):
+        self.config = config
+
+    @property
+    def Error(self):
+        from mariadb import Error
+        return Error
+
+    @property
+    def ProgrammingError(self):
+        from mariadb import ProgrammingError
+        return ProgrammingError
+
+    def _connect_args(self) -> dict:
+        return {"user": self.config["username"], "password": self.config["password"], "host": self.config["host"],
+                "port": self.config["port"]}
+
+    def connect(self, use_database: bool = True):
+        """
+        use_database - If False, connect to the server without selecting the database, e.g. to create it.
+
+        returns a new connection.
+        """
+        from mariadb import connect
+
+        if not use_database:
+            return connect(**self._connect_args())
+        return connect(database=self.config["database"], **self._connect_args())  # , collation='utf8mb4_unicode_ci')
+
+    def connection_pool(self, pool_name: str, pool_size: int):
+        """
+        returns a pool whose get_connection() hands out connections to the database. The connector won't create two
+        pools with the same name, and one is still registered until it is closed (e.g. one from before db_handler was
+        reloaded), so every pool gets a name of its own that starts with pool_name.
+        """
+        from mariadb import ConnectionPool
+
+        return ConnectionPool(pool_name=f"{pool_name}_{next(_pool_ids)}", pool_size=pool_size,
+                              database=self.config["database"], **self._connect_args())
+
+    def describe(self) -> str:
+        return (f"\tUsername: {self.config['username']}\n\tPassword: {self.config['password']}\n"
+                f"\tPort: {self.config['port']}")
+
+    def use_database(self, cur):
+        """
+        Creates the database if it doesn't exist yet and switches cur to it.
+        """
+        cur.execute(f"CREATE DATABASE IF NOT EXISTS {self.config['database']}")
+        cur.execute(f"USE {self.config['database']}")
+
+    @contextmanager
+    def bulk_load(self, cur):
+        """
+        Turns autocommit and unique checks off on cur for the duration of the block, then puts them back.
+        """
+        cur.execute("SELECT @@autocommit, @@unique_checks")
+        autocommit, unique_checks = cur.fetchone()
+        cur.execute("SET autocommit = 0")
+        cur.execute("SET unique_checks = 0")
+
+        try:
+            yield
+        finally:
+            cur.execute("SET unique_checks = ?", [unique_checks])
+            cur.execute("SET autocommit = ?", [autocommit])
+
+    def execute_literal(self, cur, statement: str):
+        """
+        Runs a statement from one of the data files, which has all of its values written out in it.
+        """
+        # The second argument is due to MariaDB using '?' as a placeholder, so we're saying put ? in its place
+        cur.execute(statement, ["?"] * statement.count("?"))
+
+    def is_view(self, cur, name: str) -> bool:
+        cur.execute("""
+            SELECT TABLE_TYPE FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ?
+        """, [name])
+        row = cur.fetchone()
+        return row is not None and row[0] == "VIEW"
+
+    def explain(self, cur, query: str, params: list) -> tuple[str, str]:
+        """
+        returns (possible_keys, key) from EXPLAIN query: the indexes that could be used for it and the one picked.
+        """
+        cur.execute("EXPLAIN " + query, params)
+        columns = [column[0] for column in cur.description]
+        row = dict(zip(columns, cur.fetchone()))
+        return row["possible_keys"], row["key"]
+
+    def version(self, cur) -> str:
+        cur.execute("SELECT VERSION()")
+        return "MariaDB " + cur.fetchone()[0]
+
+
+BACKENDS = (BACKEND_MARIADB, BACKEND_SQLITE)
+
+
+def get_backend(config: dict = None):
+    """
+    config - The settings to use, DB_CONFIG if None.
+
+    returns the backend named by config["backend"], MariaDB if it isn't set.
+    """
+    config = DB_CONFIG if config is None else config
+    name = config.get("backend", BACKEND_MARIADB)
+
+    if name == BACKEND_MARIADB:
+        return MariaDBBackend(config)
+
+    if name == BACKEND_SQLITE:
+        from sqlite_backend import SQLiteBackend
+        return SQLiteBackend(config)
+
+    raise ValueError(f"Unknown backend {name!r}, expected one of {', '.join(BACKENDS)}")
@@ -0,0 +1,154 @@
+"""
+Compares the __slots__ model classes against the original __dict__ based ones on every row of data/book.sql.
+
+Run from the project root with:
+    python -m benchmarks.bench_models [path/to/book.sql] [--repeat N]
+"""
+import argparse
+import re
+import tracemalloc
+from time import perf_counter
+
+from load_db import split_insert
+from models.Book import Book
+
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "0": "\0"}
+
+
+class DictBook:
+    """
+    A copy of Book as it was before __slots__, kept here as the baseline.
+    """
+    def __init__(self,
+                 isbn: str = None,
+                 title: str = None,
+                 author: str = None,
+                 publication_year: int = -1,
+                 publisher: str = None,
+                 num_owned: int = -1):
+        self.isbn = isbn
+        self.title = title
+        self.author = author
+        self.publication_year = publication_year
+        self.publisher = publisher
+        self.num_owned = num_owned
+
+    def __eq__(self, other):
+        return self.isbn == other.isbn
+
+
+def split_values(values):
+    """
+    values - The parenthesised row from load_db.split_insert, e.g. "('0767409752', 'A Title', 2000)".
+
+    returns a list with the SQL text of every value in the row. Commas inside quoted strings (which may contain
+        backslash escapes) or inside function calls such as DATE_SUB(CURDATE(), INTERVAL 5 DAY) are not split on.
+    """
+    tokens = []
+    current = []
+    depth = 0
+    quote = None
+    escaped = False
+
+    for char in values[1:-1]:
+        if quote:
+            current.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+
+        elif char in ("'", '"'):
+            quote = char
+            current.append(char)
+
+        elif char == "(":
+            depth += 1
+            current.append(char)
+
+        elif char == ")":
+            depth -= 1
+            current.append(char)
+
+        elif char == "," and depth == 0:
+            tokens.append("".join(current).strip())
+            current = []
+
+        else:
+            current.append(char)
+
+    tokens.append("".join(current).strip())
+    return tokens
+
+
+def sql_literal(token: str):
+    """
+    token - A single value from an INSERT statement, either a quoted string, NULL or a number
+
+    returns the equivalent Python value
+    """
+    if token.upper() == "NULL":
+        return None
+    if token.startswith("'"):
+        return re.sub(r"\\(.)", lambda match: _ESCAPES.get(match.group(1), match.group(1)), token[1:-1])
+    return int(token)
+
+
+def read_rows(path: str) -> list[tuple]:
+    """
+    path - A .sql file in the format load_db reads
+
+    returns every inserted row as a tuple, the same shape a SELECT * would give back
+    """
+    rows = []
+    with open(path) as file:
+        for line in file:
+            _, values = split_insert(line.strip())
+            if values is None:
+                continue
+            rows.append(tuple(sql_literal(token) for token in split_values(values)))
+    return rows
+
+
+def measure(label: str, build, rows: list[tuple], repeat: int):
+    """
+    label - What to print for this row of the report
+    build - Takes the rows and returns a list of model objects
+    rows - Passed straight to build
+    repeat - How many timed runs to take the best of
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        build(rows)
+        best = min(best, perf_counter() - start)
+
+    tracemalloc.start()
+    objects = build(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{label:<24}{best * 1000:>10.1f} ms{peak / 1024:>12.0f} KiB{peak / len(objects):>10.0f} B/row")
+    return objects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path", nargs="?", default="data/book.sql")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = read_rows(args.path)
+    print(f"{len(rows)} rows from {args.path}\n")
+    print(f"{'':<24}{'best time':>13}{'peak memory':>16}{'':>16}")
+
+    old = measure("DictBook(*row)", lambda rows: [DictBook(*row) for row in rows], rows, args.repeat)
+    new = measure("Book(*row)", lambda rows: [Book(*row) for row in rows], rows, args.repeat)
+
+    assert all(a.isbn == b.isbn and a.title == b.title for a, b in zip(old, new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Per-call latency of the fixed db_handler lookups sent as plain text queries versus through the prepared statement
+registry. Needs the database from MARIADB_CREDS.py loaded with load_db.py, and only reads from it.
+
+Run from the project root with:
+    python -m benchmarks.bench_prepared [--calls N]
+"""
+import argparse
+from time import perf_counter_ns
+
+import db_handler as db
+from benchmarks.stats import percentile
+
+
+def time_calls(call, args: list) -> list[float]:
+    """
+    returns how long each call(*a) for a in args took, in microseconds.
+    """
+    times = []
+    for a in args:
+        start = perf_counter_ns()
+        call(*a)
+        times.append((perf_counter_ns() - start) / 1000)
+    return times
+
+
+def report(label: str, times: list[float]):
+    times = sorted(times)
+    print(f"{label:<40}{percentile(times, 0.50):>10.1f}{percentile(times, 0.99):>10.1f}")
+
+
+def text_query(name: str):
+    """
+    returns a function that runs STATEMENTS[name] on the plain module-level cursor, the way it was sent before the
+    registry.
+    """
+    def run(*params):
+        db.cur.execute(db.STATEMENTS[name], list(params))
+        return db.cur.fetchone()
+    return run
+
+
+def prepared_query(name: str):
+    """
+    returns a function that runs STATEMENTS[name] through the registry.
+    """
+    def run(*params):
+        return db._execute(name, list(params)).fetchone()
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    db.cur.execute("SELECT isbn, account_id FROM Waitlist")
+    waitlisted = db.cur.fetchall()
+    samples = [waitlisted[i % len(waitlisted)] for i in range(args.calls)]
+    isbns = [(isbn,) for isbn, _ in samples]
+
+    print(f"{args.calls} calls each, times in microseconds\n")
+    print(f"{'':<40}{'p50':>10}{'p99':>10}")
+
+    for name, params in [("number_in_stock", isbns), ("line_length", isbns), ("place_in_line", samples)]:
+        time_calls(prepared_query(name), params[:50])  # prepare and warm up outside the timed runs
+        report(f"{name} (text)", time_calls(text_query(name), params))
+        report(f"{name} (prepared)", time_calls(prepared_query(name), params))
+
+    db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
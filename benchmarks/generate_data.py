@@ -0,0 +1,314 @@
+"""
+Generates a synthetic dataset with the same tables as data/*.sql, at any scale and with realistic skew: title
+popularity is Zipfian, so a few hot ISBNs are always checked out and have long waitlists, patrons range from occasional
+to heavy readers, and the loan history spans several years. The output only depends on the parameters, the seed and
+--as-of, the reference date the tsv dates count back from and the latest publication year is taken from.
+
+Run from the project root with:
+    python -m benchmarks.generate_data OUT_DIR [--books N] [--users N] [--loans N] [--history N] [--seed S]
+                                               [--format sql|tsv]
+
+The sql format writes book.sql, user.sql, loan.sql, loan_history.sql and waitlist.sql in the format load_db reads, with
+dates relative to the day they are loaded like the files in data/, so they can be loaded with
+load_db(data_dir=OUT_DIR, bulk=True) or benchmarked with python -m benchmarks.suite --datasets OUT_DIR/. The tsv format
+writes one tab-separated file per table, with dates relative to --as-of, and a load.sql for
+LOAD DATA LOCAL INFILE, which is much faster at tens of millions of rows. load.sql starts from an unmigrated schema, so
+apply the migrations afterwards:
+    cd OUT_DIR && mariadb --local-infile=1 DATABASE < load.sql && cd - && python migrations.py
+"""
+import argparse
+import os
+import random
+from datetime import date, timedelta
+from itertools import accumulate
+
+# The tables in the order load_db loads them, with the data/ file that has their DROP and CREATE statements
+TABLES = [
+    ("Book", "book.sql", ["isbn", "title", "author", "publication_year", "publisher", "num_owned"]),
+    ("User", "user.sql", ["account_id", "name", "address", "phone_number", "email"]),
+    ("LoanHistory", "loan_history.sql", ["isbn", "account_id", "checkout_date", "due_date", "return_date"]),
+    ("Loan", "loan.sql", ["isbn", "account_id", "checkout_date", "due_date"]),
+    ("Waitlist", "waitlist.sql", ["isbn", "account_id", "place_in_line"]),
+]
+
+WORDS = ["Night", "River", "Garden", "Secret", "History", "Shadow", "Light", "Winter", "Stone", "House", "Love", "War",
+         "Ocean", "Kingdom", "Dream", "Fire", "Silent", "Lost", "City", "Road", "Empire", "Star", "Heart", "Island",
+         "Mountain", "Storm", "Journey", "Golden", "Last", "Wild", "Broken", "Hidden", "Forest", "Glass", "Iron",
+         "Memory", "Summer", "Crown", "Song", "Time"]
+FIRST_NAMES = ["Mary", "James", "Maria", "Robert", "Linda", "Michael", "Sofia", "David", "Sarah", "Daniel", "Emma",
+               "Carlos", "Olivia", "Wei", "Fatima", "John", "Aisha", "Lucas", "Hannah", "Roberto", "Grace", "Kenji"]
+LAST_NAMES = ["Smith", "Johnson", "Martinez", "Brown", "Garcia", "Nguyen", "Lee", "Patel", "Davis", "Lopez", "Wilson",
+              "Clark", "Long", "Cooper", "Kim", "Hernandez", "Moore", "Young", "Allen", "Scott", "Khan", "Rivera"]
+PUBLISHERS = ["Penguin Books", "HarperCollins", "Random House", "Ballantine Books", "Vintage", "Scholastic",
+              "Simon & Schuster", "Tor Books", "Bantam", "Oxford University Press", "Emblem Editions", "Dover"]
+STREETS = ["SW 15th Pl", "NE Waldo Rd", "NW 13th St", "SW Archer Rd", "University Ave", "SW 34th St", "NW 39th Ave"]
+EMAIL_DOMAINS = ["gmail.com", "yahoo.com", "outlook.com", "ufl.edu"]
+
+LOAN_DAYS = 14
+EXTENSION_DAYS = 14
+
+
+def zipf_cum_weights(n: int, s: float) -> list[float]:
+    """
+    returns the cumulative weights of ranks 1..n under a Zipf distribution with exponent s, for random.choices.
+    """
+    return list(accumulate(1 / rank ** s for rank in range(1, n + 1)))
+
+
+def split_total(total: int, weights: list[float]) -> list[int]:
+    """
+    returns total split into len(weights) whole parts in proportion to weights.
+    """
+    weight_sum = sum(weights)
+    shares = [total * weight / weight_sum for weight in weights]
+    parts = [int(share) for share in shares]
+
+    # Hand out what rounding down left over to the largest remainders
+    by_remainder = sorted(range(len(shares)), key=lambda i: parts[i] - shares[i])
+    for i in by_remainder[:total - sum(parts)]:
+        parts[i] += 1
+
+    return parts
+
+
+def generate_books(rng: random.Random, num_books: int, as_of: date):
+    """
+    returns the book rows ordered from most to least popular. Popular books own more copies. Authors are Zipfian too,
+        so a few authors have a lot of books. No book is published after as_of's year.
+    """
+    num_authors = max(1, num_books // 8)
+    authors = [f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}" for i in range(num_authors)]
+    author_weights = zipf_cum_weights(num_authors, 1.0)
+    isbns = rng.sample(range(10 ** 9, 10 ** 10), num_books)
+
+    books = []
+    for rank, (isbn, author) in enumerate(zip(isbns, rng.choices(authors, cum_weights=author_weights, k=num_books)),
+                                          start=1):
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 5)))
+        publication_year = max(1850, min(as_of.year, int(rng.gauss(2000, 18))))
+        num_owned = max(1, min(20, int(8 / rank ** 0.25) + rng.randint(-1, 1)))
+        books.append((str(isbn), title, author, publication_year, rng.choice(PUBLISHERS), num_owned))
+
+    return books
+
+
+def generate_users(rng: random.Random, num_users: int):
+    users = []
+    for account_id in rng.sample(range(16 ** 12), num_users):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        address = f"{rng.randint(100, 9999)} {rng.choice(STREETS)}, Gainesville, FL 326{rng.randint(0, 9):02d}"
+        phone_number = f"{rng.randint(200, 999)}-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}"
+        email = f"{first.lower()}.{last.lower()}{rng.randint(1, 999)}@{rng.choice(EMAIL_DOMAINS)}"
+        users.append((f"{account_id:012x}", f"{first} {last}", address, phone_number, email))
+
+    return users
+
+
+def generate_history(rng: random.Random, books: list, users: list, num_history: int, years: int,
+                     book_weights: list[float]):
+    """
+    Yields (isbn, account_id, checkout_days_ago, due_days_ago, return_days_ago) rows. Each user's checkouts are on
+    distinct days, which keeps (isbn, account_id, checkout_date) unique without remembering every row. How many loans a
+    user has is lognormal, so most read a little and a few read a lot.
+    """
+    span = years * 365
+    activity = [rng.lognormvariate(0, 1) for _ in users]
+
+    for (account_id, *_), num_loans in zip(users, split_total(num_history, activity)):
+        num_loans = min(num_loans, span - 1)
+        if num_loans == 0:
+            continue
+
+        days_ago = rng.sample(range(LOAN_DAYS * 3, span + LOAN_DAYS * 3), num_loans)
+        chosen_books = rng.choices(books, cum_weights=book_weights, k=num_loans)
+
+        for checkout_days_ago, (isbn, *_) in zip(days_ago, chosen_books):
+            due_days_ago = checkout_days_ago - LOAN_DAYS
+            if rng.random() < 0.1:
+                due_days_ago -= EXTENSION_DAYS
+
+            # Most books come back early, some late
+            days_kept = max(1, int(rng.gammavariate(2, 5)) if rng.random() < 0.85 else LOAN_DAYS + rng.randint(1, 60))
+            return_days_ago = max(0, checkout_days_ago - days_kept)
+
+            yield isbn, account_id, checkout_days_ago, due_days_ago, return_days_ago
+
+
+def generate_loans_and_waitlist(rng: random.Random, books: list, users: list, num_loans: int,
+                                num_waitlisted_books: int, max_waitlist: int, book_weights: list[float]):
+    """
+    returns (loans, waitlist). Loans are (isbn, account_id, checkout_days_ago, due_days_ago) and never exceed the
+        copies owned, so the hottest books end up fully checked out. The num_waitlisted_books most popular books that
+        are fully checked out get a waitlist, longest for the most popular.
+    """
+    loans = []
+    taken = {}
+    loaned = set()
+
+    for _ in range(num_loans * 3):
+        if len(loans) == num_loans:
+            break
+
+        isbn, *_, num_owned = rng.choices(books, cum_weights=book_weights)[0]
+        account_id = rng.choice(users)[0]
+        if taken.get(isbn, 0) >= num_owned or (isbn, account_id) in loaned:
+            continue
+
+        checkout_days_ago = rng.randint(0, LOAN_DAYS * 3)
+        due_days_ago = checkout_days_ago - LOAN_DAYS - (EXTENSION_DAYS if rng.random() < 0.1 else 0)
+        loans.append((isbn, account_id, checkout_days_ago, due_days_ago))
+        loaned.add((isbn, account_id))
+        taken[isbn] = taken.get(isbn, 0) + 1
+
+    waitlist = []
+    full_books = [book for book in books if taken.get(book[0], 0) >= book[5]][:num_waitlisted_books]
+
+    for rank, (isbn, *_) in enumerate(full_books, start=1):
+        length = max(1, min(len(users), int(max_waitlist / rank ** 0.7)))
+        waiting = [account_id for account_id, *_ in rng.sample(users, min(len(users), length + 5))
+                   if (isbn, account_id) not in loaned][:length]
+        waitlist.extend((isbn, account_id, place) for place, account_id in enumerate(waiting, start=1))
+
+    return loans, waitlist
+
+
+def sql_value(value) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, int):
+        return str(value)
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def sql_date(days_ago: int) -> str:
+    return f"DATE_SUB(CURDATE(), INTERVAL {days_ago} DAY)"
+
+
+class SqlWriter:
+    """
+    Writes rows in the data/*.sql format: the DROP and CREATE statements copied from data/, then one INSERT per row.
+    """
+    def __init__(self, out_dir: str, schema_dir: str):
+        self.out_dir = out_dir
+        self.schema_dir = schema_dir
+
+    def write(self, table: str, filename: str, columns: list[str], rows, date_columns: set):
+        with open(os.path.join(self.schema_dir, filename)) as schema_file:
+            header = [schema_file.readline(), schema_file.readline()]
+
+        prefix = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ("
+        count = 0
+        with open(os.path.join(self.out_dir, filename), "w") as file:
+            file.writelines(header)
+            for row in rows:
+                values = [sql_date(value) if i in date_columns else sql_value(value) for i, value in enumerate(row)]
+                file.write(prefix + ", ".join(values) + ");\n")
+                count += 1
+
+        return count
+
+
+class TsvWriter:
+    """
+    Writes one tab-separated file per table with dates as YYYY-MM-DD counted back from as_of, plus a load.sql with the
+    DROP and CREATE statements copied from data/ and a LOAD DATA LOCAL INFILE for each file.
+    """
+    def __init__(self, out_dir: str, schema_dir: str, as_of: date):
+        self.out_dir = out_dir
+        self.schema_dir = schema_dir
+        self.as_of = as_of
+
+        # Same as migrations.prepare_reload, plus forgetting the applied migrations like load_db's reset
+        with open(os.path.join(out_dir, "load.sql"), "w") as load_file:
+            load_file.write("DROP VIEW IF EXISTS Waitlist;\nDROP TABLE IF EXISTS SchemaVersion;\n")
+
+    def write(self, table: str, filename: str, columns: list[str], rows, date_columns: set):
+        with open(os.path.join(self.schema_dir, filename)) as schema_file:
+            header = [schema_file.readline(), schema_file.readline()]
+
+        def field(i, value):
+            if value is None:
+                return "\\N"
+            if i in date_columns:
+                return (self.as_of - timedelta(days=value)).isoformat()
+            return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+        tsv_name = filename.replace(".sql", ".tsv")
+        count = 0
+        with open(os.path.join(self.out_dir, tsv_name), "w") as file:
+            for row in rows:
+                file.write("\t".join(field(i, value) for i, value in enumerate(row)) + "\n")
+                count += 1
+
+        with open(os.path.join(self.out_dir, "load.sql"), "a") as load_file:
+            load_file.writelines(header)
+            load_file.write(f"LOAD DATA LOCAL INFILE '{tsv_name}' INTO TABLE {table} ({', '.join(columns)});\n")
+
+        return count
+
+
+def generate(out_dir: str, num_books: int, num_users: int, num_loans: int, num_history: int, years: int,
+             num_waitlisted_books: int, max_waitlist: int, zipf_s: float, seed: int, output_format: str = "sql",
+             schema_dir: str = "data/", as_of: date = None, verbose: bool = True) -> dict:
+    """
+    Writes a dataset to out_dir (see the module docstring for the parameters).
+
+    returns how many rows were written to each table.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = random.Random(seed)
+    as_of = as_of or date.today()
+    if output_format == "sql":
+        writer = SqlWriter(out_dir, schema_dir)
+    else:
+        writer = TsvWriter(out_dir, schema_dir, as_of)
+
+    books = generate_books(rng, num_books, as_of)
+    book_weights = zipf_cum_weights(len(books), zipf_s)
+    users = generate_users(rng, num_users)
+    loans, waitlist = generate_loans_and_waitlist(rng, books, users, num_loans, num_waitlisted_books, max_waitlist,
+                                                  book_weights)
+    history = generate_history(rng, books, users, num_history, years, book_weights)
+
+    table_rows = {
+        "Book": (books, set()),
+        "User": (users, set()),
+        "LoanHistory": (history, {2, 3, 4}),
+        "Loan": (loans, {2, 3}),
+        "Waitlist": (waitlist, set()),
+    }
+
+    counts = {}
+    for table, filename, columns in TABLES:
+        rows, date_columns = table_rows[table]
+        counts[table] = writer.write(table, filename, columns, rows, date_columns)
+        if verbose:
+            print(f"{table}: {counts[table]} rows")
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("out_dir")
+    parser.add_argument("--books", type=int, default=100_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--loans", type=int, default=10_000, help="Books currently checked out")
+    parser.add_argument("--history", type=int, default=1_000_000, help="Rows of LoanHistory")
+    parser.add_argument("--years", type=int, default=5, help="How far back the loan history goes")
+    parser.add_argument("--waitlisted-books", type=int, default=200, help="How many hot books get a waitlist")
+    parser.add_argument("--max-waitlist", type=int, default=100, help="Waitlist length of the hottest book")
+    parser.add_argument("--zipf", type=float, default=1.0, help="Zipf exponent of title popularity")
+    parser.add_argument("--seed", type=int, default=4301)
+    parser.add_argument("--format", choices=["sql", "tsv"], default="sql")
+    parser.add_argument("--as-of", type=date.fromisoformat,
+                        help="The day tsv dates count back from and no book is published after (default today)")
+    parser.add_argument("--schema-dir", default="data/", help="Where to copy the DROP and CREATE statements from")
+    args = parser.parse_args()
+
+    generate(args.out_dir, args.books, args.users, args.loans, args.history, args.years, args.waitlisted_books,
+             args.max_waitlist, args.zipf, args.seed, args.format, args.schema_dir, args.as_of)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Load test for async_db_handler: N simulated desks each run a mix of lookups and searches back to back for a fixed
+time, and the throughput and latency percentiles of every operation are reported. Needs the database from
+MARIADB_CREDS.py loaded with load_db.py. Only reads unless --writes is given, which also checks books out and returns
+them again (adding rows to LoanHistory).
+
+Run from the project root with:
+    python -m benchmarks.load_async [--desks N] [--seconds S] [--writes]
+"""
+import argparse
+import asyncio
+import random
+from time import perf_counter
+
+import async_db_handler as adb
+from benchmarks.stats import percentile
+from models.Book import Book
+from models.Loan import Loan
+from models.User import User
+
+
+async def desk(books: list[Book], users: list[User], deadline: float, writes: bool, rng: random.Random,
+               latencies: dict):
+    """
+    Runs random operations until deadline, adding how long each took (in seconds) to latencies[operation name].
+    """
+    async def timed(name, call):
+        start = perf_counter()
+        result = await call
+        latencies.setdefault(name, []).append(perf_counter() - start)
+        return result
+
+    while perf_counter() < deadline:
+        book = rng.choice(books)
+        user = rng.choice(users)
+        roll = rng.random()
+
+        if roll < 0.3:
+            await timed("number_in_stock", adb.number_in_stock(isbn=book.isbn))
+        elif roll < 0.5:
+            await timed("place_in_line", adb.place_in_line(isbn=book.isbn, account_id=user.account_id))
+        elif roll < 0.65:
+            await timed("get_book", adb.get_book(isbn=book.isbn))
+        elif roll < 0.8:
+            await timed("get_filtered_books", adb.get_filtered_books(filter_attributes=Book(author=book.author),
+                                                                     limit=20))
+        elif roll < 0.9 or not writes:
+            await timed("get_filtered_loans",
+                        adb.get_filtered_loans(filter_attributes=Loan(account_id=user.account_id)))
+        else:
+            outcome, _ = await timed("try_checkout", adb.try_checkout(isbn=book.isbn, account_id=user.account_id))
+            if outcome == adb.db.CHECKOUT_SUCCESS:
+                await timed("return_book", adb.return_book(isbn=book.isbn, account_id=user.account_id))
+
+
+async def run(num_desks: int, seconds: float, writes: bool, seed: int) -> dict:
+    books = await adb.get_filtered_books(filter_attributes=Book(), limit=2000)
+    users = await adb.get_filtered_users(filter_attributes=User(), limit=2000)
+
+    latencies = {}
+    deadline = perf_counter() + seconds
+    await asyncio.gather(*(desk(books, users, deadline, writes, random.Random(seed + i), latencies)
+                           for i in range(num_desks)))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--desks", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--writes", action="store_true")
+    parser.add_argument("--seed", type=int, default=4301)
+    args = parser.parse_args()
+
+    latencies = asyncio.run(run(args.desks, args.seconds, args.writes, args.seed))
+    adb.shutdown()
+
+    total = sum(len(times) for times in latencies.values())
+    print(f"{args.desks} desks, {args.seconds:g} s, pool of {adb.db.POOL_SIZE} connections")
+    print(f"{total} operations, {total / args.seconds:.0f} ops/s\n")
+    print(f"{'':<22}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+
+    for name, times in sorted(latencies.items()):
+        times.sort()
+        print(f"{name:<22}{len(times):>8}{percentile(times, 0.5) * 1000:>10.2f}"
+              f"{percentile(times, 0.95) * 1000:>10.2f}{percentile(times, 0.99) * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Load generator for server.py: N client threads each keep one HTTP/1.1 connection open and send a mix of requests back
+to back for a fixed time, then the throughput and latency percentiles of every request type are reported. Start the
+server first (python server.py). Only reads unless --writes is given, which also checks books out and returns them
+again (adding rows to LoanHistory).
+
+Run from the project root with:
+    python -m benchmarks.load_http [--clients N] [--seconds S] [--writes] [--host H] [--port P]
+"""
+import argparse
+import json
+import random
+from http.client import HTTPConnection
+from threading import Thread
+from time import perf_counter
+from urllib.parse import urlencode
+
+from benchmarks.stats import percentile
+
+# Same defaults as server.py, which isn't imported so the load generator doesn't need a database connection
+HOST = "127.0.0.1"
+PORT = 8080
+
+
+def request(connection: HTTPConnection, method: str, path: str, body: dict = None):
+    """
+    returns the decoded JSON response.
+    """
+    data = None if body is None else json.dumps(body)
+    headers = {} if body is None else {"Content-Type": "application/json"}
+    connection.request(method, path, body=data, headers=headers)
+    response = connection.getresponse()
+    return json.loads(response.read())
+
+
+def client(host: str, port: int, books: list, users: list, deadline: float, writes: bool, rng: random.Random,
+           latencies: dict):
+    """
+    Sends random requests until deadline, adding how long each took (in seconds) to latencies[request name].
+    """
+    connection = HTTPConnection(host, port)
+
+    def timed(name, method, path, body=None):
+        start = perf_counter()
+        result = request(connection, method, path, body)
+        latencies.setdefault(name, []).append(perf_counter() - start)
+        return result
+
+    while perf_counter() < deadline:
+        book = rng.choice(books)
+        user = rng.choice(users)
+        roll = rng.random()
+
+        if roll < 0.4:
+            timed("GET /books (isbn)", "GET", "/books?" + urlencode({"isbn": book["isbn"]}))
+        elif roll < 0.6:
+            timed("GET /books (author)", "GET", "/books?" + urlencode({"author": book["author"]}))
+        elif roll < 0.75:
+            timed("GET /loans (account_id)", "GET", "/loans?" + urlencode({"account_id": user["account_id"]}))
+        elif roll < 0.9 or not writes:
+            timed("GET /search", "GET", "/search?" + urlencode({"q": (book["title"] or "").split(" ")[0],
+                                                               "limit": 10}))
+        else:
+            pair = {"isbn": book["isbn"], "account_id": user["account_id"]}
+            if timed("POST /checkout", "POST", "/checkout", pair)["outcome"] == "checked_out":
+                timed("POST /return", "POST", "/return", pair)
+
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--writes", action="store_true")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--seed", type=int, default=4301)
+    args = parser.parse_args()
+
+    setup = HTTPConnection(args.host, args.port)
+    books = request(setup, "GET", "/books")
+    users = request(setup, "GET", "/users")
+    setup.close()
+
+    latencies = [{} for _ in range(args.clients)]
+    deadline = perf_counter() + args.seconds
+    threads = [Thread(target=client, args=(args.host, args.port, books, users, deadline, args.writes,
+                                           random.Random(args.seed + i), latencies[i]))
+               for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    merged = {}
+    for client_latencies in latencies:
+        for name, times in client_latencies.items():
+            merged.setdefault(name, []).extend(times)
+
+    total = sum(len(times) for times in merged.values())
+    print(f"{args.clients} clients, {args.seconds:g} s")
+    print(f"{total} requests, {total / args.seconds:.0f} requests/s\n")
+    print(f"{'':<26}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+
+    for name, times in sorted(merged.items()):
+        times.sort()
+        print(f"{name:<26}{len(times):>8}{percentile(times, 0.5) * 1000:>10.2f}"
+              f"{percentile(times, 0.95) * 1000:>10.2f}{percentile(times, 0.99) * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+def percentile(sorted_times: list[float], fraction: float) -> float:
+    """
+    sorted_times - Latencies in ascending order
+    fraction - e.g. 0.99 for the 99th percentile
+
+    returns the nearest-rank percentile of sorted_times.
+    """
+    return sorted_times[min(len(sorted_times) - 1, int(len(sorted_times) * fraction))]
+
+
+def summarize(times: list[float], elapsed: float = None) -> dict:
+    """
+    times - How long each call took, in seconds
+    elapsed - The wall time the calls were spread over. Defaults to the sum of times, i.e. calls made one after another.
+
+    returns a dict with the number of calls, p50/p95/p99/max latency in milliseconds and the throughput in calls per
+        second.
+    """
+    times = sorted(times)
+    elapsed = sum(times) if elapsed is None else elapsed
+
+    return {
+        "count": len(times),
+        "p50_ms": percentile(times, 0.50) * 1000,
+        "p95_ms": percentile(times, 0.95) * 1000,
+        "p99_ms": percentile(times, 0.99) * 1000,
+        "max_ms": times[-1] * 1000,
+        "ops_per_s": len(times) / elapsed if elapsed > 0 else float("inf"),
+    }
@@ -0,0 +1,347 @@
+"""
+Repeatable benchmark suite for load_db, the core db_handler operations and the CLI's desk flows (checkout, extension,
+return and waitlisting through helper_functions). Every dataset directory (in the data/ file format) is loaded into a
+throwaway schema and each operation is called with randomly chosen but seeded arguments, then p50/p95/p99 latency and
+throughput are reported and written as JSON. Given a baseline from an earlier run, any operation whose latency got worse
+by more than the threshold is reported as a regression and the exit status is 1.
+
+Run from the project root with:
+    python -m benchmarks.suite [--datasets test_data/ data/] [--calls N] [--output results.json]
+                               [--baseline baseline.json] [--threshold 0.2] [--metric p95_ms] [--backend sqlite]
+
+The throwaway schema (<database>_bench by default, see --schema) is dropped afterwards unless --keep-schema is given.
+The real database in MARIADB_CREDS.py is never touched. With --backend sqlite the schema is the SQLite file
+<schema>.sqlite3 instead, which gives a zero-network baseline to compare the MariaDB results against.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+from contextlib import redirect_stdout
+from datetime import datetime
+from importlib import import_module
+from time import perf_counter
+from unittest.mock import patch
+
+from backends import BACKENDS, BACKEND_MARIADB, BACKEND_SQLITE
+from benchmarks.stats import summarize
+from MARIADB_CREDS import DB_CONFIG
+from models.LoanHistory import LoanHistory
+from models.Waitlist import Waitlist
+from models.Book import Book
+from models.Loan import Loan
+from models.User import User
+
+DEFAULT_DATASETS = ["test_data/", "data/"]
+TABLES = ["Book", "User", "Loan", "LoanHistory", "WaitlistEntry"]
+
+
+def server_connection():
+    from mariadb import connect
+    return connect(user=DB_CONFIG["username"], password=DB_CONFIG["password"], host=DB_CONFIG["host"],
+                   port=DB_CONFIG["port"])
+
+
+def run_on_server(statement: str):
+    conn = server_connection()
+    try:
+        conn.cursor().execute(statement)
+    finally:
+        conn.close()
+
+
+def time_calls(call, args_list: list[tuple]) -> list[float]:
+    """
+    returns how long each call(*args) for args in args_list took, in seconds.
+    """
+    times = []
+    for args in args_list:
+        start = perf_counter()
+        call(*args)
+        times.append(perf_counter() - start)
+    return times
+
+
+def sample(rng: random.Random, population: list, calls: int) -> list:
+    return [rng.choice(population) for _ in range(calls)] if population else []
+
+
+def bench_dataset(db, load_db, data_dir: str, calls: int, rng: random.Random) -> dict:
+    """
+    Loads data_dir into the throwaway schema and benchmarks every operation on it.
+
+    returns {"sizes": rows per table, "operations": {operation name: summarize() of its calls}}
+    """
+    operations = {}
+
+    start = perf_counter()
+    load_db(data_dir=data_dir, verbose=False, parent_cur=db.cur, parent_conn=db.conn, bulk=True)
+    load_time = perf_counter() - start
+    db.clear_cache()
+
+    sizes = {}
+    for table in TABLES:
+        db.cur.execute(f"SELECT COUNT(*) FROM {table}")
+        (sizes[table],) = db.cur.fetchone()
+
+    operations["load_db"] = summarize([load_time])
+    operations["load_db"]["rows_per_s"] = sum(sizes.values()) / load_time
+
+    db.cur.execute("SELECT isbn, title, author, publication_year FROM Book")
+    books = db.cur.fetchall()
+    db.cur.execute("SELECT account_id, name FROM User")
+    users = db.cur.fetchall()
+    db.cur.execute("SELECT isbn, account_id FROM Waitlist")
+    waitlisted = db.cur.fetchall()
+    db.save_changes()
+
+    def first_word(text):
+        return (text or "").split(" ")[0]
+
+    reads = {
+        "get_filtered_books (isbn)": (
+            lambda isbn: db.get_filtered_books(filter_attributes=Book(isbn=isbn)),
+            [(isbn,) for isbn, *_ in sample(rng, books, calls)]),
+        "get_filtered_books (author)": (
+            lambda author: db.get_filtered_books(filter_attributes=Book(author=author)),
+            [(author,) for _, _, author, _ in sample(rng, books, calls)]),
+        "get_filtered_books (title prefix)": (
+            lambda title: db.get_filtered_books(filter_attributes=Book(title=f"{title}%"), use_patterns=True),
+            [(first_word(title),) for _, title, _, _ in sample(rng, books, calls)]),
+        "get_filtered_books (publication year range)": (
+            lambda year: db.get_filtered_books(filter_attributes=Book(), min_publication_year=year,
+                                               max_publication_year=year + 1),
+            [(year,) for *_, year in sample(rng, books, calls)]),
+        "get_filtered_books (page of 20 by title)": (
+            lambda title: db.get_filtered_books(filter_attributes=Book(), order_by="title", limit=20,
+                                                after=db.page_cursor(Book(isbn="", title=title), order_by="title")),
+            [(title,) for _, title, _, _ in sample(rng, books, calls)]),
+        "get_filtered_users (account_id)": (
+            lambda account_id: db.get_filtered_users(filter_attributes=User(account_id=account_id)),
+            [(account_id,) for account_id, _ in sample(rng, users, calls)]),
+        "get_filtered_users (name prefix)": (
+            lambda name: db.get_filtered_users(filter_attributes=User(name=f"{name}%"), use_patterns=True),
+            [(first_word(name),) for _, name in sample(rng, users, calls)]),
+        "get_filtered_loans (account_id)": (
+            lambda account_id: db.get_filtered_loans(filter_attributes=Loan(account_id=account_id)),
+            [(account_id,) for account_id, _ in sample(rng, users, calls)]),
+        "get_filtered_loan_histories (account_id)": (
+            lambda account_id: db.get_filtered_loan_histories(filter_attributes=LoanHistory(account_id=account_id)),
+            [(account_id,) for account_id, _ in sample(rng, users, calls)]),
+        "get_filtered_waitlist (isbn)": (
+            lambda isbn: db.get_filtered_waitlist(filter_attributes=Waitlist(isbn=isbn)),
+            [(isbn,) for isbn, _ in sample(rng, waitlisted, calls)]),
+        "number_in_stock": (
+            lambda isbn: db.number_in_stock(isbn=isbn),
+            [(isbn,) for isbn, *_ in sample(rng, books, calls)]),
+        "place_in_line": (
+            lambda isbn, account_id: db.place_in_line(isbn=isbn, account_id=account_id),
+            sample(rng, waitlisted, calls)),
+    }
+
+    for name, (call, args_list) in reads.items():
+        if args_list:
+            operations[name] = summarize(time_calls(call, args_list))
+            db.save_changes()
+
+    def pick_pairs(eligible, one_per_book: bool) -> list[tuple]:
+        """
+        returns up to calls random (isbn, account_id) pairs for which eligible(isbn, account_id) is true. Picked before
+            timing, and with one_per_book each book is used at most once so none runs out part way through.
+        """
+        picked = {}
+        for _ in range(calls * 10):
+            if len(picked) == calls:
+                break
+            (isbn, *_), (account_id, _) = rng.choice(books), rng.choice(users)
+            key = isbn if one_per_book else (isbn, account_id)
+            if key not in picked and eligible(isbn, account_id):
+                picked[key] = (isbn, account_id)
+        db.save_changes()
+        return list(picked.values())
+
+    # Pairs that can be checked out: the book is in stock and the user doesn't already have it
+    pairs = pick_pairs(lambda isbn, account_id: db.number_in_stock(isbn=isbn) > 0
+                       and not db.loan_exists(isbn=isbn, account_id=account_id), one_per_book=True)
+
+    # Each write is committed, the same as one iteration of the main menu
+    def checkout(isbn, account_id):
+        db.checkout_book(isbn=isbn, account_id=account_id)
+        db.update_waitlist(isbn=isbn)
+        db.save_changes()
+
+    def grant_extension(isbn, account_id):
+        db.grant_extension(isbn=isbn, account_id=account_id)
+        db.save_changes()
+
+    def return_book(isbn, account_id):
+        db.return_book(isbn=isbn, account_id=account_id)
+        db.save_changes()
+
+    if pairs:
+        operations["checkout_book + update_waitlist"] = summarize(time_calls(checkout, pairs))
+        operations["grant_extension"] = summarize(time_calls(grant_extension, pairs))
+        operations["return_book"] = summarize(time_calls(return_book, pairs))
+
+    operations.update(bench_desk(db, pick_pairs))
+    return {"sizes": sizes, "operations": operations}
+
+
+def bench_desk(db, pick_pairs) -> dict:
+    """
+    Benchmarks the CLI's checkout, extension, return and waitlist flows by calling the helper_functions the main menu
+    calls, with their prompts answered from a script and their output thrown away. Each call is followed by the
+    commit_pending the main menu does after every choice.
+
+    returns {operation name: summarize() of its calls}
+    """
+    import helper_functions as helper
+
+    operations = {}
+    answers = iter(())
+
+    def scripted_input(prompt: str = "") -> str:
+        return next(answers)
+
+    def desk(flow, *extra_answers):
+        def run(isbn, account_id):
+            nonlocal answers
+            answers = iter([isbn, account_id, *extra_answers])
+            flow()
+            helper.commit_pending()
+        return run
+
+    # Books with no waitlist that are in stock, so the checkout goes straight through
+    pairs = pick_pairs(lambda isbn, account_id: db.number_in_stock(isbn=isbn) > 0 and db.line_length(isbn=isbn) == 0
+                       and not db.loan_exists(isbn=isbn, account_id=account_id), one_per_book=True)
+    # Books that are out of stock, so the checkout asks to waitlist the user
+    waitlist_pairs = pick_pairs(lambda isbn, account_id: db.number_in_stock(isbn=isbn) <= 0
+                                and db.place_in_line(isbn=isbn, account_id=account_id) == -1
+                                and not db.loan_exists(isbn=isbn, account_id=account_id), one_per_book=False)
+
+    with patch("builtins.input", scripted_input), open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        if pairs:
+            operations["desk: checkout"] = summarize(time_calls(desk(helper.checkout_book, "N"), pairs))
+            operations["desk: extension"] = summarize(time_calls(desk(helper.grant_extension), pairs))
+            operations["desk: return"] = summarize(time_calls(desk(helper.return_book), pairs))
+
+        if waitlist_pairs:
+            operations["desk: checkout + waitlist"] = summarize(time_calls(desk(helper.checkout_book, "Y"),
+                                                                           waitlist_pairs))
+
+    db.save_changes()
+    return operations
+
+
+def compare(results: dict, baseline: dict, metric: str, threshold: float) -> list[tuple]:
+    """
+    returns (dataset, operation, baseline value, new value, ratio) for every operation in both results and baseline
+        whose metric grew by more than threshold (e.g. 0.2 for 20%).
+    """
+    regressions = []
+
+    for dataset, dataset_results in results["datasets"].items():
+        baseline_operations = baseline.get("datasets", {}).get(dataset, {}).get("operations", {})
+
+        for operation, summary in dataset_results["operations"].items():
+            if operation not in baseline_operations or metric not in summary:
+                continue
+
+            old, new = baseline_operations[operation][metric], summary[metric]
+            if old > 0 and new / old > 1 + threshold:
+                regressions.append((dataset, operation, old, new, new / old))
+
+    return regressions
+
+
+def print_results(results: dict):
+    for dataset, dataset_results in results["datasets"].items():
+        sizes = ", ".join(f"{count} {table}" for table, count in dataset_results["sizes"].items())
+        print(f"\n{dataset} ({sizes})")
+        print(f"{'':<46}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>10}")
+
+        for operation, summary in dataset_results["operations"].items():
+            print(f"{operation:<46}{summary['count']:>7}{summary['p50_ms']:>10.2f}{summary['p95_ms']:>10.2f}"
+                  f"{summary['p99_ms']:>10.2f}{summary['ops_per_s']:>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--datasets", nargs="+", default=DEFAULT_DATASETS,
+                        help="Directories of .sql files in the data/ format, smallest first")
+    parser.add_argument("--calls", type=int, default=200, help="Calls per operation")
+    parser.add_argument("--seed", type=int, default=4301)
+    parser.add_argument("--backend", choices=list(BACKENDS), default=DB_CONFIG.get("backend", BACKEND_MARIADB))
+    parser.add_argument("--schema", default=DB_CONFIG["database"] + "_bench")
+    parser.add_argument("--keep-schema", action="store_true")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--metric", default="p50_ms", choices=["p50_ms", "p95_ms", "p99_ms"])
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="How much worse than the baseline counts as a regression, e.g. 0.2 for 20%%")
+    args = parser.parse_args()
+
+    if args.schema == DB_CONFIG["database"]:
+        parser.error("--schema must not be the real database, it is dropped afterwards")
+
+    # db_handler and load_db read DB_CONFIG when they connect, so point it at the throwaway schema first
+    DB_CONFIG["backend"] = args.backend
+    sqlite_path = args.schema + ".sqlite3"
+    if args.backend == BACKEND_SQLITE:
+        DB_CONFIG["sqlite_path"] = sqlite_path
+    else:
+        run_on_server(f"CREATE DATABASE IF NOT EXISTS {args.schema}")
+        DB_CONFIG["database"] = args.schema
+    db = import_module("db_handler")
+    load_db = import_module("load_db").load_db
+
+    results = {
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": args.backend,
+        "server": db.backend.version(db.cur),
+        "calls": args.calls,
+        "seed": args.seed,
+        "datasets": {},
+    }
+
+    try:
+        for data_dir in args.datasets:
+            results["datasets"][data_dir] = bench_dataset(db, load_db, data_dir, args.calls, random.Random(args.seed))
+    finally:
+        db.close_connection()
+        if args.keep_schema:
+            pass
+        elif args.backend == BACKEND_SQLITE:
+            for path in [sqlite_path, sqlite_path + "-wal", sqlite_path + "-shm"]:
+                if os.path.exists(path):
+                    os.remove(path)
+        else:
+            run_on_server(f"DROP DATABASE IF EXISTS {args.schema}")
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"\nWrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+        regressions = compare(results, baseline, args.metric, args.threshold)
+        print(f"\nCompared {args.metric} against {args.baseline} with a {args.threshold:.0%} threshold: "
+              f"{len(regressions)} regression{'s' if len(regressions) != 1 else ''}")
+        for dataset, operation, old, new, ratio in regressions:
+            print(f"\t{dataset} {operation}: {old:.2f} ms -> {new:.2f} ms ({ratio:.2f}x)")
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,653 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import Counter, OrderedDict, namedtuple
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import starmap
+from threading import BoundedSemaphore, Lock
+from time import monotonic
 from MARIADB_CREDS import DB_CONFIG
-from mariadb import connect
+from backends import get_backend
 from models.LoanHistory import LoanHistory
 from models.Waitlist import Waitlist
 from models.Book import Book
 from models.Loan import Loan
+from models.OverdueLoan import OverdueLoan
 from models.User import User
 
 UFID = "58200371"
 FULLNAME = "Hernandez Martin, Fernando"
 
-conn = connect(user=DB_CONFIG["username"], password=DB_CONFIG["password"], host=DB_CONFIG["host"],
-               database=DB_CONFIG["database"], port=DB_CONFIG["port"])#, collation='utf8mb4_unicode_ci')
+# MariaDB unless DB_CONFIG["backend"] says otherwise, see backends.py
+backend = get_backend()
 
-cur = conn.cursor()
+
+class _LazyConnection:
+    """
+    Stands in for the module-level connection and only connects the first time it is used, so importing this module
+    (and starting the CLI) doesn't wait for a connection or fail when the database can't be reached. Committing,
+    rolling back or closing before then does nothing, since there is nothing to commit.
+    """
+    def __init__(self):
+        self._conn = None
+        self._lock = Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._conn is not None
+
+    def target(self):
+        """
+        returns the real connection, connecting first if this is the first use.
+        """
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    self._conn = backend.connect()
+        return self._conn
+
+    def commit(self):
+        if self._conn is not None:
+            self._conn.commit()
+
+    def rollback(self):
+        if self._conn is not None:
+            self._conn.rollback()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+
+    def __getattr__(self, name: str):
+        return getattr(self.target(), name)
+
+
+class _LazyCursor:
+    """
+    Stands in for the module-level cursor, opening it (and the connection) the first time it is used.
+    """
+    def __init__(self, connection: _LazyConnection):
+        self._connection = connection
+        self._cur = None
+
+    def target(self):
+        if self._cur is None:
+            self._cur = self._connection.target().cursor()
+        return self._cur
+
+    def close(self):
+        if self._cur is not None:
+            self._cur.close()
+
+    def __iter__(self):
+        return iter(self.target())
+
+    def __getattr__(self, name: str):
+        return getattr(self.target(), name)
+
+
+conn = _LazyConnection()
+
+cur = _LazyCursor(conn)
+
+
+def __getattr__(name: str):
+    # Looked up when first asked for, so importing this module doesn't import the database driver
+    if name == "Error":
+        return backend.Error
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+POOL_NAME = "cis4301"
+POOL_SIZE = DB_CONFIG.get("pool_size", 5)
+
+_pool = None
+_pool_slots = BoundedSemaphore(POOL_SIZE)
+_pool_lock = Lock()
+
+
+def _get_pool():
+    """
+    returns the shared connection pool, creating it the first time a Session is opened.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = backend.connection_pool(POOL_NAME, POOL_SIZE)
+    return _pool
+
+
+def _close_pool():
+    """
+    Closes the shared connection pool, if a Session ever opened it, so the next Session starts a new one.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+class Session:
+    """
+    A connection and cursor borrowed from the connection pool. Every function in this module takes an optional session,
+    and when one is given the function runs on the session's connection instead of the module-level conn/cur. This lets
+    several threads (e.g. one per circulation desk) use the module at the same time, as long as each has its own session.
+
+    Used as a context manager the session commits when the block finishes, rolls back if it raises, and always goes back
+    to the pool:
+
+        with Session() as session:
+            checkout_book(isbn, account_id, session=session)
+
+    If every pooled connection is in use, opening a session waits until one is returned.
+    """
+    def __init__(self):
+        _pool_slots.acquire()
+        try:
+            self.conn = _get_pool().get_connection()
+            self.cur = self.conn.cursor()
+            self.statements = {}
+            self.commit_policy = CommitPolicy()
+        except BaseException:
+            _pool_slots.release()
+            raise
+
+    def commit(self):
+        self.conn.commit()
+        self.commit_policy.reset()
+
+    def rollback(self):
+        self.conn.rollback()
+        self.commit_policy.reset()
+
+    def close(self):
+        """
+        Closes the cursor and hands the connection back to the pool.
+        """
+        if self.conn is None:
+            return
+
+        try:
+            _close_statements(self.statements)
+            self.cur.close()
+        finally:
+            self.conn.close()
+            self.conn = None
+            self.cur = None
+            _pool_slots.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+
+
+def _cursor(session: Session = None):
+    """
+    returns the cursor of the session if one is given, otherwise the module-level cursor.
+    """
+    return _instrument(cur.target() if session is None else session.cur)
+
+
+def _connection(session: Session = None):
+    """
+    returns the connection of the session if one is given, otherwise the module-level connection.
+    """
+    return conn.target() if session is None else session.conn
+
+
+# Per-query statistics, or None while instrumentation is off (the default)
+_query_stats = None
+
+
+def _instrument(cursor, operation: str = None):
+    """
+    returns cursor wrapped in an InstrumentedCursor if instrumentation is on, otherwise cursor itself.
+    """
+    if _query_stats is None:
+        return cursor
+
+    from instrumentation import InstrumentedCursor
+    return InstrumentedCursor(cursor, _query_stats, __name__, operation)
+
+
+def enable_instrumentation(slow_query_ms: float = None):
+    """
+    slow_query_ms - Statements that take at least this many milliseconds are logged to the "db_handler.slow_queries"
+        logger with their parameters. None to not log any.
+
+    Starts recording the operation, SQL, time, rows and bytes of every statement this module runs. The statistics
+    gathered so far are kept.
+    """
+    global _query_stats
+
+    if _query_stats is None:
+        from instrumentation import QueryStats
+        _query_stats = QueryStats(slow_query_ms)
+    else:
+        _query_stats.slow_query_ms = slow_query_ms
+
+
+def disable_instrumentation():
+    """
+    Stops recording statements and throws away the statistics.
+    """
+    global _query_stats
+    _query_stats = None
+
+
+def instrumentation_enabled() -> bool:
+    return _query_stats is not None
+
+
+def query_stats() -> list[dict]:
+    """
+    returns a dict for every (operation, SQL) pair run since instrumentation was enabled, with its count, total_ms,
+        mean_ms, max_ms, rows, bytes and a histogram of counts per instrumentation.BUCKET_BOUNDS_MS bucket, slowest
+        total time first. Empty if instrumentation is off.
+    """
+    return [] if _query_stats is None else _query_stats.snapshot()
+
+
+def export_query_stats(path: str):
+    """
+    Writes the query_stats() to path as JSON.
+    """
+    from instrumentation import QueryStats
+
+    with open(path, "w") as file:
+        file.write(QueryStats().to_json() if _query_stats is None else _query_stats.to_json())
+
+
+# The fixed statements behind the single-row lookups and the circulation writes. Each one gets its own prepared cursor
+# per connection (see _execute), so the server parses it once and later calls only send the parameters, in the binary
+# protocol.
+STATEMENTS = {
+    "checkout_book": """
+        INSERT INTO Loan (isbn, account_id, checkout_date, due_date)
+        VALUES (?, ?, CURRENT_DATE(), DATE_ADD(CURRENT_DATE(), INTERVAL 2 WEEK))
+    """,
+    "increment_checked_out": "UPDATE BookAvailability SET num_checked_out = num_checked_out + 1 WHERE isbn = ?",
+    "decrement_checked_out": "UPDATE BookAvailability SET num_checked_out = num_checked_out - ? WHERE isbn = ?",
+    "take_waitlist_ticket": """
+        INSERT INTO WaitlistHead (isbn, head, tail)
+        VALUES (?, 1, 1)
+        ON DUPLICATE KEY UPDATE tail = tail + 1
+    """,
+    "waitlist_head": "SELECT head, tail FROM WaitlistHead WHERE isbn = ?",
+    "add_waitlist_entry": "INSERT INTO WaitlistEntry (isbn, account_id, seq) VALUES (?, ?, ?)",
+    "advance_waitlist_head": "UPDATE WaitlistHead SET head = head + 1 WHERE isbn = ? AND head <= tail",
+    "remove_waitlist_head": """
+        DELETE FROM WaitlistEntry
+        WHERE isbn = ? AND seq = (SELECT head - 1 FROM WaitlistHead WHERE isbn = ?)
+    """,
+    "increment_waitlist_length": "UPDATE BookAvailability SET waitlist_length = waitlist_length + 1 WHERE isbn = ?",
+    "decrement_waitlist_length": "UPDATE BookAvailability SET waitlist_length = waitlist_length - 1 WHERE isbn = ?",
+    "archive_loan": """
+        INSERT INTO LoanHistory (isbn, account_id, checkout_date, due_date, return_date)
+        SELECT isbn, account_id, checkout_date, due_date, CURRENT_DATE()
+        FROM Loan
+        WHERE isbn = ? AND account_id = ?
+    """,
+    "delete_loan": "DELETE FROM Loan WHERE isbn = ? AND account_id = ?",
+    "grant_extension": """
+        UPDATE Loan
+        SET due_date = DATE_ADD(due_date, INTERVAL 2 WEEK)
+        WHERE isbn = ? AND account_id = ? AND due_date < DATE_ADD(checkout_date, INTERVAL 4 WEEK)
+    """,
+    "get_book": "SELECT isbn, title, author, publication_year, publisher, num_owned FROM Book WHERE isbn = ?",
+    "get_user": "SELECT account_id, name, address, phone_number, email FROM User WHERE account_id = ?",
+    # One row whatever matches, with NULLs for a book or user that doesn't exist
+    "get_book_and_user": """
+        SELECT b.isbn, b.title, b.author, b.publication_year, b.publisher, b.num_owned,
+               u.account_id, u.name, u.address, u.phone_number, u.email
+        FROM (SELECT 1 AS probe) AS p
+        LEFT JOIN Book b ON b.isbn = ?
+        LEFT JOIN User u ON u.account_id = ?
+    """,
+    "number_in_stock": "SELECT num_owned - num_checked_out FROM BookAvailability WHERE isbn = ?",
+    "place_in_line": "SELECT place_in_line FROM Waitlist WHERE isbn = ? AND account_id = ?",
+    "line_length": "SELECT waitlist_length FROM BookAvailability WHERE isbn = ?",
+}
+
+# Prepared cursors for the module-level connection, by statement name. Sessions keep their own in Session.statements,
+# since a pooled connection is reset (which drops its prepared statements) when it goes back to the pool.
+_statements = {}
+
+
+def _execute(name: str, params: list, session: Session = None):
+    """
+    Runs STATEMENTS[name] with params on the prepared cursor kept for that statement, preparing it the first time it is
+    used on the connection.
+
+    returns the cursor, for fetchone() or rowcount.
+    """
+    statements = _statements if session is None else session.statements
+
+    stmt_cur = statements.get(name)
+    if stmt_cur is None:
+        stmt_cur = statements[name] = _connection(session).cursor(prepared=True)
+
+    stmt_cur = _instrument(stmt_cur)
+    stmt_cur.execute(STATEMENTS[name], params)
+    return stmt_cur
+
+
+def _close_statements(statements: dict):
+    """
+    Closes and forgets every prepared cursor in statements.
+    """
+    for stmt_cur in statements.values():
+        stmt_cur.close()
+    statements.clear()
+
+
+# How commit_pending decides when to commit the writes made since the last commit
+COMMIT_PER_OPERATION = "per_operation"  # As soon as an operation that wrote something finishes
+COMMIT_GROUP = "group"  # Once group_size writes are pending or the oldest is group_interval_ms old
+COMMIT_EXPLICIT = "explicit"  # Only on save_changes, flush or close_connection
+# Whatever the mode, operations that lock rows (try_checkout, return_books, checkout_books) commit when they finish
+COMMIT_MODES = (COMMIT_PER_OPERATION, COMMIT_GROUP, COMMIT_EXPLICIT)
+
+
+class CommitPolicy:
+    """
+    Tracks how many writes a connection has made since its last commit and decides, based on mode, when
+    commit_pending should commit them. Read-only work never marks the connection dirty, so it never causes a commit.
+    Group commit trades durability for throughput: if the process dies, up to group_size writes (or
+    group_interval_ms worth) are lost. The interval is only checked when commit_pending is called, there is no
+    background timer.
+    """
+    def __init__(self, mode: str = COMMIT_PER_OPERATION, group_size: int = 100, group_interval_ms: float = 500):
+        if mode not in COMMIT_MODES:
+            raise ValueError(f"Unknown commit mode {mode}, expected one of {', '.join(COMMIT_MODES)}")
+
+        self.mode = mode
+        self.group_size = group_size
+        self.group_interval_ms = group_interval_ms
+        self.pending = 0
+        self._dirty_since = None
+
+    @property
+    def dirty(self) -> bool:
+        return self.pending > 0
+
+    def mark_dirty(self, count: int = 1):
+        if self.pending == 0:
+            self._dirty_since = monotonic()
+        self.pending += count
+
+    def due(self) -> bool:
+        """
+        returns whether the pending writes should be committed now.
+        """
+        if not self.dirty:
+            return False
+
+        if self.mode == COMMIT_PER_OPERATION:
+            return True
+
+        if self.mode == COMMIT_GROUP:
+            return (self.pending >= self.group_size
+                    or (monotonic() - self._dirty_since) * 1000 >= self.group_interval_ms)
+
+        return False
+
+    def reset(self):
+        self.pending = 0
+        self._dirty_since = None
+
+
+if DB_CONFIG.get("instrument"):
+    enable_instrumentation(DB_CONFIG.get("slow_query_ms"))
+
+# Commit policy of the module-level connection
+_commit_policy = CommitPolicy(DB_CONFIG.get("commit_mode", COMMIT_PER_OPERATION),
+                              DB_CONFIG.get("group_commit_size", 100),
+                              DB_CONFIG.get("group_commit_ms", 500))
+
+
+def _policy(session: Session = None) -> CommitPolicy:
+    """
+    returns the commit policy of the session if one is given, otherwise the module-level one.
+    """
+    return _commit_policy if session is None else session.commit_policy
+
+
+def _mark_dirty(session: Session = None, count: int = 1):
+    """
+    Records that count writes were made on the connection and haven't been committed yet.
+    """
+    _policy(session).mark_dirty(count)
+
+
+@contextmanager
+def _locking_operation(session: Session = None):
+    """
+    Runs an operation that takes row locks (try_checkout and the batch paths) in a transaction of its own, whatever
+    the commit policy is. Writes the policy is holding back from earlier operations are committed first, so if the
+    operation raises it can be rolled back without undoing them. If it finishes it is committed straight away, so its
+    locks are released before it returns instead of being held until a later group or explicit commit.
+    """
+    flush(session)
+
+    try:
+        yield
+    except BaseException:
+        _connection(session).rollback()
+        _policy(session).reset()
+        raise
+
+    _connection(session).commit()
+    _policy(session).reset()
+
+
+def set_commit_policy(mode: str = COMMIT_PER_OPERATION, group_size: int = 100, group_interval_ms: float = 500,
+                      session: Session = None):
+    """
+    mode - One of the COMMIT_* modes.
+    group_size - With COMMIT_GROUP, commit once this many writes are pending.
+    group_interval_ms - With COMMIT_GROUP, commit once the oldest pending write is this many milliseconds old.
+    session - An optional Session to set the policy of instead of the module-level connection.
+
+    Commits anything pending under the old policy, then switches to the new one.
+    """
+    new_policy = CommitPolicy(mode, group_size, group_interval_ms)
+    flush(session)
+
+    if session is None:
+        global _commit_policy
+        _commit_policy = new_policy
+    else:
+        session.commit_policy = new_policy
+
+
+def commit_pending(session: Session = None) -> bool:
+    """
+    session - An optional Session to commit instead of the module-level connection.
+
+    Commits the pending writes if the commit policy says they are due. Meant to be called whenever an operation
+    finishes, e.g. once per iteration of the main menu.
+
+    returns whether a commit was made.
+    """
+    policy = _policy(session)
+    if not policy.due():
+        return False
+
+    _connection(session).commit()
+    policy.reset()
+    return True
 
 
-def add_book(new_book: Book = None):
+def flush(session: Session = None) -> bool:
+    """
+    session - An optional Session to commit instead of the module-level connection.
+
+    Commits any pending writes whatever the commit policy is.
+
+    returns whether there was anything to commit.
+    """
+    policy = _policy(session)
+    if not policy.dirty:
+        return False
+
+    _connection(session).commit()
+    policy.reset()
+    return True
+
+
+class LookupCache:
+    """
+    A thread-safe LRU cache with a time to live, used to remember Book and User rows by their primary key so the desk
+    doesn't go back to the database every time it checks that a book or user exists. Misses (None) are cached too.
+    hits and misses count how many lookups were answered from the cache and how many went to the database.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, load: Callable):
+        """
+        returns the cached value for key, calling load(key) and caching the result if it is missing or has expired.
+        """
+        now = monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+
+        value = load(key)
+        self.put(key, value, now)
+        return value
+
+    def put(self, key, value, now: float = None):
+        """
+        Caches value for key, evicting the least recently used entries if the cache is full.
+        """
+        expires = (monotonic() if now is None else now) + self.ttl
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def peek(self, key) -> tuple[bool, object]:
+        """
+        returns (True, value) if key is cached and hasn't expired, otherwise (False, None) and the lookup counts as a
+            miss. Never loads anything, so the caller should put what it loads.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= monotonic():
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+CACHE_SIZE = DB_CONFIG.get("cache_size", 1024)
+CACHE_TTL = DB_CONFIG.get("cache_ttl", 60.0)
+
+_book_cache = LookupCache(CACHE_SIZE, CACHE_TTL)
+_user_cache = LookupCache(CACHE_SIZE, CACHE_TTL)
+
+
+def cache_stats() -> dict:
+    """
+    returns the size and hit/miss counters of the Book and User lookup caches, e.g.
+        {"book": {"size": 10, "hits": 25, "misses": 10}, "user": {...}}
+    """
+    return {"book": _book_cache.stats(), "user": _user_cache.stats()}
+
+
+def clear_cache():
+    """
+    Empties the Book and User lookup caches and resets their counters.
+    """
+    _book_cache.clear()
+    _user_cache.clear()
+
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+def _stream(query: str, params: list, make: Callable, chunk_size: int = DEFAULT_CHUNK_SIZE,
+            session: Session = None) -> Iterator:
+    """
+    returns a generator that runs query on its own unbuffered cursor and yields make(*row) for every row, fetching
+        chunk_size rows at a time. The cursor is closed once the rows run out or the generator is closed.
+    """
+    # The query only runs once the generator is first iterated, by which time the iter_filtered_* function that asked
+    # for it has returned, so the operation name has to be looked up now
+    if _query_stats is None:
+        operation = None
+    else:
+        from instrumentation import operation_name
+        operation = operation_name(__name__)
+    return _stream_rows(query, params, make, chunk_size, session, operation)
+
+
+def _stream_rows(query: str, params: list, make: Callable, chunk_size: int, session: Session,
+                 operation: str) -> Iterator:
+    stream_cur = _instrument(_connection(session).cursor(buffered=False), operation)
+
+    try:
+        stream_cur.execute(query, params)
+
+        rows = stream_cur.fetchmany(chunk_size)
+        while rows:
+            yield from starmap(make, rows)
+
+            rows = stream_cur.fetchmany(chunk_size)
+
+    finally:
+        stream_cur.close()
+
+
+def add_book(new_book: Book = None, session: Session = None):
     """
     new_book - A Book object containing a new book to be inserted into the DB in the Books table.
         new_book and its attributes will never be None.
+    session - An optional Session to run on instead of the module-level connection.
     """
+    cur = _cursor(session)
     query = """
         INSERT INTO Book (isbn, title, author, publication_year, publisher, num_owned)
         VALUES (?, ?, ?, ?, ?, ?)
@@ -33,13 +661,24 @@ def add_book(new_book: Book = None):
         new_book.num_owned,
     ]
     cur.execute(query, params)
+    cur.execute(
+        """
+        INSERT INTO BookAvailability (isbn, num_owned, num_checked_out, waitlist_length)
+        VALUES (?, ?, 0, 0)
+        """,
+        [new_book.isbn, new_book.num_owned],
+    )
+    _mark_dirty(session)
+    _book_cache.invalidate(new_book.isbn)
 
 
-def add_user(new_user: User = None):
+def add_user(new_user: User = None, session: Session = None):
     """
     new_user - A User object containing a new user to be inserted into the DB in the Users table.
         new_user and its attributes will never be None.
+    session - An optional Session to run on instead of the module-level connection.
     """
+    cur = _cursor(session)
     query = """
         INSERT INTO User (account_id, name, address, phone_number, email)
         VALUES (?, ?, ?, ?, ?)
@@ -52,13 +691,17 @@ def add_user(new_user: User = None):
         new_user.email,
     ]
     cur.execute(query, params)
+    _mark_dirty(session)
+    _user_cache.invalidate(new_user.account_id)
 
 
-def edit_user(original_account_id: str = None, new_user: User = None):
+def edit_user(original_account_id: str = None, new_user: User = None, session: Session = None):
     """
     original_account_id - A string containing the account id for the user to be edited.
     new_user - A User object containing attributes to update for a user in the database.
+    session - An optional Session to run on instead of the module-level connection.
     """
+    cur = _cursor(session)
     set_clauses = []
     params = []
 
@@ -93,127 +736,228 @@ def edit_user(original_account_id: str = None, new_user: User = None):
     params.append(original_account_id)
 
     cur.execute(query, params)
+    _mark_dirty(session)
+
+    # The user may have been renamed, so both the old and the new account id are stale
+    _user_cache.invalidate(original_account_id)
+    if new_user.account_id is not None:
+        _user_cache.invalidate(new_user.account_id)
 
 
-def checkout_book(isbn: str = None, account_id: str = None):
+def checkout_book(isbn: str = None, account_id: str = None, session: Session = None):
     """
     isbn - A string containing the ISBN for the book being checked out. isbn will never be None.
     account_id - A string containing the account id of the user checking out a book. account_id will never be None.
+    session - An optional Session to run on instead of the module-level connection.
     """
     # checkout_date = curr
     # due_date = curr + 14
-    query = """
-        INSERT INTO Loan (isbn, account_id, checkout_date, due_date)
-        VALUES (?, ?, CURRENT_DATE(), DATE_ADD(CURRENT_DATE(), INTERVAL 2 WEEK))
-    """
-    cur.execute(query, [isbn, account_id])
+    _execute("checkout_book", [isbn, account_id], session)
+    _execute("increment_checked_out", [isbn], session)
+    _mark_dirty(session)
 
 
-def waitlist_user(isbn: str = None, account_id: str = None) -> int:
+def waitlist_user(isbn: str = None, account_id: str = None, session: Session = None) -> int:
     """
     isbn - A string containing the ISBN for the book that a user desires to be waitlisted for. isbn will never be None.
     account_id - A string containing the account id for the user that wants to be waitlisted. account_id will never be None.
+    session - An optional Session to run on instead of the module-level connection.
 
     returns an integer that is the user's place in line to check out the book.
     """
-    # curr max place_in_line for isbn
-    cur.execute(
-        "SELECT COALESCE(MAX(place_in_line), 0) FROM Waitlist WHERE isbn = ?",
-        [isbn],
-    )
-    (current_max,) = cur.fetchone()
-    new_place = current_max + 1
-    cur.execute(
-        """
-        INSERT INTO Waitlist (isbn, account_id, place_in_line)
-        VALUES (?, ?, ?)
-        """,
-        [isbn, account_id, new_place],
-    )
-    return new_place
+    # Take the next ticket for the isbn. The upsert locks the WaitlistHead row until the transaction ends, so two users
+    # can't get the same ticket
+    _execute("take_waitlist_ticket", [isbn], session)
+    head, tail = _execute("waitlist_head", [isbn], session).fetchone()
+    _execute("add_waitlist_entry", [isbn, account_id, tail], session)
+    _execute("increment_waitlist_length", [isbn], session)
+    _mark_dirty(session)
+    return tail - head + 1
 
 
-def update_waitlist(isbn: str = None):
+def update_waitlist(isbn: str = None, session: Session = None):
     """
     isbn - A string containing the ISBN for a book on the waitlist. isbn will never be None.
+    session - An optional Session to run on instead of the module-level connection.
+
+    Removes whoever is first in line. Since places in line are worked out from the head of the queue, nobody else's row
+    has to change.
     """
-    cur.execute(
-        "DELETE FROM Waitlist WHERE isbn = ? AND place_in_line = 1",
-        [isbn],
-    )
-    cur.execute(
-        """
-        UPDATE Waitlist
-        SET place_in_line = place_in_line - 1
-        WHERE isbn = ? AND place_in_line > 1
-        """,
-        [isbn],
-    )
+    if _execute("advance_waitlist_head", [isbn], session).rowcount == 0:  # Nobody is waiting
+        return
+
+    _execute("remove_waitlist_head", [isbn, isbn], session)
+    _execute("decrement_waitlist_length", [isbn], session)
+    _mark_dirty(session)
 
 
-def return_book(isbn: str = None, account_id: str = None):
+def return_book(isbn: str = None, account_id: str = None, session: Session = None):
     """
     isbn - A string containing the ISBN for the book that the user desires to return. isbn will never be None
     account_id - A string containing the account id for the user that wants to return the book. account_id will never be None
+    session - An optional Session to run on instead of the module-level connection.
     """
-    cur.execute(
-        """
-        INSERT INTO LoanHistory (isbn, account_id, checkout_date, due_date, return_date)
-        SELECT isbn, account_id, checkout_date, due_date, CURRENT_DATE()
-        FROM Loan
-        WHERE isbn = ? AND account_id = ?
-        """,
-        [isbn, account_id],
-    )
+    _execute("archive_loan", [isbn, account_id], session)
     # Delete loan entry bc the book is returned
-    cur.execute(
-        "DELETE FROM Loan WHERE isbn = ? AND account_id = ?",
-        [isbn, account_id],
-    )
+    num_returned = _execute("delete_loan", [isbn, account_id], session).rowcount
+    if num_returned > 0:
+        _execute("decrement_checked_out", [num_returned, isbn], session)
+        _mark_dirty(session)
+
 
+# Outcomes returned by grant_extension
+EXTENSION_GRANTED = "extended"
+EXTENSION_ALREADY_EXTENDED = "already_extended"  # A loan can only be extended once, to four weeks in total
+EXTENSION_NOT_LOANED = "not_loaned"  # The user doesn't have the book checked out
 
 
-def grant_extension(isbn: str = None, account_id: str = None):
+def grant_extension(isbn: str = None, account_id: str = None, session: Session = None) -> str:
     """
     isbn - A string containing the ISBN for a book. isbn will never be None.
     account_id - A string containing the account id for a user. account_id will never be None.
+    session - An optional Session to run on instead of the module-level connection.
+
+    Moves the loan's due date back two weeks, unless it has already been extended.
+
+    returns one of the EXTENSION_* constants.
     """
-    cur.execute(
-        """
-        UPDATE Loan
-        SET due_date = DATE_ADD(due_date, INTERVAL 2 WEEK)
-        WHERE isbn = ? AND account_id = ?
-        """,
-        [isbn, account_id],
-    )
+    if _execute("grant_extension", [isbn, account_id], session).rowcount > 0:
+        _mark_dirty(session)
+        return EXTENSION_GRANTED
 
+    if loan_exists(isbn=isbn, account_id=account_id, session=session):
+        return EXTENSION_ALREADY_EXTENDED
+    return EXTENSION_NOT_LOANED
 
-def get_filtered_books(filter_attributes: Book = None,
-                       use_patterns: bool = False,
-                       min_publication_year: int = -1,
-                       max_publication_year: int = -1) -> list[Book]:
+
+# Primary keys and selectable columns used for keyset pagination of the get_filtered_* functions
+BOOK_KEY = ("isbn",)
+BOOK_COLUMNS = ("isbn", "title", "author", "publication_year", "publisher", "num_owned")
+USER_KEY = ("account_id",)
+USER_COLUMNS = ("account_id", "name", "address", "phone_number", "email")
+LOAN_HISTORY_KEY = ("isbn", "account_id", "checkout_date")
+LOAN_HISTORY_COLUMNS = ("isbn", "account_id", "checkout_date", "due_date", "return_date")
+
+_PAGE_KEYS = {
+    Book: BOOK_KEY,
+    User: USER_KEY,
+    LoanHistory: LOAN_HISTORY_KEY,
+}
+
+
+def _sort_columns(key_columns: tuple, order_by: str = None) -> list[str]:
     """
-    filter_attributes - A Book object containing attributes to filter books in the database. If an attribute is None,
-        then it should not be considered for the search. e.g. if filter_attributes.title = "1984" then all books returned
-        should have their title == "1984". If filter_attributes.author = None, then we do not care what the author is when
-        filtering. It is important to note that filter_attributes.publication_year will always be -1 since we have
-        separate parameters to handle publication_year. It is also worth noting that since num_owned is an integer, it
-        can't be None, so it will default to -1 instead when not used. Additionally, many attributes may be used as a
-        filter simultaneously. filter_attributes will never be None, but any attribute not being used as a filter will be None.
-        It is also possible all the attributes in filter_attributes to be None, if that is the case then all rows should be returned.
-    use_patterns - If True, then the string attributes in filter_attributes may contain string patterns rather than typical
-        string literals, so the filtering should handle this accordingly. e.g. if filter_attributes.title = "The Great%" and
-        use_patterns = True, then all Books returned should have their title start with "The Great%". If use_patterns = False,
-        then all books returned should have their title == "The Great%".
-    min_publication_year - The minimum publication year to filter books by, inclusively. e.g. if min_publication_year = 2000,
-        then all books should be published between 2000 and the current year, including 2000 and the current year. If
-        min_publication_year is not used, it will be -1.
-    max_publication_year - The maximum publication year to filter books by, inclusively. e.g. if max_publication_year = 1999,
-        then all books should be published before the year 2000, not including 2000. If max_publication_year is not used,
-        it will be -1.
+    returns the columns to sort by: order_by followed by the primary key columns to break ties.
+    """
+    if order_by is None:
+        return list(key_columns)
 
-    returns a list of Book objects with books that meet the qualifications of the filtered attributes. If no books meet the
-        requirements, then an empty list is returned.
+    return [order_by] + [column for column in key_columns if column != order_by]
+
+
+@lru_cache(maxsize=256)
+def _keyset_condition(columns: tuple, nulls: tuple) -> str:
+    """
+    columns - The columns the rows are ordered by, ascending.
+    nulls - For each column, whether the value to page after is NULL.
+
+    returns a condition that is true for rows sorting strictly after the values when ordered by columns ascending. NULLs
+        sort first, like they do in an ascending ORDER BY. _keyset_params gives the matching parameters.
+    """
+    column, is_null = columns[0], nulls[0]
+
+    if is_null:
+        after_condition, equal_condition = f"{column} IS NOT NULL", f"{column} IS NULL"
+    else:
+        after_condition, equal_condition = f"{column} > ?", f"{column} = ?"
+
+    if len(columns) == 1:
+        return after_condition
+
+    rest_condition = _keyset_condition(columns[1:], nulls[1:])
+    return f"({after_condition} OR ({equal_condition} AND {rest_condition}))"
+
+
+def _keyset_params(values: list) -> list:
+    """
+    returns the parameters for the _keyset_condition of values, in placeholder order.
+    """
+    params = []
+    for value in values[:-1]:
+        if value is not None:
+            params += [value, value]
+
+    if values[-1] is not None:
+        params.append(values[-1])
+
+    return params
+
+
+def _compose_query(query: str, conditions: list, order_columns: tuple = (), limited: bool = False) -> str:
+    """
+    returns query with the WHERE clause for conditions and, when given, the ORDER BY and LIMIT added.
+    """
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    if order_columns:
+        query += " ORDER BY " + ", ".join(order_columns)
+
+    if limited:
+        query += " LIMIT ?"
+
+    return query
+
+
+def _paginate(query: str, conditions: list, params: list, key_columns: tuple, columns: tuple, order_by: str = None,
+              after: str = None, limit: int = -1) -> tuple[str, list]:
+    """
+    Finishes a get_filtered_* query by adding the WHERE clause and, when paging, the keyset condition for after, the
+    ORDER BY and the LIMIT.
+
+    returns the query and its parameters.
+    """
+    paging = order_by is not None or after is not None or limit != -1
+
+    if order_by is not None and order_by not in columns:
+        raise ValueError(f"Can't order by {order_by}, expected one of {', '.join(columns)}")
+
+    sort_columns = tuple(_sort_columns(key_columns, order_by))
+
+    if after is not None:
+        after_values = json.loads(urlsafe_b64decode(after.encode()))
+        if len(after_values) != len(sort_columns):
+            raise ValueError("The page cursor doesn't match order_by")
+
+        nulls = tuple(value is None for value in after_values)
+        conditions = conditions + [_keyset_condition(sort_columns, nulls)]
+        params = params + _keyset_params(after_values)
+
+    if limit != -1:
+        params = params + [limit]
+
+    query = _compose_query(query, conditions, sort_columns if paging else (), limit != -1)
+    return query, params
+
+
+def page_cursor(last_item, order_by: str = None) -> str:
+    """
+    last_item - The last Book, User or LoanHistory of a page returned by the matching get_filtered_* function.
+    order_by - The same order_by that was used to get the page.
+
+    returns an opaque cursor to pass as after to get the next page.
+    """
+    sort_columns = _sort_columns(_PAGE_KEYS[type(last_item)], order_by)
+    values = [getattr(last_item, column) for column in sort_columns]
+
+    return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def _books_query(filter_attributes: Book, use_patterns: bool, min_publication_year: int,
+                 max_publication_year: int, order_by: str = None, after: str = None,
+                 limit: int = -1) -> tuple[str, list]:
+    """
+    returns the query and parameters for get_filtered_books and iter_filtered_books.
     """
     #qury definition
     query = """
@@ -266,43 +1010,206 @@ def get_filtered_books(filter_attributes: Book = None,
         conditions.append("publication_year <= ?")
         params.append(max_publication_year)
 
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
+    return _paginate(query, conditions, params, BOOK_KEY, BOOK_COLUMNS, order_by, after, limit)
+
 
+def get_filtered_books(filter_attributes: Book = None,
+                       use_patterns: bool = False,
+                       min_publication_year: int = -1,
+                       max_publication_year: int = -1,
+                       limit: int = -1,
+                       order_by: str = None,
+                       after: str = None,
+                       session: Session = None) -> list[Book]:
+    """
+    filter_attributes - A Book object containing attributes to filter books in the database. If an attribute is None,
+        then it should not be considered for the search. e.g. if filter_attributes.title = "1984" then all books returned
+        should have their title == "1984". If filter_attributes.author = None, then we do not care what the author is when
+        filtering. It is important to note that filter_attributes.publication_year will always be -1 since we have
+        separate parameters to handle publication_year. It is also worth noting that since num_owned is an integer, it
+        can't be None, so it will default to -1 instead when not used. Additionally, many attributes may be used as a
+        filter simultaneously. filter_attributes will never be None, but any attribute not being used as a filter will be None.
+        It is also possible all the attributes in filter_attributes to be None, if that is the case then all rows should be returned.
+    use_patterns - If True, then the string attributes in filter_attributes may contain string patterns rather than typical
+        string literals, so the filtering should handle this accordingly. e.g. if filter_attributes.title = "The Great%" and
+        use_patterns = True, then all Books returned should have their title start with "The Great%". If use_patterns = False,
+        then all books returned should have their title == "The Great%".
+    min_publication_year - The minimum publication year to filter books by, inclusively. e.g. if min_publication_year = 2000,
+        then all books should be published between 2000 and the current year, including 2000 and the current year. If
+        min_publication_year is not used, it will be -1.
+    max_publication_year - The maximum publication year to filter books by, inclusively. e.g. if max_publication_year = 1999,
+        then all books should be published before the year 2000, not including 2000. If max_publication_year is not used,
+        it will be -1.
+    limit - The most rows to return, or -1 for no limit. When used, rows come back in order_by order.
+    order_by - The column to sort by. Ties (and the whole order when order_by is None) are broken by the primary key
+        (isbn), so the order is always total.
+    after - An opaque cursor from page_cursor() for the last row of the previous page. Only rows that sort after it are
+        returned, so fetching a deep page costs the same as fetching the first.
+    session - An optional Session to run on instead of the module-level connection.
+
+    returns a list of Book objects with books that meet the qualifications of the filtered attributes. If no books meet the
+        requirements, then an empty list is returned.
+    """
+    cur = _cursor(session)
+    query, params = _books_query(filter_attributes, use_patterns, min_publication_year, max_publication_year,
+                                 order_by, after, limit)
     cur.execute(query, params)
-    rows = cur.fetchall()
-
-    books: list[Book] = []
-    for isbn, title, author, pub_year, publisher, num_owned in rows:
-        books.append(
-            Book(
-                isbn=isbn,
-                title=title,
-                author=author,
-                publication_year=pub_year,
-                publisher=publisher,
-                num_owned=num_owned,
-            )
-        )
 
-    return books
+    return [Book(*row) for row in cur.fetchall()]
 
 
-def get_filtered_users(filter_attributes: User = None, use_patterns: bool = False) -> list[User]:
+def iter_filtered_books(filter_attributes: Book = None,
+                        use_patterns: bool = False,
+                        min_publication_year: int = -1,
+                        max_publication_year: int = -1,
+                        chunk_size: int = DEFAULT_CHUNK_SIZE,
+                        session: Session = None) -> Iterator[Book]:
     """
-    filter_attributes - A User object containing attributes to filter users in the database. If an attribute is None,
-        then it should not be considered for the search. e.g. if filter_attributes.name = "John" then all users returned
-        should have their name == "John". If filter_attributes.address = None, then we do not care what the address is when
-        filtering. Additionally, many attributes may be used as a filter simultaneously. filter_attributes will never be
-        None, but any attribute not being used as a filter will be None. It is also possible all the attributes in
-        filter_attributes to be None, if that is the case then all rows should be returned.
-    use_patterns - If True, then the string attributes in filter_attributes may contain string patterns rather than typical
-        string literals, so the search should handle this accordingly. e.g. if filter_attributes.name = "John%" and
-        use_patterns = True, then all Users returned should have their name start with "John". If use_patterns = False, then
-        all users returned should have their name == "John%".
+    Takes the same filters as get_filtered_books, but yields the matching books one at a time instead of building a
+    list, reading them from an unbuffered cursor chunk_size rows at a time so memory use doesn't grow with the size
+    of the table.
+    session - An optional Session to run on instead of the module-level connection. No other query can be run on the
+        connection until the generator is exhausted or closed.
+    """
+    query, params = _books_query(filter_attributes, use_patterns, min_publication_year, max_publication_year)
+    return _stream(query, params, Book, chunk_size=chunk_size, session=session)
 
-    returns a list of User objects with users who meet the qualifications of the filters. If no users meet the requirements,
-     then an empty list is returned.
+
+def _load_book(isbn: str, session: Session = None) -> Book:
+    """
+    returns the Book with the given ISBN from the database, or None if there isn't one.
+    """
+    row = _execute("get_book", [isbn], session).fetchone()
+    return Book(*row) if row else None
+
+
+def _load_user(account_id: str, session: Session = None) -> User:
+    """
+    returns the User with the given account id from the database, or None if there isn't one.
+    """
+    row = _execute("get_user", [account_id], session).fetchone()
+    return User(*row) if row else None
+
+
+def get_book(isbn: str = None, session: Session = None) -> Book:
+    """
+    isbn - A string containing the ISBN for a book. isbn will never be None.
+    session - An optional Session to run on instead of the module-level connection.
+
+    returns the Book with the given ISBN, or None if there isn't one. Lookups go through the Book cache.
+    """
+    return _book_cache.get(isbn, lambda key: _load_book(key, session))
+
+
+def get_user(account_id: str = None, session: Session = None) -> User:
+    """
+    account_id - A string containing the account id for a user. account_id will never be None.
+    session - An optional Session to run on instead of the module-level connection.
+
+    returns the User with the given account id, or None if there isn't one. Lookups go through the User cache.
+    """
+    return _user_cache.get(account_id, lambda key: _load_user(key, session))
+
+
+def book_exists(isbn: str = None, session: Session = None) -> bool:
+    """
+    isbn - A string containing the ISBN for a book. isbn will never be None.
+    session - An optional Session to run on instead of the module-level connection.
+
+    returns True if the library has a book with the given ISBN. Goes through the Book cache like get_book, so the row
+        is cached for the next check.
+    """
+    return get_book(isbn, session=session) is not None
+
+
+def user_exists(account_id: str = None, session: Session = None) -> bool:
+    """
+    account_id - A string containing the account id for a user. account_id will never be None.
+    session - An optional Session to run on instead of the module-level connection.
+
+    returns True if there is a user with the given account id. Goes through the User cache like get_user, so the row
+        is cached for the next check.
+    """
+    return get_user(account_id, session=session) is not None
+
+
+def book_and_user_exist(isbn: str = None, account_id: str = None, session: Session = None) -> tuple[bool, bool]:
+    """
+    isbn - A string containing the ISBN for a book. isbn will never be None.
+    account_id - A string containing the account id for a user. account_id will never be None.
+    session - An optional Session to run on instead of the module-level connection.
+
+    returns a tuple of (book_exists, user_exists). Whichever isn't in its cache is loaded and cached, both with a single
+        query if neither is.
+    """
+    book_cached, book = _book_cache.peek(isbn)
+    user_cached, user = _user_cache.peek(account_id)
+
+    if not book_cached and not user_cached:
+        row = _execute("get_book_and_user", [isbn, account_id], session).fetchone()
+        book = Book(*row[:len(BOOK_COLUMNS)]) if row[0] is not None else None
+        user = User(*row[len(BOOK_COLUMNS):]) if row[len(BOOK_COLUMNS)] is not None else None
+
+    elif not book_cached:
+        book = _load_book(isbn, session)
+
+    elif not user_cached:
+        user = _load_user(account_id, session)
+
+    if not book_cached:
+        _book_cache.put(isbn, book)
+    if not user_cached:
+        _user_cache.put(account_id, user)
+
+    return book is not None, user is not None
+
+
+def loan_exists(isbn: str = None, account_id: str = None, session: Session = None) -> bool:
+    """
+    isbn - A string containing the ISBN for a book. isbn will never be None.
+    account_id - A string containing the account id for a user. account_id will never be None.
+    session - An optional Session to run on instead of the module-level connection.
+
+    returns True if the user currently has the book checked out.
+    """
+    cur = _cursor(session)
+    cur.execute("SELECT EXISTS(SELECT 1 FROM Loan WHERE isbn = ? AND account_id = ?)", [isbn, account_id])
+    (exists,) = cur.fetchone()
+    return bool(exists)
+
+
+def search_books_fulltext(query: str = None, limit: int = 20, session: Session = None) -> list[Book]:
+    """
+    query - Keywords to look for in the title, author and publisher of the books, e.g. "garfield davis".
+    limit - The most books to return.
+    session - An optional Session to run on instead of the module-level connection.
+
+    returns a list of up to limit Book objects matching the keywords, most relevant first. Uses the book_fulltext index
+        created by the migrations, so unlike a LIKE '%...%' search it doesn't scan the whole table.
+    """
+    cur = _cursor(session)
+    cur.execute(*_search_books_fulltext_query(query, limit))
+
+    return [Book(*row) for row in cur.fetchall()]
+
+
+def _search_books_fulltext_query(query: str, limit: int) -> tuple[str, list]:
+    """
+    returns the query and parameters for search_books_fulltext.
+    """
+    return """
+        SELECT isbn, title, author, publication_year, publisher, num_owned
+        FROM Book
+        WHERE MATCH(title, author, publisher) AGAINST (? IN NATURAL LANGUAGE MODE)
+        ORDER BY MATCH(title, author, publisher) AGAINST (? IN NATURAL LANGUAGE MODE) DESC
+        LIMIT ?
+    """, [query, query, limit]
+
+
+def _users_query(filter_attributes: User, use_patterns: bool, order_by: str = None, after: str = None,
+                 limit: int = -1) -> tuple[str, list]:
+    """
+    returns the query and parameters for get_filtered_users and iter_filtered_users.
     """
     # query definition
     query = """
@@ -347,31 +1254,107 @@ def get_filtered_users(filter_attributes: User = None, use_patterns: bool = Fals
             conditions.append("email = ?")
         params.append(filter_attributes.email)
 
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
+    return _paginate(query, conditions, params, USER_KEY, USER_COLUMNS, order_by, after, limit)
+
 
+def get_filtered_users(filter_attributes: User = None, use_patterns: bool = False, limit: int = -1, order_by: str = None,
+                       after: str = None, session: Session = None) -> list[User]:
+    """
+    filter_attributes - A User object containing attributes to filter users in the database. If an attribute is None,
+        then it should not be considered for the search. e.g. if filter_attributes.name = "John" then all users returned
+        should have their name == "John". If filter_attributes.address = None, then we do not care what the address is when
+        filtering. Additionally, many attributes may be used as a filter simultaneously. filter_attributes will never be
+        None, but any attribute not being used as a filter will be None. It is also possible all the attributes in
+        filter_attributes to be None, if that is the case then all rows should be returned.
+    use_patterns - If True, then the string attributes in filter_attributes may contain string patterns rather than typical
+        string literals, so the search should handle this accordingly. e.g. if filter_attributes.name = "John%" and
+        use_patterns = True, then all Users returned should have their name start with "John". If use_patterns = False, then
+        all users returned should have their name == "John%".
+    limit - The most rows to return, or -1 for no limit. When used, rows come back in order_by order.
+    order_by - The column to sort by. Ties (and the whole order when order_by is None) are broken by the primary key
+        (account_id), so the order is always total.
+    after - An opaque cursor from page_cursor() for the last row of the previous page. Only rows that sort after it are
+        returned, so fetching a deep page costs the same as fetching the first.
+    session - An optional Session to run on instead of the module-level connection.
+
+    returns a list of User objects with users who meet the qualifications of the filters. If no users meet the requirements,
+     then an empty list is returned.
+    """
+    cur = _cursor(session)
+    query, params = _users_query(filter_attributes, use_patterns, order_by, after, limit)
     cur.execute(query, params)
-    rows = cur.fetchall()
-
-    users: list[User] = []
-    for account_id, name, address, phone_number, email in rows:
-        users.append(
-            User(
-                account_id=account_id,
-                name=name,
-                address=address,
-                phone_number=phone_number,
-                email=email,
-            )
-        )
 
-    return users
+    return [User(*row) for row in cur.fetchall()]
+
+
+def iter_filtered_users(filter_attributes: User = None, use_patterns: bool = False,
+                        chunk_size: int = DEFAULT_CHUNK_SIZE, session: Session = None) -> Iterator[User]:
+    """
+    Takes the same filters as get_filtered_users, but yields the matching users one at a time instead of building a
+    list, reading them from an unbuffered cursor chunk_size rows at a time so memory use doesn't grow with the size
+    of the table.
+    session - An optional Session to run on instead of the module-level connection. No other query can be run on the
+        connection until the generator is exhausted or closed.
+    """
+    query, params = _users_query(filter_attributes, use_patterns)
+    return _stream(query, params, User, chunk_size=chunk_size, session=session)
+
+
+def _loans_query(filter_attributes: Loan, min_checkout_date: str, max_checkout_date: str, min_due_date: str,
+                 max_due_date: str) -> tuple[str, list]:
+    """
+    returns the query and parameters for get_filtered_loans and iter_filtered_loans.
+    """
+    #define query
+    query = """
+        SELECT isbn, account_id, checkout_date, due_date
+        FROM Loan
+    """
+    conditions = []
+    params = []
+
+    if filter_attributes.isbn is not None:
+        conditions.append("isbn = ?")
+        params.append(filter_attributes.isbn)
+
+    if filter_attributes.account_id is not None:
+        conditions.append("account_id = ?")
+        params.append(filter_attributes.account_id)
+
+    if getattr(filter_attributes, "checkout_date", None) is not None:
+        conditions.append("checkout_date = ?")
+        params.append(filter_attributes.checkout_date)
+
+    if getattr(filter_attributes, "due_date", None) is not None:
+        conditions.append("due_date = ?")
+        params.append(filter_attributes.due_date)
+
+    # Date ranges
+    if min_checkout_date is not None:
+        conditions.append("checkout_date >= ?")
+        params.append(min_checkout_date)
+
+    if max_checkout_date is not None:
+        conditions.append("checkout_date <= ?")
+        params.append(max_checkout_date)
+
+    if min_due_date is not None:
+        conditions.append("due_date >= ?")
+        params.append(min_due_date)
+
+    if max_due_date is not None:
+        conditions.append("due_date <= ?")
+        params.append(max_due_date)
+
+    return _compose_query(query, conditions), params
+
 
 def get_filtered_loans(filter_attributes: Loan = None,
                        min_checkout_date: str = None,
                        max_checkout_date: str = None,
                        min_due_date: str = None,
-                       max_due_date: str = None, ) -> list[Loan]:
+                       max_due_date: str = None,
+                       session: Session = None) -> list[Loan]:
     """
     filter_attributes - A Loan object containing attributes to filter loan in the database. If an attribute is None,
         then it should not be considered for the search. e.g. if filter_attributes.isbn = "123456789" then all loans returned
@@ -387,14 +1370,47 @@ def get_filtered_loans(filter_attributes: Loan = None,
         "2025-01-03". If max_checkout_date is not used, it will be None
     min_due_date - like min_checkout_date but with the due date instead. If min_due_date is not used, it will be None.
     max_due_date - like max_checkout_date but with the due date instead. If max_due_date is not used, it will be None.
+    session - An optional Session to run on instead of the module-level connection.
+
+    returns a list of Loan objects with loans that meet the qualifications of the filters. If no loans meet the
+    requirements, then an empty list is returned.
+    """
+    cur = _cursor(session)
+    query, params = _loans_query(filter_attributes, min_checkout_date, max_checkout_date, min_due_date, max_due_date)
+    cur.execute(query, params)
+
+    return [Loan.from_row(*row) for row in cur.fetchall()]
+
+
+def iter_filtered_loans(filter_attributes: Loan = None,
+                        min_checkout_date: str = None,
+                        max_checkout_date: str = None,
+                        min_due_date: str = None,
+                        max_due_date: str = None,
+                        chunk_size: int = DEFAULT_CHUNK_SIZE,
+                        session: Session = None) -> Iterator[Loan]:
+    """
+    Takes the same filters as get_filtered_loans, but yields the matching loans one at a time instead of building a
+    list, reading them from an unbuffered cursor chunk_size rows at a time so memory use doesn't grow with the size
+    of the table.
+    session - An optional Session to run on instead of the module-level connection. No other query can be run on the
+        connection until the generator is exhausted or closed.
+    """
+    query, params = _loans_query(filter_attributes, min_checkout_date, max_checkout_date, min_due_date, max_due_date)
+    return _stream(query, params, Loan.from_row, chunk_size=chunk_size, session=session)
 
-    returns a list of Loan objects with loans that meet the qualifications of the filters. If no loans meet the
-    requirements, then an empty list is returned.
+
+def _loan_histories_query(filter_attributes: LoanHistory, min_checkout_date: str, max_checkout_date: str,
+                          min_due_date: str, max_due_date: str, min_return_date: str,
+                          max_return_date: str, order_by: str = None, after: str = None,
+                          limit: int = -1) -> tuple[str, list]:
     """
-    #define query
+    returns the query and parameters for get_filtered_loan_histories and iter_filtered_loan_histories.
+    """
+    # query def
     query = """
-        SELECT isbn, account_id, checkout_date, due_date
-        FROM Loan
+        SELECT isbn, account_id, checkout_date, due_date, return_date
+        FROM LoanHistory
     """
     conditions = []
     params = []
@@ -415,6 +1431,10 @@ def get_filtered_loans(filter_attributes: Loan = None,
         conditions.append("due_date = ?")
         params.append(filter_attributes.due_date)
 
+    if getattr(filter_attributes, "return_date", None) is not None:
+        conditions.append("return_date = ?")
+        params.append(filter_attributes.return_date)
+
     # Date ranges
     if min_checkout_date is not None:
         conditions.append("checkout_date >= ?")
@@ -432,24 +1452,15 @@ def get_filtered_loans(filter_attributes: Loan = None,
         conditions.append("due_date <= ?")
         params.append(max_due_date)
 
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
+    if min_return_date is not None:
+        conditions.append("return_date >= ?")
+        params.append(min_return_date)
 
-    cur.execute(query, params)
-    rows = cur.fetchall()
-
-    loans: list[Loan] = []
-    for isbn, account_id, checkout_date, due_date in rows:
-        loans.append(
-            Loan(
-                isbn=isbn,
-                account_id=account_id,
-                checkout_date=checkout_date.isoformat() if checkout_date else None,
-                due_date=due_date.isoformat() if due_date else None,
-            )
-        )
+    if max_return_date is not None:
+        conditions.append("return_date <= ?")
+        params.append(max_return_date)
 
-    return loans
+    return _paginate(query, conditions, params, LOAN_HISTORY_KEY, LOAN_HISTORY_COLUMNS, order_by, after, limit)
 
 
 def get_filtered_loan_histories(filter_attributes: LoanHistory = None,
@@ -458,7 +1469,11 @@ def get_filtered_loan_histories(filter_attributes: LoanHistory = None,
                                 min_due_date: str = None,
                                 max_due_date: str = None,
                                 min_return_date: str = None,
-                                max_return_date: str = None) -> list[LoanHistory]:
+                                max_return_date: str = None,
+                                limit: int = -1,
+                                order_by: str = None,
+                                after: str = None,
+                                session: Session = None) -> list[LoanHistory]:
     """
     filter_attributes - A LoanHistory object containing attributes to filter loan histories in the database. If an attribute is None,
         then it should not be considered for the search. e.g. if filter_attributes.isbn = "123456789" then all rows returned
@@ -478,104 +1493,144 @@ def get_filtered_loan_histories(filter_attributes: LoanHistory = None,
         None.
     max_return_date - like max_checkout_date but with the return date instead. If max_return_date is not used, it will be
         None.
+    limit - The most rows to return, or -1 for no limit. When used, rows come back in order_by order.
+    order_by - The column to sort by. Ties (and the whole order when order_by is None) are broken by the primary key
+        (isbn, account_id, checkout_date), so the order is always total.
+    after - An opaque cursor from page_cursor() for the last row of the previous page. Only rows that sort after it are
+        returned, so fetching a deep page costs the same as fetching the first.
+    session - An optional Session to run on instead of the module-level connection.
 
     returns a list of LoanHistory objects with return entries that meet the qualifications of the filters. If no entries
     meet the requirements, then an empty list is returned
     """
-    # query def
-    query = """
-        SELECT isbn, account_id, checkout_date, due_date, return_date
-        FROM LoanHistory
+    cur = _cursor(session)
+    query, params = _loan_histories_query(filter_attributes, min_checkout_date, max_checkout_date, min_due_date,
+                                          max_due_date, min_return_date, max_return_date, order_by, after, limit)
+    cur.execute(query, params)
+
+    return [LoanHistory.from_row(*row) for row in cur.fetchall()]
+
+
+def iter_filtered_loan_histories(filter_attributes: LoanHistory = None,
+                                 min_checkout_date: str = None,
+                                 max_checkout_date: str = None,
+                                 min_due_date: str = None,
+                                 max_due_date: str = None,
+                                 min_return_date: str = None,
+                                 max_return_date: str = None,
+                                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                                 session: Session = None) -> Iterator[LoanHistory]:
     """
-    conditions = []
-    params = []
+    Takes the same filters as get_filtered_loan_histories, but yields the matching loan histories one at a time
+    instead of building a list, reading them from an unbuffered cursor chunk_size rows at a time so memory use
+    doesn't grow with the size of the table.
+    session - An optional Session to run on instead of the module-level connection. No other query can be run on the
+        connection until the generator is exhausted or closed.
+    """
+    query, params = _loan_histories_query(filter_attributes, min_checkout_date, max_checkout_date, min_due_date,
+                                          max_due_date, min_return_date, max_return_date)
+    return _stream(query, params, LoanHistory.from_row, chunk_size=chunk_size, session=session)
 
-    if filter_attributes.isbn is not None:
-        conditions.append("isbn = ?")
-        params.append(filter_attributes.isbn)
 
-    if filter_attributes.account_id is not None:
-        conditions.append("account_id = ?")
-        params.append(filter_attributes.account_id)
+class LoanHistoryColumns(namedtuple("LoanHistoryColumns", ["isbn", "isbn_categories", "account_id",
+                                                           "account_id_categories", "checkout_date", "due_date",
+                                                           "return_date"])):
+    """
+    LoanHistory rows as parallel NumPy arrays, one entry per row. isbn and account_id hold int32 codes into
+    isbn_categories and account_id_categories, and the dates are datetime64[D] with NaT where the column is NULL.
+    """
+    __slots__ = ()
 
-    if getattr(filter_attributes, "checkout_date", None) is not None:
-        conditions.append("checkout_date = ?")
-        params.append(filter_attributes.checkout_date)
 
-    if getattr(filter_attributes, "due_date", None) is not None:
-        conditions.append("due_date = ?")
-        params.append(filter_attributes.due_date)
+_EPOCH_ORDINAL = 719163  # date(1970, 1, 1).toordinal(), day 0 of datetime64[D]
 
-    if getattr(filter_attributes, "return_date", None) is not None:
-        conditions.append("return_date = ?")
-        params.append(filter_attributes.return_date)
 
-    # Date ranges
-    if min_checkout_date is not None:
-        conditions.append("checkout_date >= ?")
-        params.append(min_checkout_date)
+def get_loan_histories_columnar(filter_attributes: LoanHistory = None,
+                                min_checkout_date: str = None,
+                                max_checkout_date: str = None,
+                                min_due_date: str = None,
+                                max_due_date: str = None,
+                                min_return_date: str = None,
+                                max_return_date: str = None,
+                                chunk_size: int = DEFAULT_CHUNK_SIZE,
+                                session: Session = None) -> LoanHistoryColumns:
+    """
+    Takes the same filters as get_filtered_loan_histories, but returns the matching rows as a LoanHistoryColumns of
+    NumPy arrays instead of LoanHistory objects. Rows are read from an unbuffered cursor chunk_size at a time and
+    packed into typed buffers as they arrive, so only one chunk of row tuples is ever held at once.
+    session - An optional Session to run on instead of the module-level connection.
 
-    if max_checkout_date is not None:
-        conditions.append("checkout_date <= ?")
-        params.append(max_checkout_date)
+    returns a LoanHistoryColumns with one entry per matching row. Requires numpy.
+    """
+    import numpy as np
+    from array import array
 
-    if min_due_date is not None:
-        conditions.append("due_date >= ?")
-        params.append(min_due_date)
+    if filter_attributes is None:
+        filter_attributes = LoanHistory()
 
-    if max_due_date is not None:
-        conditions.append("due_date <= ?")
-        params.append(max_due_date)
+    query, params = _loan_histories_query(filter_attributes, min_checkout_date, max_checkout_date, min_due_date,
+                                          max_due_date, min_return_date, max_return_date)
 
-    if min_return_date is not None:
-        conditions.append("return_date >= ?")
-        params.append(min_return_date)
+    nat = np.iinfo(np.int64).min
+    isbn_codes, account_codes = {}, {}
+    isbns, accounts = array("i"), array("i")
+    dates = (array("q"), array("q"), array("q"))
 
-    if max_return_date is not None:
-        conditions.append("return_date <= ?")
-        params.append(max_return_date)
+    stream_cur = _instrument(_connection(session).cursor(buffered=False))
+    try:
+        stream_cur.execute(query, params)
 
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
+        rows = stream_cur.fetchmany(chunk_size)
+        while rows:
+            for isbn, account_id, *row_dates in rows:
+                isbns.append(isbn_codes.setdefault(isbn, len(isbn_codes)))
+                accounts.append(account_codes.setdefault(account_id, len(account_codes)))
+                for column, value in zip(dates, row_dates):
+                    column.append(nat if value is None else value.toordinal() - _EPOCH_ORDINAL)
 
-    cur.execute(query, params)
-    rows = cur.fetchall()
-
-    histories: list[LoanHistory] = []
-    for isbn, account_id, checkout_date, due_date, return_date in rows:
-        histories.append(
-            LoanHistory(
-                isbn=isbn,
-                account_id=account_id,
-                checkout_date=checkout_date.isoformat() if checkout_date else None,
-                due_date=due_date.isoformat() if due_date else None,
-                return_date=return_date.isoformat() if return_date else None,
-            )
-        )
+            rows = stream_cur.fetchmany(chunk_size)
 
-    return histories
+    finally:
+        stream_cur.close()
+
+    checkout_dates, due_dates, return_dates = (np.frombuffer(column, dtype=np.int64).view("datetime64[D]")
+                                               for column in dates)
+    return LoanHistoryColumns(
+        isbn=np.frombuffer(isbns, dtype=np.int32),
+        isbn_categories=np.array(list(isbn_codes), dtype=object),
+        account_id=np.frombuffer(accounts, dtype=np.int32),
+        account_id_categories=np.array(list(account_codes), dtype=object),
+        checkout_date=checkout_dates,
+        due_date=due_dates,
+        return_date=return_dates,
+    )
 
 
+def loan_history_stats(columns: LoanHistoryColumns) -> dict:
+    """
+    columns - The result of get_loan_histories_columnar
 
-def get_filtered_waitlist(filter_attributes: Waitlist = None,
-                          min_place_in_line: int = -1,
-                          max_place_in_line: int = -1) -> list[Waitlist]:
+    returns a dict with the average number of days a book was borrowed, the fraction of loans returned after their due
+    date, and a dict of how many times each isbn has been borrowed. Loans with no return date are left out of the first
+    two.
     """
-    filter_attributes - A Waitlist object containing attributes to filter waitlists in the database. If an attribute is None,
-        then it should not be considered for the search. e.g. if filter_attributes.isbn = "123456789" then all rows returned
-        should have their isbn == "123456789". If filter_attributes.isbn = None, then we do not care what the isbn is when
-        filtering. Additionally, many attributes may be used as a filter simultaneously. filter_attributes will never be
-        None, but any attribute not being used as a filter will be None. It is also possible all the attributes in
-        filter_attributes to be None, if that is the case then all rows should be returned.
-    min_place_in_line - The minimum place in line for a waitlist to be. e.g. if min_place_in_line = 3 then only entries
-        where the place_in_line is greater than or equal to 3 should be included. If min_place_in_line is not used, it will
-        be -1.
-    max_place_in_line - The minimum place in line for a waitlist to be. e.g. if max_place_in_line = 3 then only entries
-        where the place_in_line is less than or equal to 3 should be included. If max_place_in_line is not used, it will be
-         -1.
+    import numpy as np
 
-    returns a list of Waitlist objects with waitlist entries that meet the qualifications of the filters. If no entries meet
-     the requirements, then an empty list is returned.
+    returned = ~np.isnat(columns.return_date)
+    days_borrowed = (columns.return_date[returned] - columns.checkout_date[returned]).astype(np.int64)
+    late = columns.return_date[returned] > columns.due_date[returned]
+    loans_per_isbn = np.bincount(columns.isbn, minlength=len(columns.isbn_categories))
+
+    return {
+        "average_days_borrowed": float(days_borrowed.mean()) if days_borrowed.size else 0.0,
+        "late_return_rate": float(late.mean()) if late.size else 0.0,
+        "loans_per_isbn": dict(zip(columns.isbn_categories.tolist(), loans_per_isbn.tolist())),
+    }
+
+
+def _waitlist_query(filter_attributes: Waitlist, min_place_in_line: int, max_place_in_line: int) -> tuple[str, list]:
+    """
+    returns the query and parameters for get_filtered_waitlist and iter_filtered_waitlist.
     """
     # define query
     query = """
@@ -605,71 +1660,113 @@ def get_filtered_waitlist(filter_attributes: Waitlist = None,
         conditions.append("place_in_line <= ?")
         params.append(max_place_in_line)
 
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
+    return _compose_query(query, conditions), params
+
+
+def get_filtered_waitlist(filter_attributes: Waitlist = None,
+                          min_place_in_line: int = -1,
+                          max_place_in_line: int = -1,
+                          session: Session = None) -> list[Waitlist]:
+    """
+    filter_attributes - A Waitlist object containing attributes to filter waitlists in the database. If an attribute is None,
+        then it should not be considered for the search. e.g. if filter_attributes.isbn = "123456789" then all rows returned
+        should have their isbn == "123456789". If filter_attributes.isbn = None, then we do not care what the isbn is when
+        filtering. Additionally, many attributes may be used as a filter simultaneously. filter_attributes will never be
+        None, but any attribute not being used as a filter will be None. It is also possible all the attributes in
+        filter_attributes to be None, if that is the case then all rows should be returned.
+    min_place_in_line - The minimum place in line for a waitlist to be. e.g. if min_place_in_line = 3 then only entries
+        where the place_in_line is greater than or equal to 3 should be included. If min_place_in_line is not used, it will
+        be -1.
+    max_place_in_line - The minimum place in line for a waitlist to be. e.g. if max_place_in_line = 3 then only entries
+        where the place_in_line is less than or equal to 3 should be included. If max_place_in_line is not used, it will be
+         -1.
+    session - An optional Session to run on instead of the module-level connection.
 
+    returns a list of Waitlist objects with waitlist entries that meet the qualifications of the filters. If no entries meet
+     the requirements, then an empty list is returned.
+    """
+    cur = _cursor(session)
+    query, params = _waitlist_query(filter_attributes, min_place_in_line, max_place_in_line)
     cur.execute(query, params)
-    rows = cur.fetchall()
-
-    entries: list[Waitlist] = []
-    for isbn, account_id, place_in_line in rows:
-        entries.append(
-            Waitlist(
-                isbn=isbn,
-                account_id=account_id,
-                place_in_line=place_in_line,
-            )
-        )
 
-    return entries
+    return [Waitlist(*row) for row in cur.fetchall()]
+
+
+def iter_filtered_waitlist(filter_attributes: Waitlist = None,
+                           min_place_in_line: int = -1,
+                           max_place_in_line: int = -1,
+                           chunk_size: int = DEFAULT_CHUNK_SIZE,
+                           session: Session = None) -> Iterator[Waitlist]:
+    """
+    Takes the same filters as get_filtered_waitlist, but yields the matching waitlist entries one at a time instead
+    of building a list, reading them from an unbuffered cursor chunk_size rows at a time so memory use doesn't grow
+    with the size of the table.
+    session - An optional Session to run on instead of the module-level connection. No other query can be run on the
+        connection until the generator is exhausted or closed.
+    """
+    query, params = _waitlist_query(filter_attributes, min_place_in_line, max_place_in_line)
+    return _stream(query, params, Waitlist, chunk_size=chunk_size, session=session)
+
+
+def overdue_report(as_of: str = None, due_within_days: int = 0, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   session: Session = None) -> Iterator[OverdueLoan]:
+    """
+    as_of - The date (formatted in YYYY-mm-dd) to measure lateness from. If as_of is None, today is used.
+    due_within_days - Also include loans that will be due within this many days of as_of. 0 gives the loans that are
+        overdue or due on as_of.
+    chunk_size - How many rows to fetch from the cursor at a time.
+    session - An optional Session to run on instead of the module-level connection. No other query can be run on the
+        connection until the generator is exhausted or closed.
+
+    returns a generator of OverdueLoan objects, most overdue first. The join with User and Book and the days overdue
+    (negative for loans not due yet) are worked out in a single query.
+    """
+    query, params = _overdue_report_query(as_of, due_within_days)
+    return _stream(query, params, OverdueLoan.from_row, chunk_size=chunk_size, session=session)
 
 
-def number_in_stock(isbn: str = None) -> int:
+def _overdue_report_query(as_of: str, due_within_days: int) -> tuple[str, list]:
+    """
+    returns the query and parameters for overdue_report.
+    """
+    return """
+        SELECT l.isbn, b.title, l.account_id, u.name, u.email, u.phone_number, l.checkout_date, l.due_date,
+               DATEDIFF(COALESCE(?, CURDATE()), l.due_date) AS days_overdue
+        FROM Loan l
+        JOIN User u ON u.account_id = l.account_id
+        JOIN Book b ON b.isbn = l.isbn
+        WHERE l.due_date <= DATE_ADD(COALESCE(?, CURDATE()), INTERVAL ? DAY)
+        ORDER BY l.due_date, l.isbn, l.account_id
+    """, [as_of, as_of, due_within_days]
+
+
+def number_in_stock(isbn: str = None, session: Session = None) -> int:
     """
     isbn - A string containing the ISBN for a book. ISBN will never be None.
+    session - An optional Session to run on instead of the module-level connection.
 
     returns the quantity of books available with their ISBN equal to the isbn parameter. The quantity available should be
         calculated as how many copies the branch owns minus how many copies are checked out to users. If the library does
         not own the book, then -1 should be returned.
     """
-    # how many library owns
-    cur.execute(
-        "SELECT num_owned FROM Book WHERE isbn = ?",
-        [isbn],
-    )
-    row = cur.fetchone()
+    row = _execute("number_in_stock", [isbn], session).fetchone()
     if row is None:
         return -1  # doesn't own the book
 
-    (num_owned,) = row
-
-    # count how many currently checked out
-    cur.execute(
-        "SELECT COUNT(*) FROM Loan WHERE isbn = ?",
-        [isbn],
-    )
-    (num_checked_out,) = cur.fetchone()
-
-    return num_owned - num_checked_out
+    (num_in_stock,) = row
+    return num_in_stock
 
 
-def place_in_line(isbn: str = None, account_id: str = None) -> int:
+def place_in_line(isbn: str = None, account_id: str = None, session: Session = None) -> int:
     """
     isbn - A string containing the ISBN for a book. ISBN will never be None.
     account_id - A string containing the account id for a user. account_id will never be None.
+    session - An optional Session to run on instead of the module-level connection.
 
     returns what place in line the user with the corresponding account_id is in for the book with the corresponding ISBN. If
         the user is not on the waitlist for that book, then -1 should be returned.
     """
-    cur.execute(
-        """
-        SELECT place_in_line
-        FROM Waitlist
-        WHERE isbn = ? AND account_id = ?
-        """,
-        [isbn, account_id],
-    )
-    row = cur.fetchone()
+    row = _execute("place_in_line", [isbn, account_id], session).fetchone()
     if row is None:
         return -1
 
@@ -677,33 +1774,438 @@ def place_in_line(isbn: str = None, account_id: str = None) -> int:
     return place
 
 
-def line_length(isbn: str = None) -> int:
+def line_length(isbn: str = None, session: Session = None) -> int:
     """
     isbn - A string containing the ISBN for a book. ISBN will never be None.
+    session - An optional Session to run on instead of the module-level connection.
 
     returns how many people are on the waitlist for the book with the corresponding ISBN. e.g. if there are 5 people on the
         waitlist for a book, 5 should be returned. If there is no waitlist for the book, then 0 should be returned.
     """
+    row = _execute("line_length", [isbn], session).fetchone()
+    if row is None:
+        return 0
+
+    (count,) = row
+    return count
+
+
+# Outcomes returned by try_checkout
+CHECKOUT_SUCCESS = "checked_out"
+CHECKOUT_ALREADY_HAS = "already_has"
+CHECKOUT_UNAVAILABLE = "unavailable"  # No copies left and the user is not waitlisted
+CHECKOUT_STILL_WAITLISTED = "waitlisted"  # No copies left and the user is already waitlisted
+CHECKOUT_NOT_NEXT = "not_next"  # Copies are available but someone else is ahead in line
+CHECKOUT_BOOK_NOT_FOUND = "book_not_found"
+CHECKOUT_USER_NOT_FOUND = "user_not_found"
+CHECKOUT_BOOK_AND_USER_NOT_FOUND = "book_and_user_not_found"
+
+
+def _checkout_decision(num_in_stock: int, user_has_book: bool, user_place_in_line: int, people_in_line: int) -> str:
+    """
+    returns the checkout outcome for a user given the state of the book they want, following the circulation desk rules.
+    """
+    if user_has_book:
+        return CHECKOUT_ALREADY_HAS
+
+    if num_in_stock <= 0:
+        return CHECKOUT_UNAVAILABLE if user_place_in_line == -1 else CHECKOUT_STILL_WAITLISTED
+
+    # User is either next in line or there is no waitlist
+    if user_place_in_line == 1 or people_in_line == 0:
+        return CHECKOUT_SUCCESS
+
+    return CHECKOUT_NOT_NEXT
+
+
+def try_checkout(isbn: str = None, account_id: str = None, session: Session = None) -> tuple[str, int]:
+    """
+    isbn - A string containing the ISBN for the book being checked out. isbn will never be None.
+    account_id - A string containing the account id of the user checking out a book. account_id will never be None.
+    session - An optional Session to run on instead of the module-level connection.
+
+    Checks whether the user may check out the book and, if so, checks it out and moves the waitlist along, all in one
+    transaction. Everything is read in one query that locks the book's BookAvailability row with SELECT ... FOR UPDATE, so
+    two desks can't both hand out the last copy. The transaction is committed before returning, whatever the commit
+    policy is, so the lock isn't held while the desk decides what to do next. If anything fails it is rolled back and
+    nothing is checked out.
+
+    returns a tuple of (outcome, place_in_line) where outcome is one of the CHECKOUT_* constants and place_in_line is the
+        user's place in line for the book before the checkout, or -1 if they were not waitlisted.
+    """
+    cur = _cursor(session)
+
+    with _locking_operation(session):
+        # Every checkout, return and waitlist change updates the BookAvailability row, so locking it makes the other
+        # desks wait for us (and us for them) before anything below is read
+        cur.execute(
+            """
+            SELECT a.num_owned - a.num_checked_out,
+                   a.waitlist_length,
+                   EXISTS(SELECT 1 FROM Loan l WHERE l.isbn = a.isbn AND l.account_id = ?),
+                   COALESCE((SELECT e.seq - h.head + 1
+                             FROM WaitlistEntry e
+                             JOIN WaitlistHead h ON h.isbn = e.isbn
+                             WHERE e.isbn = a.isbn AND e.account_id = ?), -1),
+                   EXISTS(SELECT 1 FROM User WHERE account_id = ?)
+            FROM BookAvailability a
+            WHERE a.isbn = ?
+            FOR UPDATE
+            """,
+            [account_id, account_id, account_id, isbn],
+        )
+        row = cur.fetchone()
+
+        if row is None:
+            cur.execute("SELECT EXISTS(SELECT 1 FROM User WHERE account_id = ?)", [account_id])
+            (user_exists,) = cur.fetchone()
+            return (CHECKOUT_BOOK_NOT_FOUND if user_exists else CHECKOUT_BOOK_AND_USER_NOT_FOUND), -1
+
+        num_in_stock, people_in_line, user_has_book, user_place_in_line, user_exists = row
+
+        if not user_exists:
+            return CHECKOUT_USER_NOT_FOUND, -1
+
+        outcome = _checkout_decision(num_in_stock, bool(user_has_book), user_place_in_line, people_in_line)
+
+        if outcome == CHECKOUT_SUCCESS:
+            checkout_book(isbn=isbn, account_id=account_id, session=session)
+            update_waitlist(isbn=isbn, session=session)
+
+        return outcome, user_place_in_line
+
+
+# Outcomes returned by return_books
+RETURN_SUCCESS = "returned"
+RETURN_NOT_LOANED = "not_loaned"  # The user doesn't have the book checked out
+RETURN_BOOK_NOT_FOUND = "book_not_found"
+RETURN_USER_NOT_FOUND = "user_not_found"
+RETURN_BOOK_AND_USER_NOT_FOUND = "book_and_user_not_found"
+
+
+# Longest isbn or account_id that can be in the database, the same as the Book, User and Loan columns
+SCAN_MAX_LENGTH = 16
+
+
+def _scan_value(value: str):
+    """
+    returns value, or None if it is too long to be an isbn or account_id. Nothing can match None, so a malformed scan
+    gets a not found outcome of its own instead of failing the whole batch in strict mode.
+    """
+    return value if value is not None and len(value) <= SCAN_MAX_LENGTH else None
+
+
+def _load_scan_batch(cur, pairs: list[tuple[str, str]]):
+    """
+    Fills the ScanBatch temporary table with (seq, isbn, account_id) for every pair, seq being its index in pairs.
+    Temporary tables only exist for the connection that made them, so concurrent batches don't see each other.
+    """
+    cur.execute(f"""
+        CREATE TEMPORARY TABLE IF NOT EXISTS ScanBatch(seq INT PRIMARY KEY, isbn VARCHAR({SCAN_MAX_LENGTH}),
+                                                       account_id VARCHAR({SCAN_MAX_LENGTH}))
+    """)
+    cur.execute("DELETE FROM ScanBatch")
+    cur.executemany(
+        "INSERT INTO ScanBatch (seq, isbn, account_id) VALUES (?, ?, ?)",
+        [(seq, _scan_value(isbn), _scan_value(account_id)) for seq, (isbn, account_id) in enumerate(pairs)],
+    )
+
+
+def return_books(pairs: list[tuple[str, str]] = None, session: Session = None) -> list[str]:
+    """
+    pairs - A list of (isbn, account_id) tuples, one for every book being returned, e.g. the scans from the book-drop.
+    session - An optional Session to run on instead of the module-level connection.
+
+    Returns every loan in pairs at once: the pairs are loaded into a temporary table which is joined against Loan to move
+    the loans to LoanHistory and delete them, all in one transaction that is committed when the batch finishes, whatever
+    the commit policy is, or rolled back if any statement fails.
+
+    returns a list with one of the RETURN_* constants for each pair, in the same order as pairs.
+    """
+    if not pairs:
+        return []
+
+    cur = _cursor(session)
+
+    with _locking_operation(session):
+        _load_scan_batch(cur, pairs)
+
+        cur.execute(
+            """
+            SELECT b.isbn IS NOT NULL, u.account_id IS NOT NULL, l.isbn IS NOT NULL
+            FROM ScanBatch s
+            LEFT JOIN Book b ON b.isbn = s.isbn
+            LEFT JOIN User u ON u.account_id = s.account_id
+            LEFT JOIN Loan l ON l.isbn = s.isbn AND l.account_id = s.account_id
+            ORDER BY s.seq
+            FOR UPDATE
+            """
+        )
+        rows = cur.fetchall()
+
+        outcomes = []
+        returned = set()
+        for (isbn, account_id), (found_book, found_user, has_loan) in zip(pairs, rows):
+            if not found_book and not found_user:
+                outcomes.append(RETURN_BOOK_AND_USER_NOT_FOUND)
+            elif not found_book:
+                outcomes.append(RETURN_BOOK_NOT_FOUND)
+            elif not found_user:
+                outcomes.append(RETURN_USER_NOT_FOUND)
+            elif not has_loan or (isbn, account_id) in returned:  # The same book scanned twice is only returned once
+                outcomes.append(RETURN_NOT_LOANED)
+            else:
+                outcomes.append(RETURN_SUCCESS)
+                returned.add((isbn, account_id))
+
+        if returned:
+            cur.execute(
+                """
+                INSERT INTO LoanHistory (isbn, account_id, checkout_date, due_date, return_date)
+                SELECT l.isbn, l.account_id, l.checkout_date, l.due_date, CURRENT_DATE()
+                FROM Loan l
+                JOIN (SELECT DISTINCT isbn, account_id FROM ScanBatch) s
+                    ON s.isbn = l.isbn AND s.account_id = l.account_id
+                """
+            )
+            cur.execute(
+                """
+                DELETE l
+                FROM Loan l
+                JOIN ScanBatch s ON s.isbn = l.isbn AND s.account_id = l.account_id
+                """
+            )
+            cur.executemany(
+                "UPDATE BookAvailability SET num_checked_out = num_checked_out - ? WHERE isbn = ?",
+                [(count, isbn) for isbn, count in Counter(isbn for isbn, _ in returned).items()],
+            )
+            _mark_dirty(session, len(returned))
+
+        return outcomes
+
+
+def checkout_books(pairs: list[tuple[str, str]] = None, session: Session = None) -> list[str]:
+    """
+    pairs - A list of (isbn, account_id) tuples, one for every book being checked out.
+    session - An optional Session to run on instead of the module-level connection.
+
+    Checks out every pair that is allowed to be checked out, following the same rules as try_checkout and in the order
+    given, so two pairs for the last copy of a book only check out the first. The state of every book in the batch is
+    read with a few set-based queries (the BookAvailability rows are locked with FOR UPDATE), the decisions are made in
+    Python, and the Loans and waitlist changes are written with executemany, all in one transaction that is committed
+    when the batch finishes, whatever the commit policy is, or rolled back if any statement fails.
+
+    returns a list with one of the CHECKOUT_* constants for each pair, in the same order as pairs.
+    """
+    if not pairs:
+        return []
+
+    cur = _cursor(session)
+
+    with _locking_operation(session):
+        _load_scan_batch(cur, pairs)
+
+        cur.execute(
+            """
+            SELECT a.isbn, a.num_owned - a.num_checked_out
+            FROM BookAvailability a
+            JOIN (SELECT DISTINCT isbn FROM ScanBatch) s ON s.isbn = a.isbn
+            FOR UPDATE
+            """
+        )
+        num_in_stock = dict(cur.fetchall())
+
+        cur.execute(
+            """
+            SELECT u.account_id IS NOT NULL, l.isbn IS NOT NULL
+            FROM ScanBatch s
+            LEFT JOIN User u ON u.account_id = s.account_id
+            LEFT JOIN Loan l ON l.isbn = s.isbn AND l.account_id = s.account_id
+            ORDER BY s.seq
+            LOCK IN SHARE MODE
+            """
+        )
+        user_rows = cur.fetchall()
+
+        cur.execute(
+            """
+            SELECT w.isbn, w.account_id
+            FROM Waitlist w
+            JOIN (SELECT DISTINCT isbn FROM ScanBatch) s ON s.isbn = w.isbn
+            ORDER BY w.isbn, w.place_in_line
+            FOR UPDATE
+            """
+        )
+        lines = {}
+        for isbn, account_id in cur.fetchall():
+            lines.setdefault(isbn, []).append(account_id)
+
+        outcomes = []
+        new_loans = []
+        num_dequeued = {}
+        loaned = set()
+        for (isbn, account_id), (found_user, has_loan) in zip(pairs, user_rows):
+            found_book = isbn in num_in_stock
+
+            if not found_book and not found_user:
+                outcomes.append(CHECKOUT_BOOK_AND_USER_NOT_FOUND)
+                continue
+            elif not found_book:
+                outcomes.append(CHECKOUT_BOOK_NOT_FOUND)
+                continue
+            elif not found_user:
+                outcomes.append(CHECKOUT_USER_NOT_FOUND)
+                continue
+
+            line = lines.get(isbn, [])
+            user_place_in_line = line.index(account_id) + 1 if account_id in line else -1
+            user_has_book = bool(has_loan) or (isbn, account_id) in loaned
+
+            outcome = _checkout_decision(num_in_stock[isbn], user_has_book, user_place_in_line, len(line))
+            outcomes.append(outcome)
+
+            if outcome == CHECKOUT_SUCCESS:
+                new_loans.append((isbn, account_id))
+                loaned.add((isbn, account_id))
+                num_in_stock[isbn] -= 1
+
+                # Same as update_waitlist: whoever was first in line is removed
+                if line:
+                    line.pop(0)
+                    num_dequeued[isbn] = num_dequeued.get(isbn, 0) + 1
+
+        if new_loans:
+            cur.executemany(
+                """
+                INSERT INTO Loan (isbn, account_id, checkout_date, due_date)
+                VALUES (?, ?, CURRENT_DATE(), DATE_ADD(CURRENT_DATE(), INTERVAL 2 WEEK))
+                """,
+                new_loans,
+            )
+            cur.executemany(
+                "UPDATE BookAvailability SET num_checked_out = num_checked_out + ? WHERE isbn = ?",
+                [(count, isbn) for isbn, count in Counter(isbn for isbn, _ in new_loans).items()],
+            )
+            _mark_dirty(session, len(new_loans))
+
+        if num_dequeued:
+            cur.executemany(
+                """
+                DELETE e
+                FROM WaitlistEntry e
+                JOIN WaitlistHead h ON h.isbn = e.isbn
+                WHERE e.isbn = ? AND e.seq < h.head + ?
+                """,
+                list(num_dequeued.items()),
+            )
+            cur.executemany(
+                "UPDATE WaitlistHead SET head = head + ? WHERE isbn = ?",
+                [(count, isbn) for isbn, count in num_dequeued.items()],
+            )
+            cur.executemany(
+                "UPDATE BookAvailability SET waitlist_length = waitlist_length - ? WHERE isbn = ?",
+                [(count, isbn) for isbn, count in num_dequeued.items()],
+            )
+
+        return outcomes
+
+
+def _availability_counts(cur) -> dict:
+    """
+    returns {isbn: (num_owned, num_checked_out, waitlist_length)} worked out from Book, Loan and WaitlistEntry.
+    """
     cur.execute(
-        "SELECT COUNT(*) FROM Waitlist WHERE isbn = ?",
-        [isbn],
+        """
+        SELECT b.isbn,
+               b.num_owned,
+               (SELECT COUNT(*) FROM Loan l WHERE l.isbn = b.isbn),
+               (SELECT COUNT(*) FROM WaitlistEntry e WHERE e.isbn = b.isbn)
+        FROM Book b
+        """
     )
-    (count,) = cur.fetchone()
-    return count
+    return {isbn: tuple(counts) for isbn, *counts in cur.fetchall()}
+
+
+def check_availability(session: Session = None) -> list[str]:
+    """
+    session - An optional Session to run on instead of the module-level connection.
+
+    Compares the BookAvailability counters with counts taken from Book, Loan and WaitlistEntry.
+
+    returns a list of the ISBNs whose counters are wrong (or missing). An empty list means everything is consistent.
+    """
+    cur = _cursor(session)
+    expected = _availability_counts(cur)
+
+    cur.execute("SELECT isbn, num_owned, num_checked_out, waitlist_length FROM BookAvailability")
+    actual = {isbn: tuple(counts) for isbn, *counts in cur.fetchall()}
+
+    return [isbn for isbn in expected.keys() | actual.keys() if expected.get(isbn) != actual.get(isbn)]
+
+
+def rebuild_availability(session: Session = None) -> int:
+    """
+    session - An optional Session to run on instead of the module-level connection.
+
+    Recomputes every BookAvailability row from Book, Loan and WaitlistEntry, fixing any counters that have drifted.
+
+    returns how many ISBNs were inconsistent before the rebuild.
+    """
+    cur = _cursor(session)
+    num_inconsistent = len(check_availability(session=session))
+
+    cur.execute("DELETE FROM BookAvailability")
+    cur.execute(
+        """
+        INSERT INTO BookAvailability (isbn, num_owned, num_checked_out, waitlist_length)
+        SELECT b.isbn,
+               b.num_owned,
+               (SELECT COUNT(*) FROM Loan l WHERE l.isbn = b.isbn),
+               (SELECT COUNT(*) FROM WaitlistEntry e WHERE e.isbn = b.isbn)
+        FROM Book b
+        """
+    )
+    _mark_dirty(session)
+
+    return num_inconsistent
+
+
+def save_changes(session: Session = None):
+    """
+    Commits all changes made to the db, whatever the commit policy is.
+    session - An optional Session to commit instead of the module-level connection.
+    """
+    _connection(session).commit()
+    _policy(session).reset()
 
 
-def save_changes():
+def discard_changes(session: Session = None):
     """
-    Commits all changes made to the db.
+    Rolls back every change made to the db since the last commit, including any writes the commit policy was holding.
+    session - An optional Session to roll back instead of the module-level connection.
     """
-    conn.commit()
+    _connection(session).rollback()
+    _policy(session).reset()
 
 
-def close_connection():
+def close_connection(session: Session = None):
     """
-    Closes the cursor and connection.
+    Commits any pending writes, then closes the cursor and connection, and the connection pool if a Session opened it.
+    session - An optional Session to close (returning its connection to the pool) instead of the module-level connection.
     """
+    if session is not None:
+        try:
+            flush(session)
+        finally:
+            session.close()
+        return
+
     try:
+        flush()
+        _close_statements(_statements)
         cur.close()
     finally:
-        conn.close()
+        try:
+            conn.close()
+        finally:
+            _close_pool()
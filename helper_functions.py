@@ -1,10 +1,10 @@
 import db_handler as db
 from models.LoanHistory import LoanHistory
-from datetime import timedelta, datetime
 from models.Waitlist import Waitlist
 from models.Book import Book
 from models.User import User
 from models.Loan import Loan
+from models.OverdueLoan import OverdueLoan
 
 # Basic lists to make menu printing modular
 MAIN_MENU_OPTIONS = [
@@ -15,6 +15,7 @@ MAIN_MENU_OPTIONS = [
     "Add a Book",
     "Add a User",
     "Edit a User",
+    "Reports",
     "Exit"
 ]
 
@@ -27,6 +28,11 @@ TABLE_OPTIONS = [
     "Cancel"
 ]
 
+REPORT_OPTIONS = [
+    "Overdue and Due Soon Loans",
+    "Cancel"
+]
+
 # These are used to filter attributes when searching through tables
 BOOK_OPTIONS = [ 
     "ISBN",
@@ -84,19 +90,60 @@ LOAN_HISTORY_OPTIONS = [
 ]
 
 
-# Given a generic list of objects, print them out. The object_name var helps it sound more specific
-def print_list_of_objects(objects: list, object_name: str):
-    if len(objects) == 0:
+# How many results the searches show at a time
+PAGE_SIZE = 20
+
+
+def print_object(o):
+    print("-" * 20)
+    print(str(o)[:-1])
+    print("-" * 20)
+
+
+def print_num_found(num_objects: int, object_name: str):
+    if num_objects == 0:
         print(f"No {object_name}s found")
 
     else:
-        for o in objects:
-            print("-" * 20)
-            print(str(o)[:-1])
-            print("-" * 20)
+        print()
+        print(f"Found {str(num_objects)} {object_name}{'s' if num_objects > 1 else ''}.")
+
+
+# Given a generic list (or generator) of objects, print them out as they come. The object_name var helps it sound more specific
+def print_list_of_objects(objects, object_name: str):
+    num_objects = 0
+
+    for o in objects:
+        print_object(o)
+        num_objects += 1
+
+    print_num_found(num_objects, object_name)
+
+
+# Prints the results a page at a time. get_page takes the cursor of the previous page (None for the first page) and
+# returns up to PAGE_SIZE objects
+def print_pages(get_page, object_name: str):
+    num_objects = 0
+    after = None
+
+    while True:
+        page = get_page(after)
+
+        for o in page:
+            print_object(o)
+
+        num_objects += len(page)
+
+        if len(page) < PAGE_SIZE:
+            break
 
         print()
-        print(f"Found {str(len(objects))} {object_name}{'s' if len(objects) > 1 else ''}.")
+        if input(f"Showing {num_objects} so far. Show the next page? (Y/N): ").upper() != "Y":
+            break
+
+        after = db.page_cursor(page[-1])
+
+    print_num_found(num_objects, object_name)
 
 
 # Generic print menu function
@@ -178,20 +225,19 @@ def handle_user_menu_choice(choice, new_user=User()):
 
 
 def check_if_user_exists(account_id):
-    user_exists = len(db.get_filtered_users(User(account_id=account_id))) == 1
+    user_exists = db.user_exists(account_id)
 
     return user_exists
 
 
 def check_if_book_exists(isbn):
-    book_exists = len(db.get_filtered_books(Book(isbn=isbn))) == 1
+    book_exists = db.book_exists(isbn)
 
     return book_exists
 
 
 def check_if_book_and_user_exists(isbn, account_id):
-    book_exists = check_if_book_exists(isbn)
-    user_exists = check_if_user_exists(account_id)
+    book_exists, user_exists = db.book_and_user_exist(isbn, account_id)
     checks_passed = book_exists and user_exists
 
     if not book_exists:
@@ -290,7 +336,11 @@ def waitlist_user(isbn=None, account_id=None):
         print("User is already waitlisted")
         return
 
+    prompt_waitlist(isbn=isbn, account_id=account_id)
+
 
+# Asks whether to waitlist a user that is known to exist and not already be waitlisted for the book
+def prompt_waitlist(isbn=None, account_id=None):
     waitlist = input("Would you like to waitlist the User (Y/N): ").upper() == "Y"
 
     if waitlist:
@@ -316,38 +366,34 @@ def checkout_book():
     isbn = input("Enter ISBN: ")
     account_id = input("Enter Account ID: ")
 
-    if not check_if_book_and_user_exists(isbn, account_id):
-        return
+    # The eligibility checks and the checkout itself all happen in one transaction
+    outcome, user_place_in_line = db.try_checkout(isbn=isbn, account_id=account_id)
 
-    num_in_stock = db.number_in_stock(isbn=isbn)
-    user_has_book = len(db.get_filtered_loans(Loan(isbn=isbn, account_id=account_id))) > 0
-    user_place_in_line = db.place_in_line(isbn=isbn, account_id=account_id)
+    if outcome in (db.CHECKOUT_BOOK_NOT_FOUND, db.CHECKOUT_BOOK_AND_USER_NOT_FOUND):
+        print("Book not found")
+
+    if outcome in (db.CHECKOUT_USER_NOT_FOUND, db.CHECKOUT_BOOK_AND_USER_NOT_FOUND):
+        print("User not found")
 
-    if user_has_book:
+    if outcome == db.CHECKOUT_ALREADY_HAS:
         print("The user has already checked out the book")
 
-    elif num_in_stock == 0 :  # Out of stock, waitlist the user
-        if user_place_in_line == -1:
-            print("This book is not available right now.")
-            waitlist_user(isbn=isbn, account_id=account_id)
-        else:
-            print("The user is waitlisted, but the book is still not available for checkout")
+    elif outcome == db.CHECKOUT_UNAVAILABLE:  # Out of stock, waitlist the user
+        print("This book is not available right now.")
+        prompt_waitlist(isbn=isbn, account_id=account_id)
 
-    else: # Check if user is able to check out the book
-        people_in_line = db.line_length(isbn=isbn)
+    elif outcome == db.CHECKOUT_STILL_WAITLISTED:
+        print("The user is waitlisted, but the book is still not available for checkout")
 
-        if user_place_in_line == 1 or people_in_line == 0: # User is either next in line or there is no waitlist
-            db.checkout_book(isbn=isbn, account_id=account_id)
-            db.update_waitlist(isbn=isbn)
-            print("Successfully checked out book")
+    elif outcome == db.CHECKOUT_SUCCESS:
+        print("Successfully checked out book")
 
-        else: # There is a waitlist and user isn't next
-            if people_in_line > 0:
-                print("The user is not next in line to checkout book.")
+    elif outcome == db.CHECKOUT_NOT_NEXT:  # There is a waitlist and user isn't next
+        print("The user is not next in line to checkout book.")
 
-            if user_place_in_line == -1: # If the user isn't waitlisted then ask to waitlist them
-                print("The user is not waitlisted for the book.")
-                waitlist_user(isbn=isbn, account_id=account_id)
+        if user_place_in_line == -1:  # If the user isn't waitlisted then ask to waitlist them
+            print("The user is not waitlisted for the book.")
+            prompt_waitlist(isbn=isbn, account_id=account_id)
 
 
 def return_book():
@@ -357,7 +403,7 @@ def return_book():
     if not check_if_book_and_user_exists(isbn, account_id):
         return
 
-    user_has_book = len(db.get_filtered_loans(Loan(isbn=isbn, account_id=account_id))) > 0
+    user_has_book = db.loan_exists(isbn=isbn, account_id=account_id)
 
     if not user_has_book:
         print("The user does have the book")
@@ -374,24 +420,31 @@ def grant_extension():
     if not check_if_book_and_user_exists(isbn, account_id):
         return
 
-    current_loan = db.get_filtered_loans(Loan(isbn=isbn, account_id=account_id))
+    outcome = db.grant_extension(isbn=isbn, account_id=account_id)
 
-    if len(current_loan) == 0:
+    if outcome == db.EXTENSION_NOT_LOANED:
         print("The user does not have the book")
-
+    elif outcome == db.EXTENSION_ALREADY_EXTENDED:
+        print("The user already has an extension and may not be granted another one")
     else:
-        loan = current_loan[0]
+        print("Successfully granted extension")
 
-        user_already_has_extension = datetime.fromisoformat(loan.due_date) - datetime.fromisoformat(loan.checkout_date) == timedelta(weeks=4)
 
-        if user_already_has_extension:
-            print("The user already has an extension and may not be granted another one")
-        else:
-            db.grant_extension(isbn=isbn, account_id=account_id)
-            print("Successfully granted extension")
+def search_books_by_keyword():
+    keywords = input("Keywords: ")
+    print()
+
+    books = db.search_books_fulltext(query=keywords, limit=PAGE_SIZE)
+    print_list_of_objects(books, "book")
 
 
 def search_books():
+    keyword_search = input("Would you like to do a keyword search over title, author and publisher? (Y/N): ").upper() == "Y"
+
+    if keyword_search:
+        search_books_by_keyword()
+        return
+
     use_patterns = input("Would you like to use patterns to search String attributes? (Y/N): ").upper() == "Y"
     new_book = Book() # Create an empty book to hold filter attributes
     min_pub_year = -1
@@ -441,9 +494,12 @@ def search_books():
         print("--------------------")
         print()
 
-    books = db.get_filtered_books(filter_attributes=new_book, use_patterns=use_patterns,
-                                  min_publication_year=min_pub_year, max_publication_year=max_pub_year)
-    print_list_of_objects(books, "book")
+    def get_page(after):
+        return db.get_filtered_books(filter_attributes=new_book, use_patterns=use_patterns,
+                                     min_publication_year=min_pub_year, max_publication_year=max_pub_year,
+                                     limit=PAGE_SIZE, after=after)
+
+    print_pages(get_page, "book")
         
         
 def search_users():
@@ -456,9 +512,11 @@ def search_users():
         new_user = handle_user_menu_choice(_choice, new_user)
 
     if _choice == "6":
-        found_users = db.get_filtered_users(filter_attributes=new_user, use_patterns=use_patterns)
+        def get_page(after):
+            return db.get_filtered_users(filter_attributes=new_user, use_patterns=use_patterns, limit=PAGE_SIZE,
+                                         after=after)
 
-        print_list_of_objects(found_users, "user")
+        print_pages(get_page, "user")
 
 
 def search_waitlist():
@@ -501,8 +559,8 @@ def search_waitlist():
         print("--------------------")
         print()
 
-    waitlist_entries = db.get_filtered_waitlist(filter_attributes=new_waitlist, min_place_in_line=min_place_in_line,
-                                                max_place_in_line=max_place_in_line)
+    waitlist_entries = db.iter_filtered_waitlist(filter_attributes=new_waitlist, min_place_in_line=min_place_in_line,
+                                                 max_place_in_line=max_place_in_line)
     print_list_of_objects(waitlist_entries, "waitlisted user")
         
 
@@ -557,9 +615,9 @@ def search_loan():
         print("--------------------")
         print()
 
-    loans = db.get_filtered_loans(filter_attributes=new_loan, min_checkout_date=min_checkout_date,
-                                  max_checkout_date=max_checkout_date, min_due_date=min_due_date,
-                                  max_due_date=max_due_date)
+    loans = db.iter_filtered_loans(filter_attributes=new_loan, min_checkout_date=min_checkout_date,
+                                   max_checkout_date=max_checkout_date, min_due_date=min_due_date,
+                                   max_due_date=max_due_date)
     print_list_of_objects(loans, "loan")
 
 def search_loan_history():
@@ -623,11 +681,13 @@ def search_loan_history():
         print("--------------------")
         print()
 
-    loans = db.get_filtered_loan_histories(filter_attributes=new_loan_history, min_checkout_date=min_checkout_date,
-                                           max_checkout_date=max_checkout_date, min_due_date=min_due_date,
-                                           max_due_date=max_due_date, min_return_date=min_return_date,
-                                           max_return_date=max_return_date)
-    print_list_of_objects(loans, "return")
+    def get_page(after):
+        return db.get_filtered_loan_histories(filter_attributes=new_loan_history, min_checkout_date=min_checkout_date,
+                                              max_checkout_date=max_checkout_date, min_due_date=min_due_date,
+                                              max_due_date=max_due_date, min_return_date=min_return_date,
+                                              max_return_date=max_return_date, limit=PAGE_SIZE, after=after)
+
+    print_pages(get_page, "return")
 
 
 def search_tables():
@@ -649,9 +709,89 @@ def search_tables():
         print("Invalid choice")
 
 
+# Writes the objects to a CSV file with one column per attribute, streaming them so the whole report is never held in
+# memory. Returns how many rows were written
+def write_csv(objects, path: str, columns) -> int:
+    import csv
+
+    num_objects = 0
+
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+
+        for o in objects:
+            writer.writerow([getattr(o, column) for column in columns])
+            num_objects += 1
+
+    return num_objects
+
+
+def overdue_report():
+    as_of = input("As of date (YYYY-MM-DD, leave blank for today): ") or None
+
+    try:
+        due_within_days = int(input("Include loans due within how many days? (leave blank for 0): ") or 0)
+    except ValueError:
+        print("Please enter a valid integer value")
+        return
+
+    path = input("Save to a CSV file? Enter a file name, or leave blank to print: ")
+    print()
+
+    loans = db.overdue_report(as_of=as_of, due_within_days=due_within_days)
+
+    if path:
+        num_loans = write_csv(loans, path, OverdueLoan.__slots__)
+        print(f"Wrote {num_loans} loan{'s' if num_loans != 1 else ''} to {path}")
+    else:
+        print_list_of_objects(loans, "loan")
+
+
+def reports():
+    choice = print_menu("Which report would you like to run?", REPORT_OPTIONS)
+
+    if choice == "1":
+        overdue_report()
+    elif choice == "2":
+        return
+    else:
+        print("Invalid choice")
+
+
+# Hidden main menu option (type "stats") for turning on the query instrumentation and looking at what it recorded
+def query_stats():
+    if not db.instrumentation_enabled():
+        if input("Query instrumentation is off. Turn it on? (Y/N): ").upper() != "Y":
+            return
+
+        try:
+            slow_query_ms = input("Log queries slower than how many ms? (leave blank to not log any): ")
+            db.enable_instrumentation(float(slow_query_ms) if slow_query_ms else None)
+        except ValueError:
+            print("Please enter a valid number")
+        return
+
+    stats = db.query_stats()
+    print(f"{'Operation':<32}{'Count':>8}{'Mean ms':>10}{'Max ms':>10}{'Rows':>10}{'Bytes':>12}")
+    for entry in stats:
+        print(f"{entry['operation']:<32}{entry['count']:>8}{entry['mean_ms']:>10.2f}{entry['max_ms']:>10.2f}"
+              f"{entry['rows']:>10}{entry['bytes']:>12}")
+    print()
+
+    path = input("Export to a JSON file? Enter a file name, or leave blank to skip: ")
+    if path:
+        db.export_query_stats(path)
+        print(f"Wrote {len(stats)} queries to {path}")
+
+
 def save_changes():
     db.save_changes()
 
 
+def commit_pending():
+    db.commit_pending()
+
+
 def close_connection():
     db.close_connection()
@@ -0,0 +1,179 @@
+import json
+import logging
+import sys
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+
+# Upper bounds (in milliseconds) of the latency histogram buckets. Anything slower goes in a last, unbounded bucket.
+BUCKET_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+slow_query_log = logging.getLogger("db_handler.slow_queries")
+
+
+def sql_shape(query: str) -> str:
+    """
+    returns query with its whitespace collapsed, so the same statement always has the same shape however it was
+        indented. The parameters are already ? placeholders, so they never show up in the shape.
+    """
+    return " ".join(query.split())
+
+
+def operation_name(module_name: str) -> str:
+    """
+    module_name - The module whose functions count as operations, i.e. "db_handler".
+
+    returns the name of the outermost function of module_name in the innermost run of its frames on the call stack,
+        e.g. "try_checkout" when try_checkout called checkout_book which called execute. "unknown" if there is none.
+    """
+    frame = sys._getframe(1)
+    name = None
+
+    while frame is not None:
+        if frame.f_globals.get("__name__") == module_name:
+            name = frame.f_code.co_name
+        elif name is not None:
+            break
+        frame = frame.f_back
+
+    return name or "unknown"
+
+
+def _fetched_bytes(rows: list) -> int:
+    """
+    returns roughly how many bytes of data rows holds: the length of every string or bytes value and 8 for anything
+        else that isn't NULL.
+    """
+    num_bytes = 0
+    for row in rows:
+        for value in row:
+            if isinstance(value, (str, bytes)):
+                num_bytes += len(value)
+            elif value is not None:
+                num_bytes += 8
+    return num_bytes
+
+
+class QueryStats:
+    """
+    Thread-safe per-(operation, SQL shape) counters: how many times each statement ran, the total and a histogram of
+    its wall time, and the rows and bytes fetched from it. Statements that take at least slow_query_ms are logged to
+    slow_query_log with their parameters.
+    """
+    def __init__(self, slow_query_ms: float = None):
+        self.slow_query_ms = slow_query_ms
+        self._entries = {}
+        self._lock = Lock()
+
+    def _entry(self, key: tuple) -> dict:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {
+                "count": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "rows": 0,
+                "bytes": 0,
+                "histogram": [0] * (len(BUCKET_BOUNDS_MS) + 1),
+            }
+        return entry
+
+    def record(self, operation: str, query: str, params, elapsed_ms: float) -> tuple:
+        """
+        Counts one run of query. returns the key to pass to add_fetched for the rows it returns.
+        """
+        key = (operation, sql_shape(query))
+
+        with self._lock:
+            entry = self._entry(key)
+            entry["count"] += 1
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            entry["histogram"][bisect_left(BUCKET_BOUNDS_MS, elapsed_ms)] += 1
+
+        if self.slow_query_ms is not None and elapsed_ms >= self.slow_query_ms:
+            slow_query_log.warning("%s took %.1f ms: %s with parameters %r", operation, elapsed_ms, key[1], params)
+
+        return key
+
+    def add_fetched(self, key: tuple, rows: list):
+        if not rows:
+            return
+
+        num_bytes = _fetched_bytes(rows)
+        with self._lock:
+            entry = self._entry(key)
+            entry["rows"] += len(rows)
+            entry["bytes"] += num_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self) -> list[dict]:
+        """
+        returns one dict per (operation, SQL shape) with its counters and mean time, slowest total time first.
+        """
+        with self._lock:
+            entries = [{"operation": operation, "sql": shape, **entry, "histogram": list(entry["histogram"])}
+                       for (operation, shape), entry in self._entries.items()]
+
+        for entry in entries:
+            entry["mean_ms"] = entry["total_ms"] / entry["count"] if entry["count"] else 0.0
+
+        return sorted(entries, key=lambda entry: entry["total_ms"], reverse=True)
+
+    def to_json(self) -> str:
+        return json.dumps({"bucket_bounds_ms": list(BUCKET_BOUNDS_MS), "queries": self.snapshot()}, indent=2)
+
+
+class InstrumentedCursor:
+    """
+    Wraps a cursor so that every execute and executemany is timed and recorded in stats, along with the rows fetched
+    afterwards. Everything else is passed straight through to the wrapped cursor. operation is the name to record the
+    statements under; if None it is worked out from the call stack with operation_name(module_name).
+    """
+    def __init__(self, cursor, stats: QueryStats, module_name: str, operation: str = None):
+        self._cursor = cursor
+        self._stats = stats
+        self._module_name = module_name
+        self._operation = operation
+        self._key = None
+
+    def _run(self, method, query: str, params):
+        operation = self._operation or operation_name(self._module_name)
+        start = perf_counter()
+        try:
+            return method(query, params)
+        finally:
+            self._key = self._stats.record(operation, query, params, (perf_counter() - start) * 1000)
+
+    def execute(self, query: str, params=()):
+        return self._run(self._cursor.execute, query, params)
+
+    def executemany(self, query: str, params):
+        return self._run(self._cursor.executemany, query, params)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None and self._key is not None:
+            self._stats.add_fetched(self._key, [row])
+        return row
+
+    def fetchmany(self, size: int = None):
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        if self._key is not None:
+            self._stats.add_fetched(self._key, rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        if self._key is not None:
+            self._stats.add_fetched(self._key, rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name: str):
+        return getattr(self._cursor, name)
@@ -1,49 +1,141 @@
-from mariadb import connect, ProgrammingError
-from MARIADB_CREDS import DB_CONFIG
+from contextlib import nullcontext
+from time import perf_counter
+from backends import get_backend
+import migrations
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def split_insert(line):
+    """
+    line - A single statement from one of the data files.
+
+    returns (prefix, values) where prefix is everything up to and including the VALUES keyword and values is the
+        parenthesised row, e.g. ("INSERT INTO Book (...) VALUES", "('0767409752', 'A Title', ...)"). If the line is not a
+        single row INSERT, then (None, None) is returned.
+    """
+    stripped = line.strip().rstrip(";").rstrip()
+
+    if not stripped.upper().startswith("INSERT INTO"):
+        return None, None
+
+    # The column list never contains parentheses, so the first ')' closes it and VALUES follows
+    columns_end = stripped.find(")")
+    values_start = stripped.upper().find("VALUES", columns_end)
+    if columns_end == -1 or values_start == -1:
+        return None, None
+
+    values_start += len("VALUES")
+    return stripped[:values_start], stripped[values_start:].strip()
+
+
+def execute_statement(cur, statement, backend=None):
+    # The backend knows how to run the data files' literal values, e.g. MariaDB needs every '?' in them passed as a
+    # parameter since it uses '?' as a placeholder even inside strings
+    (backend or get_backend()).execute_literal(cur, statement)
+
+
+def load_file(cur, file, batch_size=DEFAULT_BATCH_SIZE, backend=None):
+    """
+    cur - The cursor to run the statements with.
+    file - An open data file (e.g. data/book.sql).
+    batch_size - The most rows to send in one multi-row INSERT.
+    backend - The backend cur belongs to, the one in DB_CONFIG if None.
+
+    Runs the statements in file, grouping consecutive single row INSERTs into the same table into
+    INSERT ... VALUES (...), (...), ... batches so each batch is one round trip instead of one per row.
+
+    returns the number of rows inserted.
+    """
+    backend = backend or get_backend()
+    rows_inserted = 0
+    batch_prefix = None
+    batch = []
+
+    def flush():
+        if batch:
+            execute_statement(cur, batch_prefix + " " + ", ".join(batch), backend)
+            batch.clear()
+
+    for line in file:
+        if not line.strip():
+            continue
+
+        prefix, values = split_insert(line)
+
+        if prefix is None:
+            flush()
+            execute_statement(cur, line, backend)
+            continue
+
+        if prefix != batch_prefix or len(batch) >= batch_size:
+            flush()
+            batch_prefix = prefix
+
+        batch.append(values)
+        rows_inserted += 1
+
+    flush()
+    return rows_inserted
+
+
+def load_db(data_dir='data/', verbose=True, parent_cur=None, parent_conn=None, bulk=False,
+            batch_size=DEFAULT_BATCH_SIZE, run_migrations=True):
+    # If you get an error like 'Unknown collation', use the collation argument in backends.MariaDBBackend.connect.
+    # bulk - If True, INSERTs are sent in multi-row batches of batch_size rows with autocommit and unique checks turned
+    #   off for the duration of the load. Otherwise every line is executed on its own.
+    # run_migrations - If True, the schema migrations (indexes etc.) are applied to the freshly created tables.
+    backend = get_backend()
 
-def load_db(data_dir='data/', verbose=True, parent_cur=None, parent_conn=None):
-    # If you get an error like 'Unknown collation', use the collation argument in line 16.
-    # You will also need to make this change in the db_handler file
     try:
         # parent_cur and conn are only needed to run the tests and not have multiple connections to the DB.
         if parent_cur is None and parent_conn is None:
-            username = DB_CONFIG["username"]
-            password = DB_CONFIG["password"]
-            host= DB_CONFIG["host"]
-            port = DB_CONFIG["port"]
-
-            print(f"\nUsing:\n\tUsername: {username}\n\tPassword: {password}\n\tPort: {port}\n\tData Directory: {data_dir}")
+            print(f"\nUsing:\n{backend.describe()}\n\tData Directory: {data_dir}")
 
-            conn = connect(username=username, password=password, host=host, port=port) # , collation='utf8mb4_unicode_ci')
+            conn = backend.connect(use_database=False)
             cur = conn.cursor()
         else:
             cur = parent_cur
 
-        database = DB_CONFIG["database"]
-        cur.execute(f'CREATE DATABASE IF NOT EXISTS {database}')
-        cur.execute(f'USE {database}')
+        backend.use_database(cur)
 
         if verbose:
             print()
             print("Connected to the DB")
             print("Inserting Data...")
 
+        migrations.prepare_reload(cur)
+
         filenames = ["book.sql", "user.sql", "loan_history.sql", "loan.sql", "waitlist.sql"]
 
-        # Run through all the data files and execute them line by line
-        for filename in filenames:
-            with open(data_dir + filename, "r") as file:
-                if verbose:
-                    print("Inserting data from", filename)
+        # The backend's bulk settings (e.g. no autocommit or unique checks on MariaDB) are put back once the load is done
+        with backend.bulk_load(cur) if bulk else nullcontext():
+            # Run through all the data files and execute them line by line (or in batches when bulk loading)
+            for filename in filenames:
+                with open(data_dir + filename, "r") as file:
+                    if verbose:
+                        print("Inserting data from", filename)
 
-                # The second argument is due to MariaDB using '?' as a placeholder, so we're saying put ? in its place
-                for line in file:
-                    cur.execute(line, ["?"] * line.count("?"))
+                    if bulk:
+                        start = perf_counter()
+                        rows_inserted = load_file(cur, file, batch_size=batch_size, backend=backend)
+                        elapsed = perf_counter() - start
+
+                        if verbose:
+                            rate = rows_inserted / elapsed if elapsed > 0 else float("inf")
+                            print(f"\t{rows_inserted} rows in {elapsed:.2f}s ({rate:.0f} rows/s)")
+
+                    else:
+                        for line in file:
+                            execute_statement(cur, line, backend)
 
         if verbose:
             print("Inserted data from", filename)
             print()
 
+        if run_migrations:
+            migrations.migrate(cur, reset=True, verbose=verbose)
+
         if parent_cur is None and parent_conn is None:
             cur.close()
             conn.commit()
@@ -53,7 +145,7 @@ def load_db(data_dir='data/', verbose=True, parent_cur=None, parent_conn=None):
             parent_conn.commit()
 
     # Some SQL error, could be bad login or something else
-    except ProgrammingError as e:
+    except backend.ProgrammingError as e:
         if verbose:
             print("Error:", e)
 
@@ -75,7 +167,7 @@ def main():
     elif data_dir[-1] != "/":
         data_dir += "/"
 
-    success = load_db(data_dir=data_dir)
+    success = load_db(data_dir=data_dir, bulk=True)
 
     if success:
         print("Successfully loaded in the data")
@@ -83,4 +175,4 @@ def main():
         print("Failed to insert the data")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,7 +2,7 @@ import helper_functions as helper
 
 def main():
     choice = helper.print_main_menu() # Leaving the input as str so there won't be a type error when converting to int
-    exit_choice = "8"
+    exit_choice = "9"
 
     # Dictionary to convert user input into a function
     top_level_functions = {
@@ -13,6 +13,8 @@ def main():
         "5": helper.add_book,
         "6": helper.add_user,
         "7": helper.edit_user,
+        "8": helper.reports,
+        "stats": helper.query_stats, # Hidden, not listed in the menu
     }
 
     # Main loop
@@ -23,7 +25,7 @@ def main():
         else:
             print("Choice unrecognised")
 
-        helper.save_changes() # Save changes after an iteration
+        helper.commit_pending() # Save changes after an iteration, if the commit policy says they are due
         print()
         choice = helper.print_main_menu()
 
@@ -0,0 +1,209 @@
+from backends import get_backend
+
+# Schema changes applied on top of the tables created by the data/*.sql files. Each entry is
+# (version, description, statements) and is applied once, in order. Only ever append new versions.
+MIGRATIONS = [
+    # Waitlist has no index here since migration 3 replaces the table with a view over WaitlistEntry, whose keys cover
+    # the same lookups
+    (1, "Secondary indexes for the Loan, LoanHistory and Book access paths", [
+        "CREATE INDEX loan_account_id ON Loan (account_id)",
+        "CREATE INDEX loan_history_account_checkout ON LoanHistory (account_id, checkout_date)",
+        "CREATE INDEX loan_history_return_date ON LoanHistory (return_date)",
+        "CREATE INDEX book_author ON Book (author)",
+        "CREATE INDEX book_publication_year ON Book (publication_year)",
+    ]),
+    (2, "Full-text index for keyword searches over Book title, author and publisher", [
+        "CREATE FULLTEXT INDEX book_fulltext ON Book (title, author, publisher)",
+    ]),
+    # Waitlist entries keep the ticket (seq) they were given when they joined and WaitlistHead tracks the first and last
+    # ticket per isbn, so joining and leaving the front of the line are constant-cost writes. Waitlist becomes a view
+    # that works out place_in_line as seq - head + 1, so readers see the same 1-based places as before.
+    (3, "Store the waitlist as a ticket sequence per ISBN with a head pointer", [
+        "DROP TABLE IF EXISTS WaitlistEntry",
+        "DROP TABLE IF EXISTS WaitlistHead",
+        """
+        CREATE TABLE WaitlistEntry(isbn VARCHAR(16), account_id VARCHAR(16), seq INT, PRIMARY KEY (isbn, account_id),
+                                   UNIQUE KEY waitlist_entry_seq (isbn, seq))
+        """,
+        "CREATE TABLE WaitlistHead(isbn VARCHAR(16) PRIMARY KEY, head INT, tail INT)",
+        "INSERT INTO WaitlistEntry (isbn, account_id, seq) SELECT isbn, account_id, place_in_line FROM Waitlist",
+        """
+        INSERT INTO WaitlistHead (isbn, head, tail)
+        SELECT isbn, MIN(place_in_line), MAX(place_in_line) FROM Waitlist GROUP BY isbn
+        """,
+        "DROP TABLE Waitlist",
+        """
+        CREATE VIEW Waitlist AS
+        SELECT e.isbn, e.account_id, e.seq - h.head + 1 AS place_in_line
+        FROM WaitlistEntry e
+        JOIN WaitlistHead h ON h.isbn = e.isbn
+        """,
+    ]),
+    # Counters kept up to date by db_handler on every checkout, return and waitlist change so number_in_stock and
+    # line_length are single primary-key lookups. db_handler.rebuild_availability() recomputes them.
+    (4, "Per-ISBN availability counters", [
+        "DROP TABLE IF EXISTS BookAvailability",
+        """
+        CREATE TABLE BookAvailability(isbn VARCHAR(16) PRIMARY KEY, num_owned INT, num_checked_out INT,
+                                      waitlist_length INT)
+        """,
+        """
+        INSERT INTO BookAvailability (isbn, num_owned, num_checked_out, waitlist_length)
+        SELECT b.isbn,
+               b.num_owned,
+               (SELECT COUNT(*) FROM Loan l WHERE l.isbn = b.isbn),
+               (SELECT COUNT(*) FROM WaitlistEntry e WHERE e.isbn = b.isbn)
+        FROM Book b
+        """,
+    ]),
+    (5, "Index for the overdue report's due date range scan", [
+        "CREATE INDEX loan_due_date ON Loan (due_date)",
+    ]),
+]
+
+def index_checks() -> list[tuple[str, str, list]]:
+    """
+    returns (name, query, params) for every db_handler query check_indexes looks at: the prepared statements that look
+        rows up and the get_filtered_* (including keyset paging), overdue and full-text queries, built by the same
+        functions db_handler builds them with. The parameters are samples from test_data.
+    """
+    import db_handler as db
+    from models.LoanHistory import LoanHistory
+    from models.Waitlist import Waitlist
+    from models.Book import Book
+    from models.Loan import Loan
+    from models.User import User
+
+    checks = [(name, db.STATEMENTS[name], params) for name, params in [
+        ("get_book", ["0345392876"]),
+        ("get_user", ["e64305789806"]),
+        ("number_in_stock", ["0345392876"]),
+        ("line_length", ["0425042502"]),
+        ("waitlist_head", ["0425042502"]),
+        ("place_in_line", ["0425042502", "602cee84a0f2"]),
+        ("advance_waitlist_head", ["0425042502"]),
+        ("remove_waitlist_head", ["0425042502", "0425042502"]),
+        ("grant_extension", ["0486251217", "e64305789806"]),
+        ("delete_loan", ["0486251217", "e64305789806"]),
+    ]]
+
+    checks += [
+        ("get_filtered_books (author)", *db._books_query(Book(author="Jim Davis"), False, -1, -1)),
+        ("get_filtered_books (publication_year)", *db._books_query(Book(), False, 1995, 1995)),
+        ("get_filtered_books (next page)",
+         *db._books_query(Book(), False, -1, -1, after=db.page_cursor(Book(isbn="0345392876")), limit=20)),
+        ("get_filtered_users (next page)",
+         *db._users_query(User(), False, after=db.page_cursor(User(account_id="e64305789806")), limit=20)),
+        ("get_filtered_loans (account_id)", *db._loans_query(Loan(account_id="e64305789806"), None, None, None, None)),
+        ("get_filtered_loan_histories (account_id, checkout_date)",
+         *db._loan_histories_query(LoanHistory(account_id="1d28dd16861b"), "2000-01-01", None, None, None, None, None)),
+        ("get_filtered_loan_histories (return_date)",
+         *db._loan_histories_query(LoanHistory(), None, None, None, None, "2025-01-01", "2025-01-31")),
+        ("get_filtered_loan_histories (next page)",
+         *db._loan_histories_query(LoanHistory(), None, None, None, None, None, None,
+                                   after=db.page_cursor(LoanHistory(isbn="0486251217", account_id="1d28dd16861b",
+                                                                    checkout_date="2000-01-01")),
+                                   limit=20)),
+        ("get_filtered_waitlist (isbn)", *db._waitlist_query(Waitlist(isbn="0425042502"), -1, -1)),
+        ("overdue_report", *db._overdue_report_query("2000-01-01", 0)),
+        ("search_books_fulltext", *db._search_books_fulltext_query("garfield", 20)),
+    ]
+
+    return checks
+
+
+def current_version(cur) -> int:
+    """
+    returns the highest migration version applied to the database, or 0 if none have been.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS SchemaVersion(version INT PRIMARY KEY, description VARCHAR(128),
+                                                 applied_at DATETIME)
+    """)
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM SchemaVersion")
+    (version,) = cur.fetchone()
+    return version
+
+
+def prepare_reload(cur):
+    """
+    cur - The cursor to use. It must already be using the project database.
+
+    Undoes the migrations so the data/*.sql files can be loaded again from scratch. Migration 3 replaces the Waitlist
+    table with a view, and waitlist.sql's DROP TABLE IF EXISTS doesn't drop views. The tables the migrations create
+    are dropped too, along with the record of which migrations were applied, so a load without migrations doesn't
+    leave them behind out of date.
+    """
+    if get_backend().is_view(cur, "Waitlist"):
+        cur.execute("DROP VIEW Waitlist")
+
+    for table in ["WaitlistEntry", "WaitlistHead", "BookAvailability", "SchemaVersion"]:
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+
+
+def migrate(cur, reset=False, verbose=False) -> int:
+    """
+    cur - The cursor to run the migrations with. It must already be using the project database.
+    reset - If True, forget which migrations have been applied first. load_db does this since it recreates every table.
+    verbose - If True, print each migration as it is applied.
+
+    Applies every migration newer than the current schema version.
+
+    returns the schema version after migrating.
+    """
+    version = current_version(cur)
+
+    if reset:
+        cur.execute("DELETE FROM SchemaVersion")
+        version = 0
+
+    for migration_version, description, statements in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        if verbose:
+            print(f"Applying migration {migration_version}: {description}")
+
+        for statement in statements:
+            cur.execute(statement)
+
+        cur.execute("INSERT INTO SchemaVersion (version, description, applied_at) VALUES (?, ?, NOW())",
+                    [migration_version, description])
+        version = migration_version
+
+    return version
+
+
+def check_indexes(cur) -> list[tuple[str, str, str]]:
+    """
+    cur - The cursor to run EXPLAIN with.
+
+    returns a list of (name, possible_keys, key) for every query in index_checks(). possible_keys is None when no index can
+        be used for the query at all, i.e. it will always be a full table scan. key is the index the optimizer actually
+        picked, which can still be None on tiny tables where a scan is cheaper.
+    """
+    backend = get_backend()
+    return [(name, *backend.explain(cur, query, params)) for name, query, params in index_checks()]
+
+
+def main():
+    conn = get_backend().connect()
+    cur = conn.cursor()
+
+    try:
+        version = migrate(cur, verbose=True)
+        conn.commit()
+        print(f"Schema is at version {version}")
+        print()
+
+        for name, possible_keys, key in check_indexes(cur):
+            status = "OK" if possible_keys else "FULL SCAN"
+            print(f"{status:<10} {name}: possible keys = {possible_keys}, chosen key = {key}")
+
+    finally:
+        cur.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 class Book:
+    __slots__ = ("isbn", "title", "author", "publication_year", "publisher", "num_owned")
+
     def __init__(self,
                  isbn: str = None,
                  title: str = None,
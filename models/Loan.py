@@ -1,4 +1,6 @@
 class Loan:
+    __slots__ = ("isbn", "account_id", "checkout_date", "due_date")
+
     def __init__(self,
                  isbn: str = None,
                  account_id: str = None,
@@ -9,6 +11,16 @@ class Loan:
         self.checkout_date = checkout_date
         self.due_date = due_date
 
+    @classmethod
+    def from_row(cls, isbn, account_id, checkout_date, due_date):
+        """
+        Takes the columns in table order, as returned by a SELECT of every column. Dates are turned into YYYY-mm-dd
+        strings.
+        """
+        return cls(isbn, account_id,
+                   checkout_date.isoformat() if checkout_date else None,
+                   due_date.isoformat() if due_date else None)
+
     def __str__(self):
         self_str = ""
 
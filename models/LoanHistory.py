@@ -1,4 +1,6 @@
 class LoanHistory:
+    __slots__ = ("isbn", "account_id", "checkout_date", "due_date", "return_date")
+
     def __init__(self,
                  isbn: str = None,
                  account_id: str = None,
@@ -11,6 +13,17 @@ class LoanHistory:
         self.due_date = due_date
         self.return_date = return_date
 
+    @classmethod
+    def from_row(cls, isbn, account_id, checkout_date, due_date, return_date):
+        """
+        Takes the columns in table order, as returned by a SELECT of every column. Dates are turned into YYYY-mm-dd
+        strings.
+        """
+        return cls(isbn, account_id,
+                   checkout_date.isoformat() if checkout_date else None,
+                   due_date.isoformat() if due_date else None,
+                   return_date.isoformat() if return_date else None)
+
     def __str__(self):
         self_str = ""
         if self.isbn:
@@ -0,0 +1,64 @@
+class OverdueLoan:
+    __slots__ = ("isbn", "title", "account_id", "name", "email", "phone_number", "checkout_date", "due_date",
+                 "days_overdue")
+
+    def __init__(self,
+                 isbn: str = None,
+                 title: str = None,
+                 account_id: str = None,
+                 name: str = None,
+                 email: str = None,
+                 phone_number: str = None,
+                 checkout_date: str = None,
+                 due_date: str = None,
+                 days_overdue: int = -1):
+        self.isbn = isbn
+        self.title = title
+        self.account_id = account_id
+        self.name = name
+        self.email = email
+        self.phone_number = phone_number
+        self.checkout_date = checkout_date
+        self.due_date = due_date
+        self.days_overdue = days_overdue
+
+    @classmethod
+    def from_row(cls, isbn, title, account_id, name, email, phone_number, checkout_date, due_date, days_overdue):
+        """
+        Takes the columns in __slots__ order. Dates are turned into YYYY-mm-dd strings.
+        """
+        return cls(isbn, title, account_id, name, email, phone_number,
+                   checkout_date.isoformat() if checkout_date else None,
+                   due_date.isoformat() if due_date else None,
+                   days_overdue)
+
+    def __str__(self):
+        self_str = ""
+
+        if self.isbn:
+            self_str += f"ISBN: {self.isbn} \n"
+        if self.title:
+            self_str += f"Title: {self.title} \n"
+        if self.account_id:
+            self_str += f"Account ID: {self.account_id} \n"
+        if self.name:
+            self_str += f"Name: {self.name} \n"
+        if self.email:
+            self_str += f"Email: {self.email} \n"
+        if self.phone_number:
+            self_str += f"Phone Number: {self.phone_number} \n"
+        if self.checkout_date:
+            self_str += f"Checkout Date: {self.checkout_date} \n"
+        if self.due_date:
+            self_str += f"Due Date: {self.due_date} \n"
+        if self.days_overdue > 0:
+            self_str += f"Days Overdue: {self.days_overdue} \n"
+        elif self.days_overdue == 0:
+            self_str += "Due Today \n"
+        else:
+            self_str += f"Due In: {-self.days_overdue} days \n"
+
+        return self_str
+
+    def __eq__(self, other):
+        return self.account_id == other.account_id and self.isbn == other.isbn
@@ -1,4 +1,6 @@
 class User:
+    __slots__ = ("account_id", "name", "address", "phone_number", "email")
+
     def __init__(self,
                  account_id: str = None,
                  name: str = None,
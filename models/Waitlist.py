@@ -1,4 +1,6 @@
 class Waitlist:
+    __slots__ = ("isbn", "account_id", "place_in_line")
+
     def __init__(self,
                  isbn: str = None,
                  account_id: str = None,
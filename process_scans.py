@@ -0,0 +1,87 @@
+import csv
+import db_handler as db
+
+# How many scans are sent to the database per transaction
+BATCH_SIZE = 500
+
+OUTCOME_MESSAGES = {
+    db.RETURN_SUCCESS: "Returned",
+    db.RETURN_NOT_LOANED: "The user does not have the book",
+    db.CHECKOUT_SUCCESS: "Checked out",
+    db.CHECKOUT_ALREADY_HAS: "The user has already checked out the book",
+    db.CHECKOUT_UNAVAILABLE: "Not available, the user is not waitlisted",
+    db.CHECKOUT_STILL_WAITLISTED: "Not available, the user is waitlisted",
+    db.CHECKOUT_NOT_NEXT: "The user is not next in line",
+    db.CHECKOUT_BOOK_NOT_FOUND: "Book not found",
+    db.CHECKOUT_USER_NOT_FOUND: "User not found",
+    db.CHECKOUT_BOOK_AND_USER_NOT_FOUND: "Book and user not found",
+}
+
+
+def read_scans(path):
+    """
+    path - A CSV file with one isbn,account_id scan per line. A header line of isbn,account_id is allowed.
+
+    returns a list of (isbn, account_id) tuples in the order they were scanned.
+    """
+    pairs = []
+
+    with open(path, newline="") as file:
+        for row in csv.reader(file):
+            if len(row) < 2 or row[0].strip().lower() == "isbn":
+                continue
+
+            pairs.append((row[0].strip(), row[1].strip()))
+
+    return pairs
+
+
+def process_scans(path, returning=True, verbose=True):
+    """
+    path - The CSV file of scans to process.
+    returning - If True the scans are returned, otherwise they are checked out.
+    verbose - If True, print the outcome of every scan.
+
+    returns a dict of how many scans ended with each outcome.
+    """
+    pairs = read_scans(path)
+    process_batch = db.return_books if returning else db.checkout_books
+    totals = {}
+
+    for start in range(0, len(pairs), BATCH_SIZE):
+        batch = pairs[start:start + BATCH_SIZE]
+
+        for (isbn, account_id), outcome in zip(batch, process_batch(batch)):
+            totals[outcome] = totals.get(outcome, 0) + 1
+
+            if verbose:
+                print(f"{isbn}, {account_id}: {OUTCOME_MESSAGES[outcome]}")
+
+    return totals
+
+
+def main():
+    path = input("Which CSV file contains the scans: ").strip()
+    returning = input("Are these returns (R) or checkouts (C)? ").strip().upper() != "C"
+
+    try:
+        totals = process_scans(path, returning=returning)
+
+    except FileNotFoundError:
+        print(f"Could not find {path}")
+        return
+
+    except BaseException:
+        db.discard_changes()  # So closing the connection doesn't commit a half-processed batch
+        raise
+
+    finally:
+        db.close_connection()
+
+    print()
+    for outcome, count in totals.items():
+        print(f"{OUTCOME_MESSAGES[outcome]}: {count}")
+
+
+if __name__ == "__main__":
+    main()
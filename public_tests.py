@@ -1,35 +1,103 @@
-from unittest import TestCase, main
+import asyncio
+import json
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main, skipIf
+from unittest.mock import patch
 from datetime import date, timedelta
 from importlib import reload
-from mariadb import connect
+from threading import Thread
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from socket import create_connection
 
+import async_db_handler as async_db
+import backends
 import db_handler as db
+import helper_functions
+import sqlite_backend
 from load_db import load_db
+from migrations import MIGRATIONS, check_indexes, migrate
+import server
 from MARIADB_CREDS import DB_CONFIG
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from models.Book import Book
+from models.Loan import Loan
+from models.LoanHistory import LoanHistory
 from models.User import User
+from models.Waitlist import Waitlist
+
+# Every table with rows the tests can change. Waitlist is a view over WaitlistEntry and WaitlistHead.
+SNAPSHOT_TABLES = ["Book", "User", "Loan", "LoanHistory", "WaitlistEntry", "WaitlistHead", "BookAvailability"]
+
+
+def commits(test):
+    """
+    Marks a test that commits, or runs DDL (which commits implicitly), so rolling it back isn't enough. The tables are
+    restored from the snapshot after it instead.
+    """
+    test.commits = True
+    return test
+
+
+def take_snapshot(cur):
+    """
+    Copies every SNAPSHOT_TABLES table to <table>Snapshot.
+    """
+    for table in SNAPSHOT_TABLES:
+        cur.execute(f"DROP TABLE IF EXISTS {table}Snapshot")
+        cur.execute(f"CREATE TABLE {table}Snapshot LIKE {table}")
+        cur.execute(f"INSERT INTO {table}Snapshot SELECT * FROM {table}")
+
+
+def restore_snapshot(cur):
+    """
+    Puts the rows of every SNAPSHOT_TABLES table back the way they were when take_snapshot was called.
+    """
+    for table in SNAPSHOT_TABLES:
+        cur.execute(f"DELETE FROM {table}")
+        cur.execute(f"INSERT INTO {table} SELECT * FROM {table}Snapshot")
 
 
 class PublicTests(TestCase):
-    # Constructor
+    # Constructor. test_data/ is only loaded once, each test's changes are undone afterwards in tearDown.
     @classmethod
     def setUpClass(cls):
         cls.db = reload(db)
         cls.data_dir = "test_data/"
+        load_db(parent_cur=cls.db.cur, parent_conn=cls.db.conn, data_dir=cls.data_dir, verbose=False)
+        take_snapshot(cls.db.cur)
+        cls.db.save_changes()
 
 
     # Destructor
     @classmethod
     def tearDownClass(cls):
-        load_db(parent_cur=cls.db.cur, parent_conn= cls.db.conn, data_dir=cls.data_dir, verbose=False)
+        for table in SNAPSHOT_TABLES:
+            cls.db.cur.execute(f"DROP TABLE IF EXISTS {table}Snapshot")
         cls.db.cur.close()
         cls.db.conn.close()
 
 
     # Runs before every test
     def setUp(self):
-        load_db(parent_cur=self.db.cur, parent_conn= self.db.conn, data_dir=self.data_dir, verbose=False)
+        self.db.clear_cache()
+
+
+    # Runs after every test
+    def tearDown(self):
+        self.db.discard_changes()
+
+        if getattr(getattr(self, self._testMethodName), "commits", False):
+            restore_snapshot(self.db.cur)
+            self.db.save_changes()
 
 
     @staticmethod
@@ -153,6 +221,29 @@ class PublicTests(TestCase):
                 self.fail("Unexpected account ID")
 
 
+    def test_waitlist_queue(self):
+        isbn = "0425042502"
+        new_account_id = "f0bcbb3befe9"
+
+        self.db.update_waitlist(isbn=isbn)
+        place_in_line = self.db.waitlist_user(isbn=isbn, account_id=new_account_id)
+
+        self.assertEqual(3, place_in_line)
+        self.assertEqual(3, self.db.line_length(isbn))
+        self.assertEqual(1, self.db.place_in_line(isbn=isbn, account_id="602cee84a0f2"))
+        self.assertEqual(3, self.db.place_in_line(isbn=isbn, account_id=new_account_id))
+
+        waitlist = self.db.get_filtered_waitlist(filter_attributes=Waitlist(isbn=isbn), min_place_in_line=3)
+        self.assertEqual([new_account_id], [entry.account_id for entry in waitlist])
+
+        for _ in range(3):
+            self.db.update_waitlist(isbn=isbn)
+        self.db.update_waitlist(isbn=isbn)
+
+        self.assertEqual(0, self.db.line_length(isbn))
+        self.assertEqual(1, self.db.waitlist_user(isbn=isbn, account_id=new_account_id))
+
+
     def test_return_book(self):
         isbn = "0451521633"
         account_id = "a81fe582ce09"
@@ -177,13 +268,65 @@ class PublicTests(TestCase):
         self.assertIsNone(self.db.cur.fetchone())
 
 
+    @commits
+    def test_return_books(self):
+        pairs = [("0451521633", "a81fe582ce09"), ("0486251217", "e64305789806"), ("0451521633", "a81fe582ce09"),
+                 (self.get_book().isbn, self.get_user().account_id), ("not_an_isbn", self.get_user().account_id)]
+
+        outcomes = self.db.return_books(pairs)
+
+        self.assertEqual([self.db.RETURN_SUCCESS, self.db.RETURN_SUCCESS, self.db.RETURN_NOT_LOANED,
+                          self.db.RETURN_NOT_LOANED, self.db.RETURN_BOOK_NOT_FOUND], outcomes)
+
+        for isbn, account_id in pairs[:2]:
+            self.db.cur.execute("SELECT * FROM Loan WHERE isbn = %s AND account_id = %s", (isbn, account_id))
+            self.assertIsNone(self.db.cur.fetchone())
+
+            self.db.cur.execute("SELECT return_date FROM LoanHistory WHERE isbn = %s AND account_id = %s",
+                                (isbn, account_id))
+            self.assertEqual(date.today().isoformat(), self.db.cur.fetchone()[0].isoformat())
+
+
+    @commits
+    def test_return_books_rolls_back(self):
+        # The second scan is too long for any isbn column, so it should only fail on its own
+        pairs = [("0451521633", "a81fe582ce09"), ("0" * 40, "a81fe582ce09")]
+
+        # Fail after the loans have been moved to LoanHistory
+        with patch.object(self.db, "_mark_dirty", side_effect=self.db.Error("_mark_dirty failed")):
+            with self.assertRaises(self.db.Error):
+                self.db.return_books(pairs)
+
+        with self.db.Session() as session:
+            self.assertTrue(self.db.loan_exists(isbn="0451521633", account_id="a81fe582ce09", session=session))
+
+        self.assertEqual([self.db.RETURN_SUCCESS, self.db.RETURN_BOOK_NOT_FOUND], self.db.return_books(pairs))
+
+
+    @commits
+    def test_checkout_books(self):
+        isbn = self.get_book().isbn
+        account_id = self.get_user().account_id
+
+        outcomes = self.db.checkout_books([(isbn, account_id), (isbn, account_id), ("0425042502", account_id)])
+
+        self.assertEqual(self.db.CHECKOUT_SUCCESS, outcomes[0])
+        self.assertEqual(self.db.CHECKOUT_ALREADY_HAS, outcomes[1])
+        self.assertIn(outcomes[2], (self.db.CHECKOUT_NOT_NEXT, self.db.CHECKOUT_UNAVAILABLE))
+
+        self.db.cur.execute("SELECT COUNT(*) FROM Loan WHERE isbn = %s AND account_id = %s", (isbn, account_id))
+        self.assertEqual(1, self.db.cur.fetchone()[0])
+
+
     def test_grant_extension(self):
         isbn = "0486251217"
         account_id = "e64305789806"
         checkout_date = date.today().isoformat()
         new_due_date = (date.today() + timedelta(weeks=4)).isoformat()
 
-        self.db.grant_extension(isbn=isbn, account_id=account_id)
+        self.assertEqual(self.db.EXTENSION_GRANTED, self.db.grant_extension(isbn=isbn, account_id=account_id))
+        self.assertEqual(self.db.EXTENSION_ALREADY_EXTENDED, self.db.grant_extension(isbn=isbn, account_id=account_id))
+        self.assertEqual(self.db.EXTENSION_NOT_LOANED, self.db.grant_extension(isbn="not_an_isbn", account_id=account_id))
 
         self.db.cur.execute("SELECT isbn, account_id, checkout_date, due_date "
                             "FROM Loan WHERE isbn = %s AND account_id = %s ", (isbn, account_id))
@@ -196,6 +339,70 @@ class PublicTests(TestCase):
         self.assertEqual(new_due_date, loan[3].isoformat())
 
 
+    def test_overdue_report(self):
+        today = date.today().isoformat()
+        overdue_loans = self.db.get_filtered_loans(filter_attributes=Loan(), max_due_date=today)
+
+        report = list(self.db.overdue_report(as_of=today, chunk_size=2))
+
+        self.assertEqual(sorted((loan.isbn, loan.account_id) for loan in overdue_loans),
+                         sorted((entry.isbn, entry.account_id) for entry in report))
+        for entry in report:
+            self.assertEqual((date.today() - date.fromisoformat(entry.due_date)).days, entry.days_overdue)
+            self.assertEqual(self.db.get_user(entry.account_id).name, entry.name)
+            self.assertEqual(self.db.get_book(entry.isbn).title, entry.title)
+
+        due_soon = list(self.db.overdue_report(as_of=today, due_within_days=14))
+        self.assertGreaterEqual(len(due_soon), len(report))
+        self.assertTrue(all(entry.days_overdue >= -14 for entry in due_soon))
+
+
+    @commits
+    def test_try_checkout(self):
+        isbn = self.get_book().isbn
+        account_id = self.get_user().account_id
+
+        outcome, place_in_line = self.db.try_checkout(isbn=isbn, account_id=account_id)
+
+        self.assertEqual(self.db.CHECKOUT_SUCCESS, outcome)
+        self.assertEqual(-1, place_in_line)
+
+        self.db.cur.execute("SELECT isbn FROM Loan WHERE isbn = %s AND account_id = %s", (isbn, account_id))
+        self.assertIsNotNone(self.db.cur.fetchone())
+
+        outcome, _ = self.db.try_checkout(isbn=isbn, account_id=account_id)
+        self.assertEqual(self.db.CHECKOUT_ALREADY_HAS, outcome)
+
+        outcome, _ = self.db.try_checkout(isbn="not_an_isbn", account_id=account_id)
+        self.assertEqual(self.db.CHECKOUT_BOOK_NOT_FOUND, outcome)
+
+
+    def test_try_checkout_rolls_back(self):
+        isbn = self.get_book().isbn
+        account_id = self.get_user().account_id
+        expected_stock = self.db.number_in_stock(isbn=isbn)
+
+        # Fail after checkout_book has inserted the Loan
+        with patch.object(self.db, "update_waitlist", side_effect=self.db.Error("update_waitlist failed")):
+            with self.assertRaises(self.db.Error):
+                self.db.try_checkout(isbn=isbn, account_id=account_id)
+
+        with self.db.Session() as session:
+            self.assertFalse(self.db.loan_exists(isbn=isbn, account_id=account_id, session=session))
+            self.assertEqual(expected_stock, self.db.number_in_stock(isbn=isbn, session=session))
+
+
+    @commits
+    def test_try_checkout_not_next(self):
+        isbn = "0425042502"
+        account_id = "602cee84a0f2"
+
+        outcome, place_in_line = self.db.try_checkout(isbn=isbn, account_id=account_id)
+
+        self.assertIn(outcome, (self.db.CHECKOUT_NOT_NEXT, self.db.CHECKOUT_STILL_WAITLISTED))
+        self.assertEqual(2, place_in_line)
+
+
     def test_get_filtered_books(self):
         expected_book = self.get_book()
 
@@ -234,6 +441,104 @@ class PublicTests(TestCase):
         self.assertEqual(expected_book.num_owned, actual_book.num_owned)
 
 
+    def test_iter_filtered_books(self):
+        all_books = self.db.get_filtered_books(filter_attributes=Book())
+        streamed_books = list(self.db.iter_filtered_books(filter_attributes=Book(), chunk_size=3))
+
+        self.assertEqual(len(all_books), len(streamed_books))
+        self.assertEqual([book.isbn for book in all_books], [book.isbn for book in streamed_books])
+
+
+    def test_get_filtered_books_pages(self):
+        all_books = self.db.get_filtered_books(filter_attributes=Book(), order_by="author")
+        paged_books = []
+        after = None
+
+        while True:
+            page = self.db.get_filtered_books(filter_attributes=Book(), order_by="author", limit=7, after=after)
+            paged_books += page
+
+            if len(page) < 7:
+                break
+
+            after = self.db.page_cursor(page[-1], order_by="author")
+
+        self.assertEqual([book.isbn for book in all_books], [book.isbn for book in paged_books])
+
+
+    @skipIf(numpy is None, "numpy is not installed")
+    def test_get_loan_histories_columnar(self):
+        histories = self.db.get_filtered_loan_histories(filter_attributes=LoanHistory())
+        columns = self.db.get_loan_histories_columnar(filter_attributes=LoanHistory(), chunk_size=3)
+
+        self.assertEqual(len(histories), len(columns.isbn))
+        self.assertEqual([history.isbn for history in histories],
+                         columns.isbn_categories[columns.isbn].tolist())
+        self.assertEqual([history.account_id for history in histories],
+                         columns.account_id_categories[columns.account_id].tolist())
+        self.assertEqual([history.checkout_date for history in histories],
+                         [str(checkout_date) for checkout_date in columns.checkout_date])
+
+        stats = self.db.loan_history_stats(columns)
+        self.assertEqual(len(histories), sum(stats["loans_per_isbn"].values()))
+
+
+    def test_search_books_fulltext(self):
+        expected_book = self.get_book()
+
+        results = self.db.search_books_fulltext(query="Garfield Dishes", limit=5)
+
+        self.assertLessEqual(len(results), 5)
+        self.assertEqual(expected_book.isbn, results[0].isbn)
+
+
+    def test_lookup_cache(self):
+        original_account_id = "0cf25a005473"
+        new_user = User(account_id="test_id")
+
+        self.assertIsNotNone(self.db.get_user(original_account_id))
+        self.assertIsNotNone(self.db.get_user(original_account_id))
+        self.assertIsNone(self.db.get_user(new_user.account_id))
+        self.assertEqual({"size": 2, "hits": 1, "misses": 2}, self.db.cache_stats()["user"])
+
+        self.db.edit_user(original_account_id=original_account_id, new_user=new_user)
+
+        self.assertIsNone(self.db.get_user(original_account_id))
+        self.assertEqual(new_user.account_id, self.db.get_user(new_user.account_id).account_id)
+
+
+    def test_exists_checks(self):
+        isbn = self.get_book().isbn
+        account_id = self.get_user().account_id
+
+        self.assertTrue(self.db.book_exists(isbn))
+        self.assertFalse(self.db.book_exists("not_an_isbn"))
+        self.assertTrue(self.db.user_exists(account_id))
+        self.assertFalse(self.db.user_exists("not_an_id"))
+        self.assertEqual((True, False), self.db.book_and_user_exist(isbn, "not_an_id"))
+        self.assertTrue(self.db.loan_exists("0486251217", "e64305789806"))
+        self.assertFalse(self.db.loan_exists(isbn, account_id))
+
+
+    def test_desk_checks_use_cache(self):
+        isbn, account_id = "0312285329", "e64305789806"
+
+        self.assertTrue(helper_functions.check_if_book_and_user_exists(isbn, account_id))
+        self.assertFalse(helper_functions.check_if_book_exists("not_an_isbn"))
+
+        # The second round of checks is answered from the caches without going to the database
+        went_to_database = AssertionError("The check went to the database")
+        with patch.object(self.db, "_execute", side_effect=went_to_database), \
+                patch.object(self.db, "_cursor", side_effect=went_to_database):
+            self.assertTrue(helper_functions.check_if_book_and_user_exists(isbn, account_id))
+            self.assertTrue(helper_functions.check_if_book_exists(isbn))
+            self.assertTrue(helper_functions.check_if_user_exists(account_id))
+            self.assertFalse(helper_functions.check_if_book_exists("not_an_isbn"))
+
+        self.assertEqual({"size": 2, "hits": 3, "misses": 2}, self.db.cache_stats()["book"])
+        self.assertEqual({"size": 1, "hits": 2, "misses": 1}, self.db.cache_stats()["user"])
+
+
     def test_number_in_stock(self):
         isbn = "0312285329"
         expected_num_in_stock = 4
@@ -243,6 +548,26 @@ class PublicTests(TestCase):
         self.assertEqual(expected_num_in_stock, actual_num_in_stock)
 
 
+    def test_availability_counters(self):
+        isbn = "0312285329"
+        account_id = self.get_user().account_id
+
+        self.db.checkout_book(isbn, account_id)
+        self.assertEqual(3, self.db.number_in_stock(isbn))
+
+        self.db.return_book(isbn=isbn, account_id=account_id)
+        self.assertEqual(4, self.db.number_in_stock(isbn))
+
+        self.db.waitlist_user(isbn=isbn, account_id=account_id)
+        self.assertEqual(1, self.db.line_length(isbn))
+        self.assertEqual([], self.db.check_availability())
+
+        self.db.cur.execute("UPDATE BookAvailability SET num_checked_out = 0 WHERE isbn = %s", (isbn,))
+        self.assertEqual([isbn], self.db.check_availability())
+        self.assertEqual(1, self.db.rebuild_availability())
+        self.assertEqual([], self.db.check_availability())
+
+
     def test_place_in_line(self):
         isbn = "0425042502"
         account_id = "602cee84a0f2"
@@ -261,6 +586,175 @@ class PublicTests(TestCase):
         self.assertEqual(expected_line_length, actual_line_length)
 
 
+    @commits
+    def test_load_db_bulk(self):
+        load_db(parent_cur=self.db.cur, parent_conn=self.db.conn, data_dir=self.data_dir, verbose=False, bulk=True,
+                batch_size=7)
+
+        for table, filename in [("Book", "book.sql"), ("User", "user.sql"), ("Loan", "loan.sql"),
+                                ("LoanHistory", "loan_history.sql"), ("Waitlist", "waitlist.sql")]:
+            with open(self.data_dir + filename) as file:
+                expected_rows = sum(1 for line in file if line.startswith("INSERT"))
+
+            self.db.cur.execute(f"SELECT COUNT(*) FROM {table}")
+            self.assertEqual(expected_rows, self.db.cur.fetchone()[0])
+
+        self.assertEqual(self.get_book().title, self.db.get_filtered_books(self.get_book())[0].title)
+
+
+    @commits
+    def test_session(self):
+        new_user = self.get_user()
+        new_user.account_id = "test_id"
+
+        with self.db.Session() as session:
+            self.db.add_user(new_user=new_user, session=session)
+            found_users = self.db.get_filtered_users(User(account_id=new_user.account_id), session=session)
+
+        self.assertEqual(1, len(found_users))
+        self.assertEqual(new_user.name, found_users[0].name)
+
+        self.db.cur.execute("SELECT name FROM User WHERE account_id = %s", (new_user.account_id,))
+        self.assertEqual(new_user.name, self.db.cur.fetchone()[0])
+
+
+    def test_session_after_reload(self):
+        with self.db.Session() as session:
+            self.db.number_in_stock(isbn="0425042502", session=session)
+
+        # A reload forgets the pool, but the connector still has it registered until it is closed
+        old_conn = self.db.conn
+        self.db = reload(db)
+        old_conn.close()
+
+        with self.db.Session() as session:
+            self.assertEqual(self.db.number_in_stock(isbn="0425042502"),
+                             self.db.number_in_stock(isbn="0425042502", session=session))
+
+
+    def test_prepared_statements(self):
+        isbn = "0425042502"
+        expected_stock = self.db.number_in_stock(isbn=isbn)
+
+        with self.db.Session() as session:
+            for _ in range(3):
+                self.assertEqual(expected_stock, self.db.number_in_stock(isbn=isbn, session=session))
+
+            self.assertEqual(["number_in_stock"], list(session.statements))
+
+        self.assertEqual({}, session.statements)
+
+
+    @commits
+    def test_commit_policy(self):
+        new_user = self.get_user()
+        session = self.db.Session()
+        self.db.set_commit_policy(self.db.COMMIT_GROUP, group_size=2, group_interval_ms=60000, session=session)
+
+        self.assertFalse(self.db.commit_pending(session=session))  # Nothing written yet
+        self.assertEqual(4, self.db.number_in_stock(isbn="0312285329", session=session))
+        self.assertFalse(self.db.commit_pending(session=session))  # Reads don't make the connection dirty
+
+        new_user.account_id = "test_id_1"
+        self.db.add_user(new_user=new_user, session=session)
+        self.assertFalse(self.db.commit_pending(session=session))
+
+        new_user.account_id = "test_id_2"
+        self.db.add_user(new_user=new_user, session=session)
+        self.assertTrue(self.db.commit_pending(session=session))
+
+        new_user.account_id = "test_id_3"
+        self.db.add_user(new_user=new_user, session=session)
+        self.assertTrue(session.commit_policy.dirty)
+        self.db.close_connection(session=session)  # Flushes test_id_3
+
+        self.db.save_changes()  # End the module connection's transaction so it sees the session's commits
+        for account_id in ["test_id_1", "test_id_2", "test_id_3"]:
+            self.assertTrue(self.db.user_exists(account_id=account_id))
+
+
+    @commits
+    def test_commit_policy_locking_operations(self):
+        isbn = self.get_book().isbn
+        account_id = self.get_user().account_id
+
+        with self.db.Session() as session:
+            self.db.set_commit_policy(self.db.COMMIT_EXPLICIT, session=session)
+            self.assertEqual(self.db.CHECKOUT_SUCCESS,
+                             self.db.try_checkout(isbn=isbn, account_id=account_id, session=session)[0])
+
+            # Committed straight away, so the BookAvailability row isn't left locked until the next explicit commit
+            self.assertFalse(session.commit_policy.dirty)
+            self.db.save_changes()  # End the module connection's transaction so it sees the session's commit
+            self.assertTrue(self.db.loan_exists(isbn=isbn, account_id=account_id))
+
+
+    def test_async_db_handler(self):
+        isbn = "0312285329"
+        expected_num_in_stock = self.db.number_in_stock(isbn)
+        expected_books = self.db.get_filtered_books(filter_attributes=Book(author="Jim Davis"))
+
+        async def run():
+            nums_in_stock = await asyncio.gather(*(async_db.number_in_stock(isbn=isbn) for _ in range(10)))
+            books = await async_db.get_filtered_books(filter_attributes=Book(author="Jim Davis"))
+            streamed_books = [book async for book in async_db.iter_filtered_books(filter_attributes=Book(),
+                                                                                  chunk_size=3)]
+            return nums_in_stock, books, streamed_books
+
+        nums_in_stock, books, streamed_books = asyncio.run(run())
+
+        self.assertEqual([expected_num_in_stock] * 10, nums_in_stock)
+        self.assertEqual([book.isbn for book in expected_books], [book.isbn for book in books])
+        self.assertEqual(len(self.db.get_filtered_books(filter_attributes=Book())), len(streamed_books))
+
+
+    @commits
+    def test_server(self):
+        http_server = server.make_server(port=0)  # Any free port
+        Thread(target=http_server.serve_forever, daemon=True).start()
+        base_url = f"http://{server.HOST}:{http_server.server_port}"
+        expected_book = self.get_book()
+
+        try:
+            with urlopen(f"{base_url}/books?author=Jim%20Davis") as response:
+                books = json.loads(response.read())
+            self.assertEqual(len(self.db.get_filtered_books(filter_attributes=Book(author="Jim Davis"))), len(books))
+
+            request = Request(f"{base_url}/books", data=json.dumps(server.to_json(expected_book)).encode(),
+                              method="POST", headers={"Content-Type": "application/json"})
+            with urlopen(request) as response:
+                self.assertEqual(expected_book.isbn, json.loads(response.read())["isbn"])
+
+            self.db.save_changes()  # End the module connection's transaction so it sees the server's commit
+            self.assertTrue(self.db.book_exists(isbn=expected_book.isbn))
+
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+
+
+    def test_instrumentation(self):
+        self.db.enable_instrumentation()
+        try:
+            self.db.number_in_stock(isbn="0312285329")
+            books = self.db.get_filtered_books(filter_attributes=Book(author="Jim Davis"))
+            stats = {entry["operation"]: entry for entry in self.db.query_stats()}
+        finally:
+            self.db.disable_instrumentation()
+
+        self.assertEqual(1, stats["number_in_stock"]["count"])
+        self.assertEqual(1, stats["number_in_stock"]["rows"])
+        self.assertEqual(len(books), stats["get_filtered_books"]["rows"])
+        self.assertEqual(1, sum(stats["get_filtered_books"]["histogram"]))
+        self.assertEqual([], self.db.query_stats())
+
+
+    def test_indexes(self):
+        for name, possible_keys, key in check_indexes(self.db.cur):
+            self.assertIsNotNone(possible_keys, f"{name} can't use an index")
+
+
+    @commits
     def test_save_changes(self):
         test_account_id = 'test_id'
         self.db.cur.execute("INSERT INTO User (account_id) VALUES (%s)", (test_account_id,))
@@ -276,6 +770,8 @@ class PublicTests(TestCase):
 
 
     def test_close_connection(self):
+        from mariadb import connect
+
         temp_conn = connect(user=DB_CONFIG["username"], password=DB_CONFIG["password"], host=DB_CONFIG["host"],
                        database=DB_CONFIG["database"], port=DB_CONFIG["port"])
         temp_cur = temp_conn.cursor()
@@ -293,5 +789,288 @@ class PublicTests(TestCase):
         self.db = reload(db)
 
 
+class SQLiteTests(TestCase):
+    # The same db_handler API on the embedded SQLite backend, in a throwaway file. test_data/ is loaded before every
+    # test since that takes milliseconds in-process.
+    @classmethod
+    def setUpClass(cls):
+        cls.saved_config = dict(DB_CONFIG)
+        cls.directory = TemporaryDirectory()
+        DB_CONFIG["backend"] = backends.BACKEND_SQLITE
+        DB_CONFIG["sqlite_path"] = os.path.join(cls.directory.name, "test.sqlite3")
+        cls.db = reload(db)
+        cls.data_dir = "test_data/"
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close_connection()
+        cls.directory.cleanup()
+        DB_CONFIG.clear()
+        DB_CONFIG.update(cls.saved_config)
+
+
+    def setUp(self):
+        load_db(parent_cur=self.db.cur, parent_conn=self.db.conn, data_dir=self.data_dir, verbose=False)
+        self.db.clear_cache()
+
+
+    def test_translate(self):
+        sql, locking = sqlite_backend.translate(self.db.STATEMENTS["checkout_book"])
+        self.assertIn("date(date('now', 'localtime'), '14 days')", sql)
+        self.assertFalse(locking)
+
+        sql, locking = sqlite_backend.translate("SELECT * FROM BookAvailability WHERE isbn = ? FOR UPDATE")
+        self.assertEqual("SELECT * FROM BookAvailability WHERE isbn = ?", sql)
+        self.assertTrue(locking)
+
+        sql, _ = sqlite_backend.translate("DELETE e FROM WaitlistEntry e JOIN WaitlistHead h ON h.isbn = e.isbn "
+                                    "WHERE e.isbn = ?")
+        self.assertEqual("DELETE FROM WaitlistEntry AS e WHERE EXISTS (SELECT 1 FROM WaitlistHead h "
+                         "WHERE h.isbn = e.isbn AND (e.isbn = ?))", sql)
+
+
+    def test_checkout_and_return(self):
+        isbn = PublicTests.get_book().isbn
+        account_id = PublicTests.get_user().account_id
+        expected_stock = self.db.number_in_stock(isbn=isbn)
+
+        self.assertEqual((self.db.CHECKOUT_SUCCESS, -1), self.db.try_checkout(isbn=isbn, account_id=account_id))
+        self.assertEqual(expected_stock - 1, self.db.number_in_stock(isbn=isbn))
+
+        (loan,) = self.db.get_filtered_loans(filter_attributes=Loan(isbn=isbn, account_id=account_id))
+        self.assertEqual(date.today().isoformat(), loan.checkout_date)
+        self.assertEqual((date.today() + timedelta(weeks=2)).isoformat(), loan.due_date)
+
+        self.assertEqual(self.db.EXTENSION_GRANTED, self.db.grant_extension(isbn=isbn, account_id=account_id))
+        self.assertEqual(self.db.EXTENSION_ALREADY_EXTENDED, self.db.grant_extension(isbn=isbn, account_id=account_id))
+        (loan,) = self.db.get_filtered_loans(filter_attributes=Loan(isbn=isbn, account_id=account_id))
+        self.assertEqual((date.today() + timedelta(weeks=4)).isoformat(), loan.due_date)
+
+        self.assertEqual([self.db.RETURN_SUCCESS, self.db.RETURN_BOOK_NOT_FOUND],
+                         self.db.return_books([(isbn, account_id), ("not_an_isbn", account_id)]))
+        (history,) = self.db.get_filtered_loan_histories(filter_attributes=LoanHistory(isbn=isbn,
+                                                                                       account_id=account_id))
+        self.assertEqual(date.today().isoformat(), history.return_date)
+        self.assertEqual([], self.db.check_availability())
+
+
+    def test_try_checkout_rolls_back(self):
+        isbn = PublicTests.get_book().isbn
+        account_id = PublicTests.get_user().account_id
+        expected_stock = self.db.number_in_stock(isbn=isbn)
+
+        with patch.object(self.db, "update_waitlist", side_effect=self.db.Error("update_waitlist failed")):
+            with self.assertRaises(self.db.Error):
+                self.db.try_checkout(isbn=isbn, account_id=account_id)
+
+        with self.db.Session() as session:
+            self.assertFalse(self.db.loan_exists(isbn=isbn, account_id=account_id, session=session))
+            self.assertEqual(expected_stock, self.db.number_in_stock(isbn=isbn, session=session))
+
+
+    def test_desk_checks_use_cache(self):
+        isbn, account_id = "0312285329", "e64305789806"
+
+        self.assertTrue(helper_functions.check_if_book_and_user_exists(isbn, account_id))
+        self.assertFalse(helper_functions.check_if_book_exists("not_an_isbn"))
+
+        # The second round of checks is answered from the caches without going to the database
+        went_to_database = AssertionError("The check went to the database")
+        with patch.object(self.db, "_execute", side_effect=went_to_database), \
+                patch.object(self.db, "_cursor", side_effect=went_to_database):
+            self.assertTrue(helper_functions.check_if_book_and_user_exists(isbn, account_id))
+            self.assertTrue(helper_functions.check_if_book_exists(isbn))
+            self.assertTrue(helper_functions.check_if_user_exists(account_id))
+            self.assertFalse(helper_functions.check_if_book_exists("not_an_isbn"))
+
+        self.assertEqual({"size": 2, "hits": 3, "misses": 2}, self.db.cache_stats()["book"])
+        self.assertEqual({"size": 1, "hits": 2, "misses": 1}, self.db.cache_stats()["user"])
+
+
+    def test_waitlist(self):
+        isbn = "0425042502"
+        new_account_id = "f0bcbb3befe9"
+
+        self.assertEqual(4, self.db.waitlist_user(isbn=isbn, account_id=new_account_id))
+        self.db.update_waitlist(isbn=isbn)
+
+        self.assertEqual(3, self.db.line_length(isbn))
+        self.assertEqual(3, self.db.place_in_line(isbn=isbn, account_id=new_account_id))
+
+
+    def test_checkout_books(self):
+        isbn = PublicTests.get_book().isbn
+        account_id = PublicTests.get_user().account_id
+
+        outcomes = self.db.checkout_books([(isbn, account_id), (isbn, account_id), ("0425042502", account_id)])
+
+        self.assertEqual([self.db.CHECKOUT_SUCCESS, self.db.CHECKOUT_ALREADY_HAS], outcomes[:2])
+        self.assertIn(outcomes[2], (self.db.CHECKOUT_NOT_NEXT, self.db.CHECKOUT_UNAVAILABLE))
+        self.assertEqual([], self.db.check_availability())
+
+
+    def test_return_books_rolls_back(self):
+        pairs = [("0451521633", "a81fe582ce09"), ("0" * 40, "a81fe582ce09")]
+
+        with patch.object(self.db, "_mark_dirty", side_effect=self.db.Error("_mark_dirty failed")):
+            with self.assertRaises(self.db.Error):
+                self.db.return_books(pairs)
+
+        with self.db.Session() as session:
+            self.assertTrue(self.db.loan_exists(isbn="0451521633", account_id="a81fe582ce09", session=session))
+
+        self.assertEqual([self.db.RETURN_SUCCESS, self.db.RETURN_BOOK_NOT_FOUND], self.db.return_books(pairs))
+
+
+    def test_async_streams_and_calls(self):
+        isbn = "0312285329"
+        expected_num_in_stock = self.db.number_in_stock(isbn)
+
+        async def run():
+            # Every pooled connection is held by an open stream, then as many plain calls are made as there are workers
+            streams = [async_db.iter_filtered_books(filter_attributes=Book(), chunk_size=1)
+                       for _ in range(self.db.POOL_SIZE)]
+            for stream in streams:
+                await anext(stream)
+
+            calls = asyncio.gather(*(async_db.number_in_stock(isbn=isbn) for _ in range(self.db.POOL_SIZE)))
+            streamed = [[book async for book in stream] for stream in streams]
+            return await asyncio.wait_for(calls, timeout=10), streamed
+
+        nums_in_stock, streamed = asyncio.run(asyncio.wait_for(run(), timeout=20))
+
+        self.assertEqual([expected_num_in_stock] * self.db.POOL_SIZE, nums_in_stock)
+        self.assertTrue(all(streamed))
+
+
+    def test_server_stream_error(self):
+        def failing_search(filter_attributes, session):
+            yield Book(isbn="0312285329")
+            raise self.db.Error("lost the connection")
+
+        http_server = server.make_server(port=0)
+        Thread(target=http_server.serve_forever, daemon=True).start()
+
+        try:
+            with patch.dict(server.SEARCHES, {"/books": (Book, failing_search, set())}), \
+                    create_connection((server.HOST, http_server.server_port), timeout=5) as connection:
+                connection.sendall(b"GET /books HTTP/1.1\r\nHost: localhost\r\n\r\n")
+
+                # Read until the server closes the connection, which it should do as soon as the search fails
+                response = b""
+                while data := connection.recv(65536):
+                    response += data
+
+            # The 200 was already sent, so the body is cut off rather than followed by a second status line
+            self.assertTrue(response.startswith(b"HTTP/1.1 200"))
+            self.assertEqual(1, response.count(b"HTTP/1.1"))
+            self.assertFalse(response.endswith(b"0\r\n\r\n"))  # The chunked body was never ended
+
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+
+
+    def test_server_search_params(self):
+        http_server = server.make_server(port=0)
+        Thread(target=http_server.serve_forever, daemon=True).start()
+        base_url = f"http://{server.HOST}:{http_server.server_port}"
+
+        try:
+            with urlopen(f"{base_url}/books?publication_year=1995") as response:
+                books = json.loads(response.read())
+            expected_books = self.db.get_filtered_books(filter_attributes=Book(), min_publication_year=1995,
+                                                     max_publication_year=1995)
+            self.assertEqual(sorted(book.isbn for book in expected_books), sorted(book["isbn"] for book in books))
+            self.assertLess(len(books), len(self.db.get_filtered_books(filter_attributes=Book())))
+
+            for path in ["/books?limit=5", "/users?title=Garfield", "/overdue?author=Jim%20Davis"]:
+                with self.assertRaises(HTTPError) as raised:
+                    urlopen(base_url + path)
+                self.assertEqual(400, raised.exception.code)
+                self.assertIn("doesn't support", json.loads(raised.exception.read())["error"])
+
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+
+
+    def test_load_db_without_migrations(self):
+        load_db(parent_cur=self.db.cur, parent_conn=self.db.conn, data_dir=self.data_dir, verbose=False,
+                run_migrations=False)
+
+        # Nothing is left over from the migrations of the previous load, so migrating again starts from scratch
+        self.db.cur.execute("SELECT name FROM sqlite_master WHERE name IN "
+                            "('WaitlistEntry', 'WaitlistHead', 'BookAvailability', 'SchemaVersion')")
+        self.assertEqual([], self.db.cur.fetchall())
+        self.assertEqual(MIGRATIONS[-1][0], migrate(self.db.cur))
+        self.assertEqual(self.db.line_length(isbn="0425042502"), len(self.db.get_filtered_waitlist(
+            filter_attributes=Waitlist(isbn="0425042502"))))
+
+
+    def test_indexes(self):
+        for name, possible_keys, key in check_indexes(self.db.cur):
+            if name != "search_books_fulltext":  # SQLite has no full-text index, it is a scan with match_against
+                self.assertIsNotNone(key, f"{name} doesn't use an index")
+
+
+    def test_searches(self):
+        expected_book = PublicTests.get_book()
+
+        self.assertEqual(expected_book.isbn, self.db.search_books_fulltext(query="Garfield Dishes", limit=5)[0].isbn)
+
+        # MariaDB compares strings case-insensitively, and so does the SQLite backend
+        books = self.db.get_filtered_books(filter_attributes=Book(title=expected_book.title.upper()))
+        self.assertEqual([expected_book.isbn], [book.isbn for book in books])
+
+        books = self.db.get_filtered_books(filter_attributes=Book(author="jim%"), use_patterns=True)
+        self.assertTrue(books)
+        self.assertTrue(all(book.author == "Jim Davis" for book in books))
+
+
+    def test_overdue_report(self):
+        today = date.today().isoformat()
+        overdue_loans = self.db.get_filtered_loans(filter_attributes=Loan(), max_due_date=today)
+
+        report = list(self.db.overdue_report(as_of=today, chunk_size=2))
+
+        self.assertEqual(len(overdue_loans), len(report))
+        for entry in report:
+            self.assertEqual((date.today() - date.fromisoformat(entry.due_date)).days, entry.days_overdue)
+            self.assertIn(f"Checkout Date: {entry.checkout_date}", str(entry))
+
+
+class ImportTests(TestCase):
+    # How long import main may take, in milliseconds. It takes about 10-25 ms; importing the database driver, numpy or
+    # connecting at import time would blow well past this.
+    IMPORT_TIME_BUDGET_MS = 100
+
+    def test_startup_imports(self):
+        # Run in a fresh interpreter, since this one already has everything imported. The fastest of a few runs is
+        # used so a busy machine doesn't fail the test.
+        code = ("import sys, main, db_handler; "
+                "print([m for m in ['mariadb', 'sqlite3', 'logging', 'csv', 'numpy'] if m in sys.modules]); "
+                "print(db_handler.conn.connected)")
+        import_times = []
+
+        for _ in range(3):
+            result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                                    check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+            imported, connected = result.stdout.splitlines()
+            self.assertEqual("[]", imported)
+            self.assertEqual("False", connected)
+
+            # -X importtime writes "import time: <self us> | <cumulative us> | <module>" lines to stderr
+            for line in result.stderr.splitlines():
+                fields = line.removeprefix("import time:").split("|")
+                if len(fields) == 3 and fields[2].strip() == "main":
+                    import_times.append(int(fields[1]) / 1000)
+
+        self.assertEqual(3, len(import_times))
+        self.assertLess(min(import_times), self.IMPORT_TIME_BUDGET_MS, f"import main took {min(import_times):.1f} ms")
+
+
 if __name__ == '__main__':
     test = main()
@@ -0,0 +1,329 @@
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import db_handler as db
+from models.LoanHistory import LoanHistory
+from models.Waitlist import Waitlist
+from models.Book import Book
+from models.Loan import Loan
+from models.User import User
+
+HOST = "127.0.0.1"
+PORT = 8080
+
+# Query string parameters that are converted to int and bool before being passed on
+INT_PARAMS = {"num_owned", "publication_year", "place_in_line", "min_publication_year", "max_publication_year",
+              "min_place_in_line", "max_place_in_line", "due_within_days", "limit"}
+BOOL_PARAMS = {"use_patterns"}
+
+# GET path -> (model used for the filter attributes, generator function that streams the matches, the query string
+# parameters it supports). Only the model attributes the query actually filters on are listed.
+SEARCHES = {
+    "/books": (Book, db.iter_filtered_books,
+               {"isbn", "title", "author", "publication_year", "publisher", "num_owned", "use_patterns",
+                "min_publication_year", "max_publication_year"}),
+    "/users": (User, db.iter_filtered_users, {"account_id", "name", "address", "phone_number", "email", "use_patterns"}),
+    "/loans": (Loan, db.iter_filtered_loans,
+               {"isbn", "account_id", "checkout_date", "due_date", "min_checkout_date", "max_checkout_date",
+                "min_due_date", "max_due_date"}),
+    "/loan_history": (LoanHistory, db.iter_filtered_loan_histories,
+                      {"isbn", "account_id", "checkout_date", "due_date", "return_date", "min_checkout_date",
+                       "max_checkout_date", "min_due_date", "max_due_date", "min_return_date", "max_return_date"}),
+    "/waitlist": (Waitlist, db.iter_filtered_waitlist,
+                  {"isbn", "account_id", "place_in_line", "min_place_in_line", "max_place_in_line"}),
+}
+
+SEARCH_PARAMS = {"q", "limit"}
+OVERDUE_PARAMS = {"as_of", "due_within_days"}
+
+# Exact-value parameters the queries only support as a range, e.g. publication_year=1995 is
+# min_publication_year=1995&max_publication_year=1995
+RANGE_PARAMS = {"publication_year": ("min_publication_year", "max_publication_year")}
+
+
+class BadRequest(Exception):
+    pass
+
+
+def to_json(o) -> dict:
+    """
+    returns the attributes of a model object as a dict.
+    """
+    return {name: getattr(o, name) for name in type(o).__slots__}
+
+
+def parse_params(query: str) -> dict:
+    """
+    query - A URL query string, e.g. "author=Jim%20Davis&min_publication_year=1990"
+
+    returns a dict of the parameters, with the INT_PARAMS and BOOL_PARAMS converted.
+    """
+    params = {}
+    for name, value in parse_qsl(query):
+        try:
+            if name in INT_PARAMS:
+                value = int(value)
+            elif name in BOOL_PARAMS:
+                value = value.lower() in ("1", "true", "yes")
+        except ValueError:
+            raise BadRequest(f"{name} must be an integer")
+
+        params[name] = value
+
+    return params
+
+
+def check_params(path: str, params: dict, supported: set):
+    """
+    Raises BadRequest if params has any parameter that isn't in supported.
+    """
+    unsupported = sorted(set(params) - supported)
+    if unsupported:
+        raise BadRequest(f"{path} doesn't support {', '.join(unsupported)}")
+
+
+def exact_to_range(params: dict) -> dict:
+    """
+    returns params with the RANGE_PARAMS replaced by the min_/max_ parameters they stand for.
+    """
+    params = dict(params)
+    for name, (min_name, max_name) in RANGE_PARAMS.items():
+        if name in params:
+            value = params.pop(name)
+            params.setdefault(min_name, value)
+            params.setdefault(max_name, value)
+
+    return params
+
+
+def split_filters(model, params: dict) -> tuple:
+    """
+    returns a model object with the params that are its attributes set, and a dict of the other params.
+    """
+    filter_attributes = model()
+    other_params = {}
+
+    for name, value in params.items():
+        if name in model.__slots__:
+            setattr(filter_attributes, name, value)
+        else:
+            other_params[name] = value
+
+    return filter_attributes, other_params
+
+
+def require(body: dict, *names: str) -> list:
+    """
+    returns the values of names in body, raising BadRequest if any are missing.
+    """
+    missing = [name for name in names if body.get(name) is None]
+    if missing:
+        raise BadRequest(f"Missing {', '.join(missing)}")
+
+    return [body[name] for name in names]
+
+
+def checkout(body: dict, session: db.Session) -> dict:
+    isbn, account_id = require(body, "isbn", "account_id")
+    outcome, place = db.try_checkout(isbn=isbn, account_id=account_id, session=session)
+    return {"outcome": outcome, "place_in_line": place}
+
+
+def return_book(body: dict, session: db.Session) -> dict:
+    isbn, account_id = require(body, "isbn", "account_id")
+    (outcome,) = db.return_books([(isbn, account_id)], session=session)
+    return {"outcome": outcome}
+
+
+def grant_extension(body: dict, session: db.Session) -> dict:
+    isbn, account_id = require(body, "isbn", "account_id")
+    return {"outcome": db.grant_extension(isbn=isbn, account_id=account_id, session=session)}
+
+
+def add_book(body: dict, session: db.Session) -> dict:
+    require(body, "isbn", "title", "author", "publication_year", "publisher", "num_owned")
+    new_book, _ = split_filters(Book, body)
+    if db.book_exists(isbn=new_book.isbn, session=session):
+        raise BadRequest("A book with that ISBN already exists")
+
+    db.add_book(new_book=new_book, session=session)
+    return to_json(new_book)
+
+
+def add_user(body: dict, session: db.Session) -> dict:
+    require(body, "account_id", "name", "address", "phone_number", "email")
+    new_user, _ = split_filters(User, body)
+    if db.user_exists(account_id=new_user.account_id, session=session):
+        raise BadRequest("A user with that account ID already exists")
+
+    db.add_user(new_user=new_user, session=session)
+    return to_json(new_user)
+
+
+# POST path -> function taking the JSON body and a Session, returning the JSON response
+ACTIONS = {
+    "/checkout": checkout,
+    "/return": return_book,
+    "/extension": grant_extension,
+    "/books": add_book,
+    "/users": add_user,
+}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the circulation operations as JSON. Every request runs on its own pooled Session, so requests on different
+    threads don't share a connection:
+
+        POST /checkout, /return, /extension  {"isbn": ..., "account_id": ...}
+        POST /books, /users                  a Book or User as a JSON object
+        GET  /books, /users, /loans, /loan_history, /waitlist
+             ?<attribute or min_/max_ filter>=...  streams every match as a JSON array (see SEARCHES for the
+                                                   parameters each one supports)
+        GET  /search?q=...&limit=20           full-text book search
+        GET  /overdue?as_of=...&due_within_days=...
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+
+        try:
+            params = parse_params(url.query)
+
+            if url.path in SEARCHES:
+                model, search, supported = SEARCHES[url.path]
+                check_params(url.path, params, supported)
+                filter_attributes, other_params = split_filters(model, exact_to_range(params))
+                self.send_stream(lambda session: search(filter_attributes=filter_attributes, session=session,
+                                                        **other_params))
+
+            elif url.path == "/search":
+                check_params(url.path, params, SEARCH_PARAMS)
+                with db.Session() as session:
+                    books = db.search_books_fulltext(query=params.get("q", ""), limit=params.get("limit", 20),
+                                                     session=session)
+                self.send_json(200, [to_json(book) for book in books])
+
+            elif url.path == "/overdue":
+                check_params(url.path, params, OVERDUE_PARAMS)
+                self.send_stream(lambda session: db.overdue_report(session=session, **params))
+
+            else:
+                self.send_json(404, {"error": f"No such path {url.path}"})
+
+        except (BadRequest, ValueError) as error:
+            self.send_json(400, {"error": str(error)})
+
+        except db.Error as error:
+            self.send_json(500, {"error": str(error)})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        action = ACTIONS.get(url.path)
+        if action is None:
+            self.send_json(404, {"error": f"No such path {url.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(body, dict):
+                raise BadRequest("The body must be a JSON object")
+
+            with db.Session() as session:
+                response = action(body, session)
+
+            self.send_json(200, response)
+
+        except (BadRequest, ValueError) as error:  # json.JSONDecodeError is a ValueError
+            self.send_json(400, {"error": str(error)})
+
+        except db.Error as error:
+            self.send_json(500, {"error": str(error)})
+
+    def send_json(self, status: int, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, search):
+        """
+        search - Takes a Session and returns a generator of model objects.
+
+        Sends the objects as a JSON array with chunked transfer encoding, one chunk per db_handler.DEFAULT_CHUNK_SIZE
+        objects, so a large result is never held in memory. The Session is held until the last chunk is sent.
+
+        A db_handler.Error before the headers are sent is raised as usual. After that the 200 can't be taken back, so the
+        connection is closed without ending the chunked body, which tells the client the response is incomplete.
+        """
+        headers_sent = False
+
+        try:
+            with db.Session() as session:
+                objects = search(session)
+
+                try:
+                    # Run the query before sending the headers, so a bad filter can still get a 400
+                    first = next(objects, None)
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    headers_sent = True
+
+                    prefix = "["
+                    chunk = [] if first is None else [json.dumps(to_json(first))]
+                    for o in objects:
+                        chunk.append(json.dumps(to_json(o)))
+                        if len(chunk) == db.DEFAULT_CHUNK_SIZE:
+                            self.write_chunk(prefix + ",".join(chunk))
+                            prefix, chunk = ",", []
+
+                    if chunk:
+                        self.write_chunk(prefix + ",".join(chunk) + "]")
+                    else:
+                        self.write_chunk("[]" if prefix == "[" else "]")
+                    self.write_chunk("")  # End of the response
+
+                finally:
+                    objects.close()
+
+        except db.Error:
+            if not headers_sent:
+                raise
+            self.close_connection = True
+
+    def write_chunk(self, text: str):
+        data = text.encode()
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+
+    def log_message(self, format, *args):
+        pass  # One line per request to stderr slows the server down a lot under load
+
+
+def make_server(host: str = HOST, port: int = PORT) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    server = make_server()
+    print(f"Serving on http://{HOST}:{PORT} with a pool of {db.POOL_SIZE} connections")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
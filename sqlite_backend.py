@@ -0,0 +1,445 @@
+"""
+The embedded SQLite backend (see backends.py). It is its own module so that the regular expressions, sqlite3 and
+datetime it needs are only imported when DB_CONFIG["backend"] is "sqlite".
+"""
+import re
+import sqlite3
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime
+from functools import lru_cache
+
+from backends import BACKEND_SQLITE
+
+DEFAULT_SQLITE_PATH = "library.sqlite3"
+
+# MariaDB's backslash escapes in string literals. Any other escaped character stands for itself.
+_ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a", "%": "\\%", "_": "\\_"}
+_STRING_LITERAL = re.compile(r"""'((?:[^'\\]|\\.|'')*)'|"((?:[^"\\]|\\.|"")*)\"""", re.DOTALL)
+_ESCAPE_SEQUENCE = re.compile(r"\\(.)", re.DOTALL)
+
+_DATE_ARITHMETIC = re.compile(r"\b(DATE_ADD|DATE_SUB)\s*\(", re.IGNORECASE)
+_DATEDIFF = re.compile(r"\b(DATEDIFF)\s*\(", re.IGNORECASE)
+_INTERVAL = re.compile(r"^\s*INTERVAL\s+(.+?)\s+(DAY|WEEK|MONTH|YEAR)\s*$", re.IGNORECASE | re.DOTALL)
+# How many of the SQLite date modifier unit each MariaDB interval unit is
+_INTERVAL_UNITS = {"DAY": (1, "days"), "WEEK": (7, "days"), "MONTH": (1, "months"), "YEAR": (1, "years")}
+
+_CURRENT_DATE = re.compile(r"\b(?:CURDATE|CURRENT_DATE)\s*\(\s*\)", re.IGNORECASE)
+_NOW = re.compile(r"\bNOW\s*\(\s*\)", re.IGNORECASE)
+_LOCKING_READ = re.compile(r"\s+(?:FOR\s+UPDATE|LOCK\s+IN\s+SHARE\s+MODE)\b", re.IGNORECASE)
+_UPSERT = re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", re.IGNORECASE)
+_UPSERT_VALUE = re.compile(r"\bVALUES\s*\(\s*(\w+)\s*\)", re.IGNORECASE)
+_LIKE = re.compile(r"\bLIKE\s+\?(?!\s*ESCAPE)", re.IGNORECASE)
+_MATCH_AGAINST = re.compile(r"\bMATCH\s*\(([^)]*)\)\s*AGAINST\s*\(\s*\?\s*IN\s+NATURAL\s+LANGUAGE\s+MODE\s*\)",
+                            re.IGNORECASE)
+_JOIN_DELETE = re.compile(r"^\s*DELETE\s+(\w+)\s+FROM\s+(\w+)\s+(\w+)\s+JOIN\s+(.+?)\s+ON\s+(.+?)"
+                          r"(?:\s+WHERE\s+(.+?))?\s*;?\s*$", re.IGNORECASE | re.DOTALL)
+_CREATE_TABLE = re.compile(r"^\s*CREATE\s+(?:TEMPORARY\s+)?TABLE\b", re.IGNORECASE)
+_VARCHAR = re.compile(r"\bVARCHAR\s*\(\s*\d+\s*\)", re.IGNORECASE)
+_UNIQUE_KEY = re.compile(r"\bUNIQUE\s+KEY\s+\w+\s*\(", re.IGNORECASE)
+_SCHEMA_CHANGE = re.compile(r"^\s*(?:CREATE|DROP|ALTER)\b", re.IGNORECASE)
+_FULLTEXT_INDEX = re.compile(r"^\s*CREATE\s+FULLTEXT\s+INDEX\b", re.IGNORECASE)
+
+
+def _unescape(text: str, quote: str) -> str:
+    text = text.replace(quote * 2, quote)
+    return _ESCAPE_SEQUENCE.sub(lambda match: _ESCAPES.get(match.group(1), match.group(1)), text)
+
+
+def _literals_to_params(statement: str) -> tuple[str, list]:
+    """
+    returns statement with every string literal replaced by a ? placeholder, and the values of the literals in order.
+    """
+    params = []
+
+    def replace(match):
+        if match.group(1) is not None:
+            params.append(_unescape(match.group(1), "'"))
+        else:
+            params.append(_unescape(match.group(2), '"'))
+        return "?"
+
+    return _STRING_LITERAL.sub(replace, statement), params
+
+
+def _closing_paren(text: str, open_index: int) -> int:
+    """
+    returns the index of the ')' matching the '(' at open_index.
+    """
+    depth = 0
+    for i in range(open_index, len(text)):
+        if text[i] == "(":
+            depth += 1
+        elif text[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError(f"Unbalanced parentheses in {text!r}")
+
+
+def _split_arguments(text: str) -> list[str]:
+    """
+    returns text split on the commas that aren't inside parentheses.
+    """
+    arguments = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(text):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            arguments.append(text[start:i].strip())
+            start = i + 1
+    arguments.append(text[start:].strip())
+    return arguments
+
+
+def _rewrite_calls(query: str, pattern: re.Pattern, rewrite) -> str:
+    """
+    returns query with every call to the function matched by pattern replaced by rewrite(name, arguments). Calls nested
+        in the arguments are rewritten first.
+    """
+    parts = []
+    position = 0
+
+    while (match := pattern.search(query, position)) is not None:
+        open_index = match.end() - 1
+        close_index = _closing_paren(query, open_index)
+        arguments = [_rewrite_calls(argument, pattern, rewrite)
+                     for argument in _split_arguments(query[open_index + 1:close_index])]
+
+        parts.append(query[position:match.start()])
+        parts.append(rewrite(match.group(1).upper(), arguments))
+        position = close_index + 1
+
+    parts.append(query[position:])
+    return "".join(parts)
+
+
+def _date_arithmetic(name: str, arguments: list[str]) -> str:
+    expression, interval = arguments
+    match = _INTERVAL.match(interval)
+    if match is None:
+        raise ValueError(f"Unsupported interval {interval!r}")
+
+    amount, unit = match.group(1), match.group(2).upper()
+    multiplier, modifier_unit = _INTERVAL_UNITS[unit]
+    if name == "DATE_SUB":
+        multiplier = -multiplier
+
+    if re.fullmatch(r"-?\d+", amount):
+        return f"date({expression}, '{int(amount) * multiplier} {modifier_unit}')"
+    return f"date({expression}, (({amount}) * {multiplier}) || ' {modifier_unit}')"
+
+
+def _datediff(name: str, arguments: list[str]) -> str:
+    first, second = arguments
+    return f"CAST(julianday({first}) - julianday({second}) AS INTEGER)"
+
+
+def _translate_join_delete(match: re.Match) -> str:
+    alias, table, table_alias, joined, condition, where = match.groups()
+    if alias.lower() != table_alias.lower():
+        raise ValueError(f"Unsupported DELETE of {alias} from {table} {table_alias}")
+
+    conditions = condition if where is None else f"{condition} AND ({where})"
+    return f"DELETE FROM {table} AS {alias} WHERE EXISTS (SELECT 1 FROM {joined} WHERE {conditions})"
+
+
+def _translate(query: str) -> tuple[str, bool]:
+    """
+    returns (the query in SQLite's dialect, whether it was a locking read). The query is None if SQLite has nothing
+        equivalent and it should be skipped, i.e. a FULLTEXT index (match_against scans instead).
+    """
+    if _FULLTEXT_INDEX.match(query):
+        return None, False
+
+    query, num_locks = _LOCKING_READ.subn("", query)
+
+    if _CREATE_TABLE.match(query):
+        # MariaDB's default collation compares strings case-insensitively
+        query = _VARCHAR.sub(lambda match: match.group(0) + " COLLATE NOCASE", query)
+        query = _UNIQUE_KEY.sub("UNIQUE (", query)
+
+    join_delete = _JOIN_DELETE.match(query)
+    if join_delete is not None:
+        query = _translate_join_delete(join_delete)
+
+    if _UPSERT.search(query):
+        query = _UPSERT.sub("ON CONFLICT DO UPDATE SET", query)
+        query = _UPSERT_VALUE.sub(r"excluded.\1", query)
+
+    query = _CURRENT_DATE.sub("date('now', 'localtime')", query)
+    query = _NOW.sub("datetime('now', 'localtime')", query)
+    if "DATE" in query.upper():
+        query = _rewrite_calls(query, _DATE_ARITHMETIC, _date_arithmetic)
+        query = _rewrite_calls(query, _DATEDIFF, _datediff)
+
+    # MariaDB treats \ as the escape character in LIKE patterns, SQLite has none unless told
+    query = _LIKE.sub(r"LIKE ? ESCAPE '\\'", query)
+    query = _MATCH_AGAINST.sub(r"match_against(?, \1)", query)
+
+    return query, num_locks > 0
+
+
+@lru_cache(maxsize=1024)
+def translate(query: str) -> tuple[str, bool]:
+    """
+    query - A statement written for MariaDB.
+
+    returns (the query in SQLite's dialect, whether it was a locking read). Cached, since db_handler runs the same few
+        statements over and over. The differences handled are:
+            CURDATE(), CURRENT_DATE() and NOW()        -> date('now', 'localtime') and datetime('now', 'localtime')
+            DATE_ADD/DATE_SUB(date, INTERVAL n unit)   -> date(date, '±n days/months/years')
+            DATEDIFF(a, b)                             -> the difference of julianday(a) and julianday(b)
+            SELECT ... FOR UPDATE / LOCK IN SHARE MODE -> the SELECT, run in a BEGIN IMMEDIATE transaction
+            ON DUPLICATE KEY UPDATE                    -> ON CONFLICT DO UPDATE SET
+            DELETE a FROM A a JOIN B b ON ...          -> DELETE FROM A AS a WHERE EXISTS (SELECT 1 FROM B b WHERE ...)
+            LIKE ?                                     -> LIKE ? ESCAPE '\\'
+            MATCH(columns) AGAINST (? IN NATURAL LANGUAGE MODE) -> match_against(?, columns)
+            VARCHAR(n) in CREATE TABLE                 -> VARCHAR(n) COLLATE NOCASE
+            UNIQUE KEY name (columns)                  -> UNIQUE (columns)
+            CREATE FULLTEXT INDEX                      -> skipped
+    """
+    return _translate(query)
+
+
+@lru_cache(maxsize=256)
+def _search_words(query: str) -> frozenset:
+    # Like InnoDB full-text search, words shorter than 3 characters are ignored
+    return frozenset(word for word in re.findall(r"\w+", query.lower()) if len(word) >= 3)
+
+
+def match_against(query: str, *columns) -> int:
+    """
+    The SQLite stand-in for MATCH(columns) AGAINST (query IN NATURAL LANGUAGE MODE). returns how many times the words
+        of query appear in columns, so 0 (false) when none of them do and more relevant rows score higher.
+    """
+    words = _search_words(query or "")
+    if not words:
+        return 0
+
+    counts = Counter(re.findall(r"\w+", " ".join(column for column in columns if column).lower()))
+    return sum(counts[word] for word in words)
+
+
+def _adapt(params) -> list:
+    """
+    returns params with dates and datetimes turned into the YYYY-MM-DD and YYYY-MM-DD HH:MM:SS text they are stored as.
+    """
+    return [value.isoformat(" ") if isinstance(value, datetime) else
+            value.isoformat() if isinstance(value, date) else value
+            for value in params]
+
+
+class SQLiteCursor:
+    """
+    A sqlite3 cursor that translates each statement to SQLite's dialect first. A locking read that starts a transaction
+    starts it with BEGIN IMMEDIATE, which takes SQLite's write lock, so nobody else can write until it commits.
+    SQLite locks the whole database rather than rows, so this is stricter than MariaDB's row locks but gives the same
+    guarantees.
+
+    Dates are stored as YYYY-MM-DD text. Date parameters are converted on the way in and columns declared DATE come back
+    as datetime.date, the same as from mariadb. This is done here rather than with sqlite3.register_adapter and
+    register_converter, which would change how dates are handled for every sqlite3 connection in the process.
+    """
+    def __init__(self, connection: "SQLiteConnection"):
+        self._connection = connection
+        self._conn = connection.raw
+        self._cursor = self._conn.cursor()
+        self._date_positions = ()
+
+    def _executed(self, sql: str):
+        """
+        Works out which columns of the result are dates, after sql has run.
+        """
+        if _SCHEMA_CHANGE.match(sql):
+            self._connection.forget_schema()
+
+        description = self._cursor.description
+        if description is None:
+            self._date_positions = ()
+        else:
+            date_columns = self._connection.date_columns()
+            self._date_positions = tuple(i for i, column in enumerate(description) if column[0] in date_columns)
+
+    def _convert(self, row):
+        if row is None or not self._date_positions:
+            return row
+
+        row = list(row)
+        for i in self._date_positions:
+            if row[i] is not None:
+                row[i] = date.fromisoformat(row[i])
+        return tuple(row)
+
+    def execute(self, query: str, params=()):
+        sql, locking = translate(query)
+        if sql is None:
+            return
+
+        if locking and not self._conn.in_transaction:
+            self._cursor.execute("BEGIN IMMEDIATE")
+        self._cursor.execute(sql, _adapt(params))
+        self._executed(sql)
+
+    def execute_translated(self, sql: str, params=()):
+        """
+        Runs sql, which is already in SQLite's dialect.
+        """
+        self._cursor.execute(sql, _adapt(params))
+        self._executed(sql)
+
+    def executemany(self, query: str, params):
+        sql, _ = translate(query)
+        if sql is not None:
+            self._cursor.executemany(sql, (_adapt(row) for row in params))
+            self._executed(sql)
+
+    def fetchone(self):
+        return self._convert(self._cursor.fetchone())
+
+    def fetchmany(self, size: int = None):
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        return [self._convert(row) for row in rows] if self._date_positions else rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        return [self._convert(row) for row in rows] if self._date_positions else rows
+
+    def __iter__(self):
+        return map(self._convert, self._cursor) if self._date_positions else iter(self._cursor)
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    """
+    A sqlite3 connection that hands out SQLiteCursors. cursor() takes the mariadb prepared and buffered arguments but
+    ignores them: sqlite3 already caches prepared statements and steps through results a row at a time.
+    """
+    def __init__(self, path: str, timeout: float):
+        # IMMEDIATE makes the transactions sqlite3 opens before a write take the write lock straight away, so a
+        # transaction never has to upgrade its lock part way through (which can fail instead of waiting)
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level="IMMEDIATE", check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")  # Readers don't wait for the writer
+        self._conn.create_function("match_against", -1, match_against, deterministic=True)
+        self._date_columns = None
+
+    @property
+    def raw(self) -> sqlite3.Connection:
+        return self._conn
+
+    def date_columns(self) -> frozenset:
+        """
+        returns the names of the columns declared DATE in any table, read from the schema the first time they are needed
+            after connecting or changing the schema.
+        """
+        if self._date_columns is None:
+            rows = self._conn.execute("""
+                SELECT DISTINCT c.name
+                FROM sqlite_master t, pragma_table_info(t.name) c
+                WHERE t.type = 'table' AND upper(c.type) = 'DATE'
+            """).fetchall()
+            self._date_columns = frozenset(name for (name,) in rows)
+        return self._date_columns
+
+    def forget_schema(self):
+        self._date_columns = None
+
+    def cursor(self, prepared: bool = False, buffered: bool = True) -> SQLiteCursor:
+        return SQLiteCursor(self)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+
+class SQLitePool:
+    """
+    SQLite connections are cheap to open, so every connection from the "pool" is a new one and closing it closes it.
+    """
+    def __init__(self, backend):
+        self._backend = backend
+
+    def get_connection(self) -> SQLiteConnection:
+        return self._backend.connect()
+
+    def close(self):
+        pass  # Every connection is closed when it is handed back
+
+
+class SQLiteBackend:
+    name = BACKEND_SQLITE
+    Error = sqlite3.Error
+    ProgrammingError = sqlite3.OperationalError  # What a bad statement or missing table raises
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.path = config.get("sqlite_path", DEFAULT_SQLITE_PATH)
+        self.timeout = config.get("sqlite_timeout", 5.0)
+
+    def connect(self, use_database: bool = True) -> SQLiteConnection:
+        return SQLiteConnection(self.path, self.timeout)
+
+    def connection_pool(self, pool_name: str, pool_size: int) -> SQLitePool:
+        return SQLitePool(self)
+
+    def describe(self) -> str:
+        return f"\tSQLite database: {self.path}"
+
+    def use_database(self, cur):
+        pass  # The file is the database, and connecting creates it
+
+    @contextmanager
+    def bulk_load(self, cur):
+        yield  # sqlite3 already runs the whole load in one transaction
+
+    def execute_literal(self, cur: SQLiteCursor, statement: str):
+        """
+        Runs a statement from one of the data files, which has all of its values written out in it as MariaDB literals.
+        The strings are sent as parameters, which saves translating their escapes. Not cached, since every statement
+        is different.
+        """
+        statement, params = _literals_to_params(statement)
+        sql, _ = _translate(statement)
+        if sql is not None:
+            cur.execute_translated(sql, params)
+
+    def is_view(self, cur, name: str) -> bool:
+        cur.execute("SELECT type FROM sqlite_master WHERE name = ?", [name])
+        row = cur.fetchone()
+        return row is not None and row[0] == "view"
+
+    def explain(self, cur, query: str, params: list) -> tuple[str, str]:
+        """
+        returns (possible_keys, key) like MariaDB's EXPLAIN, from EXPLAIN QUERY PLAN. SQLite only reports the index it
+            picked, so both are that index (None for a full scan).
+        """
+        sql, _ = translate(query)
+        cur.execute_translated("EXPLAIN QUERY PLAN " + sql, params)
+        plan = " ".join(row[-1] for row in cur.fetchall())
+
+        match = re.search(r"USING (?:COVERING )?INDEX (\w+)|USING (?:INTEGER )?PRIMARY KEY", plan)
+        key = None if match is None else match.group(1) or "PRIMARY"
+        return key, key
+
+    def version(self, cur) -> str:
+        cur.execute("SELECT sqlite_version()")
+        return "SQLite " + cur.fetchone()[0]